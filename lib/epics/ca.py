@@ -1248,6 +1248,11 @@ def put(chid, value, wait=False, timeout=30, callback=None,
     """
     ftype = field_type(chid)
     count = element_count(chid)
+    fast = _numpy_put_data(value, ftype, count)
+    if fast is not None:
+        count, data = fast
+        return _put_data(chid, ftype, count, data, wait, timeout,
+                         callback, callback_data)
     if count > 1:
         # check that data for array PVS is a list, array, or string
         try:
@@ -1297,6 +1302,29 @@ def put(chid, value, wait=False, timeout=30, callback=None,
             errmsg = "cannot put array data to PV of type '%s'"
             raise ChannelAccessException(errmsg % (repr(value)))
 
+    return _put_data(chid, ftype, count, data, wait, timeout,
+                     callback, callback_data)
+
+def _numpy_put_data(value, ftype, count):
+    """returns (count, pointer) for a numpy array that can be sent to the
+    channel without any conversion: a C-contiguous array whose dtype is the
+    channel's native type.  Returns None for anything else, in which case
+    the value has to be copied into a ctypes array element by element.
+
+    The pointer is only valid for as long as the caller holds a reference
+    to value.
+    """
+    if not (HAS_NUMPY and count > 1 and isinstance(value, numpy.ndarray)):
+        return None
+    if (ftype not in dbr.NP_Map or
+        value.dtype != numpy.dtype(dbr.NP_Map[ftype]) or
+        not value.flags['C_CONTIGUOUS'] or value.size < 1):
+        return None
+    return (min(value.size, count), ctypes.c_void_p(value.ctypes.data))
+
+def _put_data(chid, ftype, count, data, wait=False, timeout=30,
+              callback=None, callback_data=None):
+    "sends already converted data to the channel. see put()"
     # simple put, without wait or callback
     if not (wait or hasattr(callback, '__call__')):
         ret =  libca.ca_array_put(ftype, count, chid, data)
@@ -1584,6 +1612,18 @@ def sg_put(gid, chid, value):
 
     ftype = field_type(chid)
     count = element_count(chid)
+    fast = _numpy_put_data(value, ftype, count)
+    if fast is not None:
+        count, data = fast
+        ret =  libca.ca_sg_array_put(gid, ftype, count, chid, data)
+        PySEVCHK('sg_put', ret)
+        return ret
+    if count > 1 and not (ftype == dbr.CHAR and isinstance(value, str)):
+        # as with put(), only send as many elements as we were given
+        try:
+            count = min(len(value), count)
+        except TypeError:
+            pass
     data  = (count*dbr.Map[ftype])()
 
     if ftype == dbr.STRING:
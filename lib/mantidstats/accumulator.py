@@ -0,0 +1,91 @@
+'''
+Created on Oct 18, 2026
+
+
+Base class for calc functions that keep a running value over a run.
+
+Most of the 'total for the run' PV's don't need the accumulated workspace at
+all.  They can just add each chunk's contribution to a running state and
+reset it when the run number changes.  That's what this class does.  Using
+it instead of a post processing function means the live listener doesn't
+have to preserve events, which saves a lot of RAM and CPU on long runs.
+
+A subclass overrides update() (and optionally initial_state() and value()):
+
+    class EventCount(Accumulator):
+        def update( self, state, context, pv_name):
+            return state + context.total_events()
+
+One instance can serve several PV's.  Each PV name gets its own state.
+'''
+
+import threading
+
+
+class Accumulator(object):
+    '''
+    Keeps a run-scoped state for each PV name and updates it from each chunk.
+    '''
+
+    # Each PV only touches its own state
+    thread_safe = True
+
+    def __init__(self):
+        self._states = {}    # PV name -> current state
+        self._run_nums = {}  # PV name -> run number the state belongs to
+        self._lock = threading.Lock()
+
+    def initial_state( self, pv_name):
+        '''
+        Returns the state at the start of a run.  Defaults to 0.
+        '''
+        return 0
+
+    def update( self, state, context, pv_name):
+        '''
+        Returns the new state after adding the chunk in context.  Subclasses
+        must override this.
+        '''
+        raise NotImplementedError( "Accumulator subclasses must override "
+                                   "update()")
+
+    def value( self, state, pv_name):
+        '''
+        Returns the PV value for a state.  Defaults to the state itself.
+        '''
+        return state
+
+    def __call__( self, pv_name, run_num, context, **kwargs):
+        state = self._get( pv_name, run_num)
+        state = self.update( state, context, pv_name)
+        self._states[pv_name] = state
+        return self.value( state, pv_name)
+
+    def _get( self, pv_name, run_num):
+        '''
+        Returns the current state for the PV, starting over if the run
+        number has changed
+        '''
+        if self._run_nums.get( pv_name) != run_num:
+            self._states[pv_name] = self.initial_state( pv_name)
+            self._run_nums[pv_name] = run_num
+        return self._states[pv_name]
+
+    # These two let the states survive a plugin reload (see plugin_reload.py)
+    def get_state( self):
+        self._lock.acquire()
+        try:
+            return (dict( self._states), dict( self._run_nums))
+        finally:
+            self._lock.release()
+
+    def set_state( self, state):
+        self._lock.acquire()
+        try:
+            (states, run_nums) = state
+            self._states.update( states)
+            self._run_nums.update( run_nums)
+        finally:
+            self._lock.release()
+
+# End of class Accumulator
@@ -0,0 +1,248 @@
+'''
+Created on Oct 18, 2026
+
+
+Periodic checkpoints of the accumulated plugin state.
+
+The values that build up over a run (event counts, proton charge, detector
+images, etc..) only live in memory.  If the service is restarted in the
+middle of a run, they'd start over from 0.  The only way to rebuild them
+would be to replay the run from the start.
+
+To avoid that, the main program periodically collects the state from every
+calc function that has a get_state() method (the same state that's handed
+over when a plugin is reloaded - see plugin_reload.py) and a Checkpointer
+writes it to disk from a background thread.  The first chunk after the
+program starts restores the state with set_state(), if the checkpoint is
+for the same run.
+
+Checkpoint files are NumPy .npz files named after the run number.  Each
+NumPy array in the state is stored as its own (uncompressed) entry, so the
+large arrays are written and read without any conversion.  Everything else
+is pickled into a single small entry.
+'''
+
+import os
+import re
+import glob
+import threading
+import cPickle as pickle
+import logging
+
+import numpy as np
+
+_FILE_PREFIX = "mantidstats_run"
+_FILE_RE = re.compile( r'^%s([0-9]+)\.npz$'%_FILE_PREFIX)
+
+# The name of the .npz entry that holds the pickled (array-less) state
+_SKELETON = "skeleton"
+
+
+class _ArrayRef(object):
+    '''
+    Stands in for an array in the pickled part of a checkpoint
+    '''
+    def __init__(self, key):
+        self.key = key
+
+
+def _extract_arrays( obj, arrays):
+    '''
+    Returns a copy of obj with every NumPy array replaced by an _ArrayRef.
+    The arrays themselves are copied into the arrays dict.  Only dicts,
+    lists and tuples are searched.
+    '''
+    if isinstance( obj, np.ndarray):
+        key = "a%d"%len(arrays)
+        arrays[key] = np.array( obj)
+        return _ArrayRef( key)
+    elif isinstance( obj, dict):
+        return dict( [ (k, _extract_arrays( v, arrays))
+                       for (k, v) in obj.items() ])
+    elif isinstance( obj, list):
+        return [ _extract_arrays( v, arrays) for v in obj ]
+    elif isinstance( obj, tuple):
+        return tuple( [ _extract_arrays( v, arrays) for v in obj ])
+    return obj
+
+
+def _insert_arrays( obj, arrays):
+    '''
+    The reverse of _extract_arrays()
+    '''
+    if isinstance( obj, _ArrayRef):
+        return arrays[obj.key]
+    elif isinstance( obj, dict):
+        return dict( [ (k, _insert_arrays( v, arrays))
+                       for (k, v) in obj.items() ])
+    elif isinstance( obj, list):
+        return [ _insert_arrays( v, arrays) for v in obj ]
+    elif isinstance( obj, tuple):
+        return tuple( [ _insert_arrays( v, arrays) for v in obj ])
+    return obj
+
+
+def checkpoint_path( checkpoint_dir, run_num):
+    return os.path.join( checkpoint_dir, "%s%d.npz"%(_FILE_PREFIX, run_num))
+
+
+class Checkpointer(object):
+    '''
+    Writes checkpoints in a background thread and reads them back.
+    '''
+
+    def __init__(self, checkpoint_dir):
+        self._dir = checkpoint_dir
+
+        # The snapshot waiting to be written: (run number, skeleton, arrays)
+        self._pending = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop_requested = False
+
+    def start( self):
+        '''
+        Start the writer thread
+        '''
+        if not os.path.isdir( self._dir):
+            os.makedirs( self._dir)
+
+        self._stop_requested = False
+        self._thread = threading.Thread( target=self._run,
+                                         name="Checkpoint Writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop( self):
+        '''
+        Stop the writer thread after it writes anything that's pending
+        '''
+        if self._thread is None:
+            return
+        self._cond.acquire()
+        self._stop_requested = True
+        self._cond.notify()
+        self._cond.release()
+        self._thread.join()
+        self._thread = None
+
+    def busy( self):
+        '''
+        Returns True if the previous snapshot hasn't been written yet
+        '''
+        return self._pending is not None
+
+    def save( self, run_num, states):
+        '''
+        Queue a checkpoint for the run.  states is a dict mapping a (stable)
+        key for each callable to whatever its get_state() returned.
+
+        The arrays are copied here, so the caller can go on modifying its
+        own.  The actual writing happens in the writer thread (or right
+        here, if the thread isn't running).  If the previous checkpoint is
+        still being written, this one is dropped.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        if self.busy():
+            logger.debug( "Previous checkpoint is still being written.  "
+                          "Skipping this one.")
+            return False
+
+        arrays = {}
+        try:
+            # Pickle the rest now, too, since it may also be changed as soon
+            # as we return
+            skeleton = pickle.dumps( _extract_arrays( states, arrays),
+                                     pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            logger.error( "Couldn't checkpoint the plugin state: %s"%e)
+            return False
+
+        if self._thread is None:
+            self._write( run_num, skeleton, arrays)
+            return True
+
+        self._cond.acquire()
+        self._pending = (run_num, skeleton, arrays)
+        self._cond.notify()
+        self._cond.release()
+        return True
+
+    def load( self, run_num):
+        '''
+        Returns the states dict from the checkpoint for the run, or None if
+        there isn't one (or it can't be read)
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        path = checkpoint_path( self._dir, run_num)
+        if not os.path.exists( path):
+            return None
+
+        try:
+            data = np.load( path)
+            try:
+                arrays = {}
+                for key in data.files:
+                    if key != _SKELETON:
+                        arrays[key] = data[key]
+                skeleton = pickle.loads( data[_SKELETON].tostring())
+            finally:
+                data.close()
+            return _insert_arrays( skeleton, arrays)
+        except Exception, e:
+            logger.error( "Couldn't read checkpoint file %s: %s"%(path, e))
+            return None
+
+    def _write( self, run_num, skeleton, arrays):
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        path = checkpoint_path( self._dir, run_num)
+        tmp_path = path + ".tmp"
+
+        arrays = dict( arrays)
+        arrays[_SKELETON] = np.frombuffer( skeleton, dtype=np.uint8)
+        try:
+            f = open( tmp_path, "wb")
+            try:
+                np.savez( f, **arrays)
+            finally:
+                f.close()
+            # rename() is atomic, so a crash never leaves a partial file
+            os.rename( tmp_path, path)
+        except (IOError, OSError), e:
+            logger.error( "Couldn't write checkpoint file %s: %s"%(path, e))
+            return
+
+        # Checkpoints for older runs are no use any more
+        for old in glob.glob( os.path.join( self._dir, _FILE_PREFIX + "*")):
+            m = _FILE_RE.match( os.path.basename( old))
+            if m and int( m.group(1)) != run_num:
+                try:
+                    os.remove( old)
+                except OSError:
+                    pass
+        logger.debug( "Wrote checkpoint for run %d"%run_num)
+
+    def _run( self):
+        '''
+        Main loop for the writer thread
+        '''
+        while True:
+            self._cond.acquire()
+            while self._pending is None and not self._stop_requested:
+                self._cond.wait()
+            pending = self._pending
+            stop = self._stop_requested
+            self._cond.release()
+
+            if pending is not None:
+                self._write( *pending)
+                # Only clear it after it's written so that save() knows
+                # we're still busy
+                self._cond.acquire()
+                self._pending = None
+                self._cond.release()
+
+            if stop:
+                break
+
+# End of class Checkpointer
@@ -0,0 +1,203 @@
+'''
+Created on Oct 18, 2026
+
+
+The per-chunk context object that's passed to every PV calc function (as
+the 'context' keyword).
+
+Many of the calc functions need the same things from the workspace: the
+number of events, the proton charge log, the per-spectrum event counts,
+etc..  Rather than have each function go back to the workspace, they ask
+the context for a named 'product'.  Each product is computed the first time
+it's requested and the result is reused for the rest of the chunk.
+
+Plugins can register their own products (usually intermediate results that
+more than one PV needs) with register_product():
+
+    def _bank_totals( context):
+        counts = context.product( 'spectrum_counts')
+        ...
+
+    register_product( 'bank_totals', _bank_totals)
+
+Product functions take the context as their only argument and may request
+other products.  A product function that can't compute its value should
+return None (which is also memoized).
+'''
+
+import re
+import threading
+import logging
+
+import numpy as np
+
+# Maps product names to the functions that compute them
+_PRODUCTS = {}
+
+
+def register_product( name, func):
+    '''
+    Registers func as the function that computes the named product.
+    Re-registering a name replaces the old function.
+    '''
+    _PRODUCTS[name] = func
+
+
+class ChunkContext(object):
+    '''
+    Lazily computes (and memoizes) products of a single workspace.
+
+    A new context is created for each chunk (or each accumulation workspace,
+    in the case of post processing).
+    '''
+
+    def __init__(self, ws):
+        '''
+        ws is the workspace the products are computed from
+        '''
+        self.ws = ws
+        self._cache = {}
+
+        # Products may be requested from more than one thread (see
+        # CALC_THREADS in the config file).  Each product has its own lock
+        # so that computing an expensive product doesn't hold up requests
+        # for the cheap ones.  _lock just protects the dict of locks.
+        self._lock = threading.Lock()
+        self._product_locks = {}
+
+    def product( self, name):
+        '''
+        Returns the value of the named product, computing it if necessary.
+
+        Raises KeyError if no function has been registered for the name.
+        '''
+        if name in self._cache:
+            return self._cache[name]
+
+        self._lock.acquire()
+        try:
+            if not name in self._product_locks:
+                self._product_locks[name] = threading.Lock()
+            product_lock = self._product_locks[name]
+        finally:
+            self._lock.release()
+
+        product_lock.acquire()
+        try:
+            # Another thread may have computed it while we were waiting
+            if not name in self._cache:
+                self._cache[name] = _PRODUCTS[name]( self)
+            return self._cache[name]
+        finally:
+            product_lock.release()
+
+    # Convenience wrappers for the common products
+    def run_number( self):
+        return self.product( 'run_number')
+
+    def total_events( self):
+        return self.product( 'total_events')
+
+    def proton_charge_sum( self):
+        return self.product( 'proton_charge_sum')
+
+    def spectrum_counts( self):
+        return self.product( 'spectrum_counts')
+
+    def monitor_counts( self):
+        return self.product( 'monitor_counts')
+
+# End of class ChunkContext
+
+# -----------------------------------------------------------------------------
+# The standard products
+
+def _run_number( context):
+    return context.ws.getRunNumber()
+
+def _total_events( context):
+    return context.ws.getNumberEvents()
+
+def _proton_charge_log( context):
+    '''
+    The 'proton_charge' time series property (charge for each pulse), or
+    None if the workspace doesn't have one
+    '''
+    run = context.ws.run()
+    # For reasons that are unclear, calling run.getProtonCharge() causes the
+    # program to crash with an error about unknown property "gd_prtn_chrg"
+    if run.hasProperty( 'proton_charge'):
+        return run.getProperty( 'proton_charge')
+    return None
+
+def _proton_charge( context):
+    '''
+    NumPy array holding the charge for each pulse, or None
+    '''
+    p_charge = context.product( 'proton_charge_log')
+    if p_charge is None:
+        return None
+    return p_charge.value
+
+def _proton_charge_sum( context):
+    '''
+    Total charge (in picocoulombs) of all the pulses in the workspace.
+    0 if there's no proton_charge property.
+    '''
+    charge = context.product( 'proton_charge')
+    if charge is None:
+        return 0
+    return charge.sum()
+
+def _spectrum_counts( context):
+    '''
+    NumPy array holding the number of events in each spectrum (indexed by
+    workspace index), or None if the counts couldn't be extracted in bulk.
+    '''
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+    # extractY() hands back the whole (num_spectra x num_bins) array in
+    # a single call.  For an event workspace, the Y values are the events
+    # histogrammed into the workspace's bins, so summing across the bins
+    # gives the event count for each spectrum.
+    try:
+        counts = context.ws.extractY().sum(axis=1)
+    except (AttributeError, RuntimeError), e:
+        logger.debug( "Couldn't extract per-spectrum counts: %s"%e)
+        return None
+
+    # Events that fall outside the workspace's bin boundaries won't show
+    # up in the Y values.  If that happened, the bulk counts are wrong
+    # and the caller has to count the events the slow way.
+    counts = np.rint(counts).astype(np.int64)
+    total_event_count = context.product( 'total_events')
+    if counts.sum() != total_event_count:
+        logger.debug( "Bulk event count (%d) doesn't match the workspace "
+                      "total event count (%d)" %
+                      (counts.sum(), total_event_count))
+        return None
+
+    return counts
+
+_MONITOR_PROP_RE = re.compile( r'^monitor([0-9]+)_counts$')
+
+def _monitor_counts( context):
+    '''
+    Dict mapping each beam monitor number to its count (from the
+    'monitor<N>_counts' properties)
+    '''
+    counts = {}
+    run = context.ws.run()
+    for prop in run.getProperties():
+        m = _MONITOR_PROP_RE.match( prop.name)
+        if m:
+            counts[int(m.group(1))] = prop.value
+    return counts
+
+register_product( 'run_number', _run_number)
+register_product( 'total_events', _total_events)
+register_product( 'proton_charge_log', _proton_charge_log)
+register_product( 'proton_charge', _proton_charge)
+register_product( 'proton_charge_sum', _proton_charge_sum)
+register_product( 'spectrum_counts', _spectrum_counts)
+register_product( 'monitor_counts', _monitor_counts)
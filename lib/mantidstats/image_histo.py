@@ -0,0 +1,1072 @@
+'''
+Created on Oct 18, 2026
+
+
+Common code for the process variables that accumulate events into a 2D image
+of the detectors (EVTHISTO, DETIMAGE, etc..)
+
+The ImageHisto class handles everything except the actual projection of the
+detector positions onto the image.  Subclasses supply that by overriding
+_compute_coords(), usually by calling one of the projection functions below.
+'''
+
+import re
+import math
+
+import numpy as np
+
+import logging
+
+from pixel_map_cache import instrument_id, geometry_hash, load_pixel_map, \
+                            save_pixel_map
+from pv_config import get_pv_option
+from chunk_context import ChunkContext, register_product
+# -----------------------------------------------------------------------------
+
+# Delta mode.  Instead of publishing the whole image every chunk, an image PV
+# can publish just the elements that changed as a pair of waveforms:
+# <PV>_DELTA_IDX holds indexes into the flattened image and <PV>_DELTA_VAL
+# holds the (absolute, not incremental) values at those indexes.  The full
+# image is still published every FULL_FRAME_EVERY chunks, at run transitions
+# and whenever too many elements changed to fit in the delta waveforms.
+DELTA_SUFFIXES = ('_DELTA_IDX', '_DELTA_VAL')
+DEFAULT_FULL_FRAME_EVERY = 60
+DEFAULT_DELTA_MAX_ELEMENTS = 65536
+
+# Changed whenever the meaning of the pixel map values changes, so that maps
+# cached by older versions aren't used.  (2: out of range pixels map to the
+# discard bin instead of 0,0.)
+_PIXEL_MAP_FORMAT = 2
+
+# The ImageHisto attributes that get_state() & set_state() carry over when a
+# plugin is reloaded (or restored from a checkpoint).  Only the accumulated
+# data:  the settings always come from the current config.
+_STATE_ATTRS = ('_run_num', '_pixel_map', '_output', '_touched',
+                '_chunks_since_full')
+
+
+def split_delta_name( pv_name):
+    '''
+    Splits a PV name like EVTHISTO_DELTA_IDX into ('EVTHISTO', '_DELTA_IDX').
+    Names without a delta suffix come back as (pv_name, None).
+    '''
+    for suffix in DELTA_SUFFIXES:
+        if pv_name.endswith( suffix):
+            return (pv_name[:-len(suffix)], suffix)
+    return (pv_name, None)
+
+
+# Binned images.  An image PV can also be published at reduced resolution, as
+# <PV>_2X2, <PV>_4X4 and <PV>_8X8.  Each element of a binned image is the sum
+# of a 2x2 block of the level above it (so the 4X4 image is built from the
+# 2X2 image, etc..).  An element is -1 only if all the image elements it
+# covers are -1.
+BINNED_FACTORS = (2, 4, 8)
+_BINNED_RE = re.compile( r'^(.*)_([0-9]+)X\2$')
+
+
+def split_binned_name( pv_name):
+    '''
+    Splits a PV name like EVTHISTO_4X4 into ('EVTHISTO', 4).  Names that
+    aren't binned images come back as (pv_name, None).
+    '''
+    m = _BINNED_RE.match( pv_name)
+    if m is None or not int( m.group(2)) in BINNED_FACTORS:
+        return (pv_name, None)
+    return (m.group(1), int( m.group(2)))
+
+
+def binned_shape( width, height, factor):
+    '''
+    Returns the (width, height) of an image binned by factor.  (Partial
+    blocks at the edges still get an element.)
+    '''
+    return ((width + factor - 1) // factor, (height + factor - 1) // factor)
+
+
+def delta_max_elements( pv_name, config):
+    '''
+    Returns the size of the delta waveforms for the specified image PV.
+    (pv_name may be either the image PV or one of its delta PV's.)
+    '''
+    return get_pv_option( config, split_delta_name( pv_name)[0],
+                          'DELTA_MAX_ELEMENTS', DEFAULT_DELTA_MAX_ELEMENTS, int)
+
+
+# Waveform element types for the image PV's (the WAVEFORM_TYPE option).  Maps
+# each type to the waveform's FTVL and the NumPy type of the published array,
+# which is the same as the native type of the FTVL, so ca.put() doesn't have
+# to convert anything.
+#   LONG  - 32 bit counts (the default)
+#   SHORT - 16 bit counts that stop at 32767 instead of wrapping around
+#   FLOAT - 32 bit floats (exact up to 2^24 counts per element)
+#   LOG8 & LOG16 - a display-only encoding of log(1 + counts), scaled so that
+#           LOG_FULL_SCALE counts maps to the largest value (255 or 32767).
+#           Higher counts saturate.  'No detector' elements are 0.
+# USHORT is accepted as another name for SHORT, since Channel Access serves
+# USHORT waveforms as 32 bit LONG's anyway.
+WAVEFORM_TYPES = { 'LONG'  : ('LONG', np.int32),
+                   'SHORT' : ('SHORT', np.int16),
+                   'FLOAT' : ('FLOAT', np.float32),
+                   'LOG8'  : ('UCHAR', np.uint8),
+                   'LOG16' : ('SHORT', np.int16) }
+_WAVEFORM_ALIASES = { 'USHORT' : 'SHORT' }
+DEFAULT_WAVEFORM_TYPE = 'LONG'
+DEFAULT_LOG_FULL_SCALE = 1000000
+
+
+def waveform_type( pv_name, config):
+    '''
+    Returns the WAVEFORM_TYPE for the specified image PV.  (pv_name may also
+    be one of its delta PV's.)
+    '''
+    base_name = split_delta_name( pv_name)[0]
+    wf_type = get_pv_option( config, base_name, 'WAVEFORM_TYPE',
+                             DEFAULT_WAVEFORM_TYPE).upper()
+    wf_type = _WAVEFORM_ALIASES.get( wf_type, wf_type)
+    if not wf_type in WAVEFORM_TYPES:
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.error( "Unknown WAVEFORM_TYPE '%s' for PV %s.  Using %s."%
+                      (wf_type, base_name, DEFAULT_WAVEFORM_TYPE))
+        wf_type = DEFAULT_WAVEFORM_TYPE
+    return wf_type
+
+
+def waveform_ftvl( pv_name, config):
+    '''
+    Returns the FTVL for the waveform record of the specified image PV (or
+    its _DELTA_VAL PV)
+    '''
+    return WAVEFORM_TYPES[waveform_type( pv_name, config)][0]
+
+
+class GeometryError(Exception):
+    '''
+    An exception that is thrown if the instrument geometry doesn't match
+    what we were expecting.
+    '''
+    pass
+
+# -----------------------------------------------------------------------------
+
+# Maps image PV names to the ImageHisto objects that calculate them, so that
+# other plugins can look at the images.  (See find_image().)
+_IMAGES = {}
+
+def find_image( pv_name):
+    '''
+    Returns the ImageHisto object for the image PV, or None if it hasn't
+    been calculated yet (or is running in a worker process).
+    '''
+    return _IMAGES.get( pv_name)
+
+def request_full_frame( pv_name):
+    '''
+    Makes the image PV publish its whole image next chunk, instead of a
+    delta.  Does nothing if the image hasn't been calculated yet.
+    '''
+    image = _IMAGES.get( pv_name)
+    if image is not None:
+        image.request_full_frame()
+
+# The image a rectangular ROI PV is summed from if its section doesn't have
+# an IMAGE option.  (See plugins/roi.py.)
+DEFAULT_RECT_IMAGE = 'EVTHISTO'
+
+def image_companions( image_name, pv_names, config):
+    '''
+    Returns the PV's in pv_names that are calculated from the image PV's
+    ImageHisto object in the main process:  its delta PV's, its binned images
+    and any rectangular ROI's on it.  None of these can work if the image
+    runs in a worker process.
+    '''
+    companions = []
+    for pv_name in pv_names:
+        if pv_name == image_name:
+            continue
+        if split_delta_name( pv_name)[0] == image_name or \
+           split_binned_name( pv_name)[0] == image_name:
+            companions.append( pv_name)
+        elif config is not None and \
+             get_pv_option( config, pv_name, 'RECT') is not None and \
+             get_pv_option( config, pv_name, 'IMAGE',
+                            DEFAULT_RECT_IMAGE) == image_name:
+            companions.append( pv_name)
+    return companions
+
+# -----------------------------------------------------------------------------
+
+def get_detector_positions( ws, check_ids = False):
+    '''
+    Returns an (N,3) NumPy array holding the X, Y & Z coordinates of the
+    detector for each workspace index.
+
+    This is the only place that walks the detectors one at a time.
+    Everything else operates on the array it returns.
+
+    If check_ids is True, log an error for any detector whose ID doesn't
+    match its workspace index.
+    '''
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+    logger.debug( "Collecting detector positions")
+
+    num_spectra = ws.getNumberHistograms()
+    logger.debug( "Num spectra: %d"%num_spectra)
+
+    positions = np.empty( (num_spectra, 3), dtype=np.float64)
+    for ws_index in range( num_spectra):
+        det = ws.getDetector( ws_index)
+        if check_ids and (ws_index != det.getID()):
+            logger.error( "Detector ID / workspace index mismatch: "
+                            "%d != %d"%(ws_index, det.getID()))
+
+        pos = det.getPos()
+        positions[ws_index] = (pos.getX(), pos.getY(), pos.getZ())
+
+    return positions
+
+# Chunk context products needed to initialize an image.  (Having them as
+# products lets an image PV run in a worker process, which has no workspace.
+# See plugin_worker.py.)
+register_product( 'detector_positions',
+                  lambda context: get_detector_positions( context.ws))
+register_product( 'num_spectra',
+                  lambda context: context.ws.getNumberHistograms())
+register_product( 'instrument_id',
+                  lambda context: instrument_id( context.ws.getInstrument()))
+
+# -----------------------------------------------------------------------------
+
+# Projection functions.  Each one takes the array of detector positions (or
+# just the number of spectra, for the raster) and returns a pair of int32
+# arrays holding the X & Y coordinate in the output image for each workspace
+# index.  Coordinates outside the image are left for ImageHisto to deal with.
+#
+# In all cases, 0,0 is the top, left corner of the image.
+
+def _scale( values, min_val, max_val, size, round_coords):
+    '''
+    Maps values in the range max_val..min_val onto 0..size-1
+
+    If round_coords is False, the scaled values are truncated instead of
+    rounded to the nearest integer.
+    '''
+    if max_val == min_val:
+        return np.zeros( len(values), dtype=np.int32)
+    scaled = ((max_val - values) / (max_val - min_val)) * (size - 1)
+    if round_coords:
+        scaled = np.rint( scaled)
+    return scaled.astype(np.int32)
+
+
+def unwrap_angles( alpha):
+    '''
+    Shifts an array of angles (in radians) so that the largest empty gap
+    between them falls on the 2*pi boundary.  That keeps a set of detectors
+    that straddles the +/- pi line from being split across the image.
+    '''
+    if len(alpha) == 0:
+        return alpha
+    s = np.sort( alpha)
+    gaps = np.diff( np.append( s, s[0] + 2*np.pi))
+    start = s[ (gaps.argmax() + 1) % len(s)]
+    return np.mod( alpha - start, 2*np.pi) + start
+
+
+def cylindrical_coords( positions, width, height,
+                        min_alpha = None, max_alpha = None,
+                        min_y = None, max_y = None, round_coords = True):
+    '''
+    'Unrolls' detectors arranged on a cylinder around the Y axis.
+
+    The horizontal coordinate comes from the angle off the Z axis in the X-Z
+    plane (alpha) and the vertical coordinate comes from the Y value.  Any
+    of the min/max values that aren't specified are taken from the data.
+    '''
+    alpha = np.arctan2( positions[:,0], positions[:,2])  # arctan of x/z
+    if min_alpha is None or max_alpha is None:
+        alpha = unwrap_angles( alpha)
+    y = positions[:,1]
+
+    if min_alpha is None: min_alpha = alpha.min()
+    if max_alpha is None: max_alpha = alpha.max()
+    if min_y is None: min_y = y.min()
+    if max_y is None: max_y = y.max()
+
+    return (_scale( alpha, min_alpha, max_alpha, width, round_coords),
+            _scale( y, min_y, max_y, height, round_coords))
+
+
+def flat_coords( positions, width, height, round_coords = True):
+    '''
+    Projects detectors arranged (more or less) on a flat panel onto that
+    panel's plane.
+
+    The plane is the best fit through the detector positions.  Its vertical
+    axis is as close to the lab's Y axis as possible.
+    '''
+    rel = positions - positions.mean( axis=0)
+
+    # Eigenvectors of the covariance matrix, sorted by increasing spread.
+    # The normal to the plane is the direction with the least spread.
+    (_, vecs) = np.linalg.eigh( np.dot( rel.T, rel))
+    normal = vecs[:,0]
+
+    up = np.array( [0.0, 1.0, 0.0]) - normal * normal[1]
+    if np.linalg.norm( up) < 1.0e-6:
+        # The panel is perpendicular to the Y axis.  Just use the direction
+        # with the most spread.
+        up = vecs[:,2]
+    up /= np.linalg.norm( up)
+    across = np.cross( up, normal)
+
+    h = np.dot( rel, across)
+    v = np.dot( rel, up)
+    return (_scale( h, h.min(), h.max(), width, round_coords),
+            _scale( v, v.min(), v.max(), height, round_coords))
+
+
+def raster_coords( num_spectra, row_length, bin_x = 1, bin_y = 1):
+    '''
+    Lays the pixels out by workspace index: each consecutive group of
+    row_length pixels (typically one tube) becomes one column of the image.
+
+    bin_x and bin_y combine that many columns/rows into a single image
+    element.
+    '''
+    ws_index = np.arange( num_spectra, dtype=np.int32)
+    return ((ws_index // row_length) // bin_x,
+            (ws_index % row_length) // bin_y)
+
+
+def raster_size( num_spectra, row_length, bin_x = 1, bin_y = 1):
+    '''
+    Returns the (width, height) of the smallest image that holds all the
+    pixels in the raster projection.  (See raster_coords().)
+    '''
+    num_rows = int( math.ceil( float( num_spectra) / row_length))
+    return (int( math.ceil( float( num_rows) / bin_x)),
+            int( math.ceil( float( min( num_spectra, row_length)) / bin_y)))
+
+
+def guess_projection( positions):
+    '''
+    Returns 'flat', 'cylindrical' or 'raster', depending on which projection
+    best suits the detector positions.
+    '''
+    rel = positions - positions.mean( axis=0)
+    spread = np.linalg.eigvalsh( np.dot( rel.T, rel) / max( len(rel), 1))
+    if spread[0] < 1.0e-4 * spread[2]:
+        return 'flat'
+
+    radius = np.hypot( positions[:,0], positions[:,2])
+    if radius.std() < 0.1 * radius.mean():
+        return 'cylindrical'
+
+    return 'raster'
+
+# -----------------------------------------------------------------------------
+
+class ImageHisto(object):
+    '''
+    Base class for PV's that accumulate event counts into a 2D image.
+
+    Subclasses must override _compute_coords().  They may also override
+    _validate_geometry() and _hash_params().
+    '''
+    # Note: We're operating on the chunkWS, which means we need to keep a
+    # running sum of the events for each pixel in a static variable and add
+    # the events in chunkWS to it.  (And reset all the elements to 0 when the
+    # run # changes.)
+
+    # Each image only touches its own arrays, so it can be calculated
+    # alongside the other PV's.  (The delta PV getters read those arrays, so
+    # they're left unmarked and run after the thread-safe functions.)
+    thread_safe = True
+
+    # The chunk context products the image needs if it's run in a worker
+    # process (see plugin_worker.py): worker_inputs for every chunk and
+    # worker_init_inputs for the first chunk the worker sees.
+    # Note: The delta & binned PV getters (and the rectangular ROI's) can't
+    # see an image that lives in a worker, so main.py won't isolate an image
+    # that has any of them.  (See image_companions().)
+    # The detector positions aren't listed, since they're only needed if
+    # the pixel map isn't cached.  The worker fetches them if it has to.
+    worker_inputs = ('total_events', 'spectrum_counts')
+    worker_init_inputs = ('num_spectra', 'instrument_id')
+
+    def __init__(self, width, height, expect_duplicates = False):
+
+        # The actual dimensions of the array data we'll output
+        self._OUTPUT_ARRAY_WIDTH = width
+        self._OUTPUT_ARRAY_HEIGHT = height
+
+        # If the image is smaller than the detector, several pixels are
+        # expected to land in the same element, so there's no point in
+        # complaining about each of them.
+        self._expect_duplicates = expect_duplicates
+
+        # Need to keep track of the run numbers so we can reset the output
+        # at run transitions
+        self._run_num = -99
+
+        # there isn't too much we can do until we actually have a workspace
+        # to work with, so just set a boolean.  We'll test it down in
+        # __call__() and complete the initialization then.
+        self._is_init = False
+        self._pending_state = None  # from set_state(), until we're initialized
+
+        # maps pixel ID's to their location in the output array.  The array
+        # index is the workspace index and the value is an index into the
+        # flattened output array.  (ie: x * _OUTPUT_ARRAY_HEIGHT + y)
+        # Pixels that fall outside the image map to the discard bin, one
+        # past the end of the output array.  (See _discard_bin().)
+        self._pixel_map = np.zeros( 0, dtype=np.int32)
+
+        # Delta mode settings and state.  (See _init_delta().)
+        self._delta_mode = False
+        self._full_frame_every = DEFAULT_FULL_FRAME_EVERY
+        self._delta_max_elements = DEFAULT_DELTA_MAX_ELEMENTS
+        self._touched = None  # flags the output elements changed since the last publish
+        self._chunks_since_full = 0
+        self._force_full = True
+        self._delta_idx = None
+        self._delta_val = None
+
+        # holds the actual histogram data.  It's int32 because that's the
+        # native type of the waveform records (FTVL=LONG), which lets
+        # ca.put() send the array without converting it.  _init_waveform()
+        # switches it to the type of the PV's WAVEFORM_TYPE.
+        self._output = np.empty((self._OUTPUT_ARRAY_WIDTH,
+                                 self._OUTPUT_ARRAY_HEIGHT), np.int32)
+
+        # Waveform type settings.  (See _init_waveform().)
+        self._waveform_type = DEFAULT_WAVEFORM_TYPE
+        self._saturate = None   # largest count the output can hold, if limited
+        self._log_scale = None  # scale factor for the LOG8 & LOG16 encodings
+        self._encoded = None    # the published array for LOG8 & LOG16
+        self._encode_tmp = None
+
+        # Incremented whenever the output changes, so that the things derived
+        # from it know when they need to be rebuilt
+        self._version = 0
+
+        # Summed-area table of the output (see summed_area_table()).  Only
+        # allocated if somebody asks for it.
+        self._sat = None
+        self._sat_tmp = None
+        self._sat_version = -1
+
+        # The binned images (see binned()).  Maps the binning factor to the
+        # buffers for that level.
+        self._pyramid = {}
+
+        self._reset()
+
+
+    def __call__( self, chunkWS, pv_name, run_num, config = None,
+                  context = None, **kwargs):
+        '''
+        Process the chunk workspace and update the histogram array with
+        any new events
+        '''
+
+        # TODO: main.py defines the LOGGER_NAME variable.  It'd be nice if
+        # that definition could make it down into this module somehow...
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+        if context is None:
+            context = ChunkContext( chunkWS)
+
+        _IMAGES[pv_name] = self
+
+        if not self._is_init:
+            self._finish_init( context, pv_name, config)
+
+        # Zero the entries in the output array when the run number changes
+        if self._run_num != run_num:
+            self._reset()
+            self._run_num = run_num
+
+        # This serves as both a sanity check and (in the case of 0 events)
+        # a means of skipping a bunch of unnecessary work.
+        total_event_count = context.total_events()
+
+        if total_event_count > 0:
+            # Try the vectorized path first.  If the per-spectrum counts
+            # can't be extracted (or don't add up), fall back to looping
+            # over the individual event lists.
+            counts = self._get_spectrum_counts( context)
+            if counts is not None:
+                self._accumulate_counts( counts)
+            elif context.ws is None:
+                # Running in a worker process, so there's no workspace to
+                # loop over
+                logger.error( "No per-spectrum counts for PV %s.  Dropping "
+                              "%d events."%(pv_name, total_event_count))
+            else:
+                logger.debug( "Falling back to the per-spectrum loop")
+                self._accumulate_loop( context.ws, total_event_count)
+        else:
+            logger.debug( "0 events in this chunk workspace")
+
+        self._version += 1
+        return self._publish()
+
+
+    def get_state( self):
+        '''
+        Returns the accumulated image (and the pixel map it was built with)
+        for handing over to a reloaded version of the plugin or saving in a
+        checkpoint.  (See plugin_reload.py & checkpoint.py.)  'key' holds
+        the settings the data depends on, so set_state() can tell whether
+        it still fits.
+        '''
+        if not self._is_init:
+            # Nothing accumulated yet, other than a state that's waiting for
+            # the first chunk
+            return self._pending_state
+
+        state = {}
+        for attr in _STATE_ATTRS:
+            state[attr] = getattr( self, attr)
+        state['key'] = self._state_key()
+        return state
+
+    def set_state( self, state):
+        '''
+        Takes over the accumulated data from a previous version of the
+        plugin (or a checkpoint), unless something that affects the pixel
+        map has changed.  The settings come from the current config, so if
+        the image isn't initialized yet, the state is held until it is.
+        '''
+        if self._is_init:
+            self._restore_state( state)
+        else:
+            self._pending_state = state
+
+    def _state_key( self):
+        '''
+        Returns the values that decide whether a saved state can be restored
+        '''
+        return (type(self).__name__, self._hash_params(), self._output.shape)
+
+    def _restore_state( self, state):
+        '''
+        Copies the accumulated data from state into this (initialized) image.
+        The data is converted if the WAVEFORM_TYPE has changed.  Returns
+        False (and leaves the image alone) if the state doesn't fit.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        if state is None or state.get( 'key') != self._state_key() or \
+           not np.array_equal( state['_pixel_map'], self._pixel_map):
+            logger.info( "Image geometry changed.  Not restoring the "
+                         "accumulated image.")
+            return False
+
+        output = state['_output']
+        if output.dtype != self._output.dtype:
+            logger.info( "Converting the restored image from %s to %s" %
+                         (output.dtype, self._output.dtype))
+            if self._saturate is not None:
+                output = np.clip( output, -1, self._saturate)
+        np.copyto( self._output, output, casting='unsafe')
+
+        self._run_num = state['_run_num']
+        self._chunks_since_full = state['_chunks_since_full']
+        touched = state['_touched']
+        if self._touched is not None and touched is not None and \
+           touched.shape == self._touched.shape:
+            self._touched[:] = touched
+
+        # Delta clients should resync with the restored image
+        self._force_full = True
+        self._encoded = None
+        self._version += 1
+        return True
+
+
+    def request_full_frame( self):
+        '''
+        Publish the whole image next chunk, even in delta mode.  (Used when a
+        delta couldn't be published.)
+        '''
+        self._force_full = True
+
+
+    def summed_area_table( self):
+        '''
+        Returns the summed-area table of the image:  a (WIDTH+1, HEIGHT+1)
+        int64 array where element [x, y] is the total of all the image
+        elements [0:x, 0:y].  (The 'no detector' elements count as 0.)
+
+        It's rebuilt (once) after each chunk, the first time it's asked for.
+        '''
+        if self._sat is None:
+            self._sat = np.zeros( (self._OUTPUT_ARRAY_WIDTH + 1,
+                                   self._OUTPUT_ARRAY_HEIGHT + 1), np.int64)
+            self._sat_tmp = np.empty( self._output.shape, np.int32)
+
+        if self._sat_version != self._version:
+            np.maximum( self._output, 0, out=self._sat_tmp, casting='unsafe')
+            inner = self._sat[1:, 1:]
+            np.cumsum( self._sat_tmp, axis=0, dtype=np.int64, out=inner)
+            np.cumsum( inner, axis=1, out=inner)
+            self._sat_version = self._version
+        return self._sat
+
+    def rect_sum( self, x0, y0, x1, y1):
+        '''
+        Returns the total of the image elements in the rectangle from x0,y0
+        to x1,y1 (inclusive) in O(1) time.  The rectangle is clipped to the
+        image.
+        '''
+        x0 = max( x0, 0)
+        y0 = max( y0, 0)
+        x1 = min( x1, self._OUTPUT_ARRAY_WIDTH - 1)
+        y1 = min( y1, self._OUTPUT_ARRAY_HEIGHT - 1)
+        if x1 < x0 or y1 < y0:
+            return 0
+
+        sat = self.summed_area_table()
+        return int( sat[x1 + 1, y1 + 1] - sat[x0, y1 + 1] -
+                    sat[x1 + 1, y0] + sat[x0, y0])
+
+
+    def binned( self, factor):
+        '''
+        Returns the image binned by factor (1 or one of BINNED_FACTORS) as a
+        2D int32 array.  Levels are built from the level above, at most once
+        per chunk, in buffers that are allocated the first time.
+        '''
+        if factor == 1:
+            return self._output
+
+        src = self.binned( factor // 2)
+        if not factor in self._pyramid:
+            (w, h) = src.shape
+            (w2, h2) = binned_shape( w, h, 2)
+            # The padding at the edges (for odd sizes) is never written, so
+            # it stays 0 / not valid
+            self._pyramid[factor] = {
+                'counts'  : np.zeros( (w2 * 2, h2 * 2), np.int32),
+                'valid'   : np.zeros( (w2 * 2, h2 * 2), bool),
+                'output'  : np.empty( (w2, h2), np.int32),
+                'masked'  : np.empty( (w2, h2), bool),
+                'version' : -1 }
+        level = self._pyramid[factor]
+
+        if level['version'] != self._version:
+            (w, h) = src.shape
+            (w2, h2) = level['output'].shape
+            np.maximum( src, 0, out=level['counts'][:w, :h], casting='unsafe')
+            np.greater_equal( src, 0, out=level['valid'][:w, :h])
+
+            # Each element is the sum of a 2x2 block of the level above
+            level['counts'].reshape( w2, 2, h2, 2).sum( axis=(1, 3),
+                                                        out=level['output'])
+            level['valid'].reshape( w2, 2, h2, 2).any( axis=(1, 3),
+                                                       out=level['masked'])
+            np.logical_not( level['masked'], out=level['masked'])
+            np.copyto( level['output'], -1, where=level['masked'])
+            level['version'] = self._version
+        return level['output']
+
+    def get_binned( self, pv_name, **kwargs):
+        '''
+        Returns the value for one of the binned image PV's (<PV>_2X2, etc..)
+
+        Like the delta PV's, these are built from the image, so the image PV
+        must also be in the PROCESS_VARIABLES list (and should come first).
+        '''
+        factor = split_binned_name( pv_name)[1]
+        if factor is None:
+            return None
+        return self.binned( factor).ravel()
+
+
+    def get_delta( self, pv_name, **kwargs):
+        '''
+        Returns the value for one of the delta PV's (<PV>_DELTA_IDX or
+        <PV>_DELTA_VAL), or None if there's nothing new to publish.
+
+        The deltas are computed when the image PV itself is calculated, so
+        the image PV must also be in the PROCESS_VARIABLES list (and should
+        come before the delta PV's).
+        '''
+        suffix = split_delta_name( pv_name)[1]
+        if suffix == '_DELTA_IDX':
+            return self._delta_idx
+        elif suffix == '_DELTA_VAL':
+            return self._delta_val
+        return None
+
+
+    def _init_waveform( self, pv_name, config):
+        '''
+        Reads the WAVEFORM_TYPE option from the PV's config section and
+        switches the output array to the matching type
+        '''
+        self._waveform_type = waveform_type( pv_name, config)
+        dtype = WAVEFORM_TYPES[self._waveform_type][1]
+        self._saturate = None
+        self._log_scale = None
+        self._encoded = None
+
+        if self._waveform_type in ('LOG8', 'LOG16'):
+            # The encoding is only for display, so the counts themselves
+            # are still accumulated as int32
+            full_scale = get_pv_option( config, pv_name, 'LOG_FULL_SCALE',
+                                        DEFAULT_LOG_FULL_SCALE, float)
+            self._log_scale = np.iinfo( dtype).max / \
+                              math.log1p( max( full_scale, 1.0))
+            dtype = np.int32
+        elif self._waveform_type == 'SHORT':
+            self._saturate = int( np.iinfo( dtype).max)
+
+        if self._output.dtype != dtype:
+            self._output = np.empty( self._output.shape, dtype)
+
+        if self._waveform_type != DEFAULT_WAVEFORM_TYPE:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.info( "PV %s uses waveform type %s"%
+                         (pv_name, self._waveform_type))
+
+
+    def _init_delta( self, pv_name, config):
+        '''
+        Reads the delta mode options from the PV's config section
+        '''
+        self._delta_mode = get_pv_option( config, pv_name, 'DELTA_MODE',
+                                          False, bool)
+        if not self._delta_mode:
+            return
+
+        self._full_frame_every = get_pv_option( config, pv_name,
+                                                'FULL_FRAME_EVERY',
+                                                DEFAULT_FULL_FRAME_EVERY, int)
+        self._delta_max_elements = delta_max_elements( pv_name, config)
+        self._touched = np.zeros( self._output.size, dtype=bool)
+        self._force_full = True
+
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.info( "Delta mode enabled for PV %s.  Full frame every %d "
+                     "chunks." % (pv_name, self._full_frame_every))
+
+
+    def _publish( self):
+        '''
+        Returns the value to publish for the image PV.  In delta mode, this
+        also computes the values for the delta PV's.
+
+        Returns None when the full image shouldn't be published this time.
+        '''
+        self._delta_idx = None
+        self._delta_val = None
+
+        if self._delta_mode:
+            self._chunks_since_full += 1
+            changed = np.flatnonzero( self._touched)
+            self._touched[changed] = False
+
+            if not self._force_full and \
+               self._chunks_since_full < self._full_frame_every and \
+               len(changed) <= self._delta_max_elements:
+                if len(changed):
+                    self._delta_idx = changed.astype(np.int32)
+                    self._delta_val = self._output.flat[changed]
+                    if self._log_scale is not None:
+                        self._delta_val = self._encode( self._delta_val,
+                            np.empty( len(changed), self._encoded_dtype()),
+                            np.empty( len(changed), np.float32))
+                return None
+
+            self._force_full = False
+            self._chunks_since_full = 0
+
+        if self._log_scale is not None:
+            if self._encoded is None:
+                self._encoded = np.empty( self._output.size,
+                                          self._encoded_dtype())
+                self._encode_tmp = np.empty( self._output.size, np.float32)
+            return self._encode( self._output.ravel(), self._encoded,
+                                 self._encode_tmp)
+
+        # ravel() returns a 1D view of the (contiguous) array, so nothing is
+        # copied here.  Since its dtype matches the waveform's native type,
+        # ca.put() hands the buffer straight to Channel Access.
+        return self._output.ravel()
+
+    def _encoded_dtype( self):
+        return WAVEFORM_TYPES[self._waveform_type][1]
+
+    def _encode( self, counts, out, tmp):
+        '''
+        Writes the LOG8/LOG16 encoding of counts into out and returns it.
+        tmp is a float32 scratch array the same size as counts.
+        '''
+        np.maximum( counts, 0, out=tmp, casting='unsafe')
+        np.log1p( tmp, out=tmp)
+        tmp *= self._log_scale
+        np.minimum( tmp, np.iinfo( out.dtype).max, out=tmp)
+        np.rint( tmp, out=tmp)
+        np.copyto( out, tmp, casting='unsafe')
+        return out
+
+
+    def _get_spectrum_counts( self, context):
+        '''
+        Returns a NumPy array holding the number of events in each spectrum
+        of the chunk workspace (indexed by workspace index), or None if the
+        counts couldn't be extracted in bulk.
+
+        The counts come from the chunk context, so they're only extracted
+        once per chunk no matter how many image PV's are being calculated.
+        '''
+        counts = context.spectrum_counts()
+        if counts is None:
+            return None
+
+        if len(counts) != len(self._pixel_map):
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( "Spectrum count (%d) doesn't match the pixel map "
+                          "size (%d)!" % (len(counts), len(self._pixel_map)))
+            return None
+
+        return counts
+
+    def _accumulate_counts( self, counts):
+        '''
+        Add an array of per-spectrum event counts to the output array.
+
+        Uses the pixel map computed in _finish_init() so that the whole
+        chunk is scattered into the output with one bincount() call.
+        '''
+        hits = np.bincount( self._pixel_map, weights=counts,
+                            minlength=self._discard_bin() + 1)
+        hits = hits[:self._discard_bin()]
+        if self._delta_mode:
+            # Only the elements that got events in this chunk (hits is
+            # turned into the running totals below)
+            self._touched |= (hits > 0)
+        if self._saturate is None:
+            self._output += hits.astype(self._output.dtype).reshape(self._output.shape)
+        else:
+            # Add in floating point and clip, rather than let a narrow type
+            # wrap around
+            hits += self._output.ravel()
+            np.minimum( hits, self._saturate, out=hits)
+            np.copyto( self._output.ravel(), hits, casting='unsafe')
+
+    def _accumulate_loop( self, chunkWS, total_event_count):
+        '''
+        Add the events in the chunk workspace to the output array one
+        spectrum at a time.
+
+        This is the original (slow) method.  It's only used when
+        _get_spectrum_counts() can't provide the counts.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        running_event_count = 0
+
+        # loop through all the spectra in the workspace
+        num_spectra = chunkWS.getNumberHistograms()
+        for i in range(num_spectra):
+            num_events = chunkWS.getEventList(i).getNumberEvents()
+            if num_events > 0:
+                try:
+                    index = self._pixel_map[i]
+                    running_event_count += num_events
+                    if index == self._discard_bin():
+                        continue
+                    value = self._output.flat[index] + num_events
+                    if self._saturate is not None:
+                        value = min( value, self._saturate)
+                    self._output.flat[index] = value
+                    if self._delta_mode:
+                        self._touched[index] = True
+                except IndexError:
+                    logger.error( "Spectrum #%d wasn't in the pixel map!"%i)
+
+        # end of for loop
+        if running_event_count != total_event_count:
+            logger.error( "Running event count (%d) doesn't match the "
+                          "workspace total event count (%d)!" %
+                          (running_event_count, total_event_count))
+
+    def _finish_init( self, context, pv_name, config):
+        '''
+        Complete all the initialization steps that had to be deferred until
+        we had an actual workspace.
+
+        If the config specifies a PIXEL_MAP_CACHE_DIR, the detector map is
+        loaded from (or saved to) a file in that directory.  The detector
+        positions are only collected (and validated) if there's no cached
+        map, since that means walking every detector.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.debug( "Inside _finish_init()")
+
+        num_spectra = context.product( 'num_spectra')
+        self._init_projection(num_spectra, pv_name, config)
+        self._init_waveform(pv_name, config)
+        self._init_delta(pv_name, config)
+
+        cache_dir = None
+        if config is not None and \
+           config.has_option("System Config", "PIXEL_MAP_CACHE_DIR"):
+            cache_dir = config.get("System Config", "PIXEL_MAP_CACHE_DIR")
+
+        pixel_map = None
+        if cache_dir:
+            # Anything that changes the map needs to be part of the hash
+            geom_hash = geometry_hash( context.product( 'instrument_id'),
+                                       num_spectra, _PIXEL_MAP_FORMAT,
+                                       self._OUTPUT_ARRAY_WIDTH,
+                                       self._OUTPUT_ARRAY_HEIGHT,
+                                       *self._hash_params())
+            pixel_map = load_pixel_map( cache_dir, pv_name, geom_hash,
+                                        num_spectra)
+
+        if pixel_map is None:
+            # A cached map was validated before it was saved, so this is the
+            # only place the geometry needs checking
+            positions = self._get_detector_positions(context)
+            self._validate_geometry(positions)
+            pixel_map = self._compute_pixel_map( positions)
+            if cache_dir:
+                save_pixel_map( cache_dir, pv_name, geom_hash, pixel_map)
+
+        self._pixel_map = pixel_map
+        self._reset() # set the initial value for the output array
+        self._is_init = True
+
+        # Now that the settings are known, restore any state handed to
+        # set_state() before the first chunk
+        if self._pending_state is not None:
+            self._restore_state( self._pending_state)
+            self._pending_state = None
+
+
+    def _get_detector_positions( self, context):
+        '''
+        Returns the (N,3) array of detector positions for the workspace.
+        (See get_detector_positions().)
+        '''
+        return context.product( 'detector_positions')
+
+    def _validate_geometry( self, positions):
+        '''
+        Verify the instrument geometry is what the subclass expects.  Should
+        throw a GeometryError if it's not.
+
+        The default implementation accepts anything.
+        '''
+        pass
+
+    def _init_projection( self, num_spectra, pv_name, config):
+        '''
+        Called once the number of spectra is known, but before the pixel map
+        is loaded or built.  (The detector positions aren't known yet.  A
+        subclass that picks its projection based on the geometry has to wait
+        for _compute_coords().)
+
+        The default implementation does nothing.
+        '''
+        pass
+
+    def _hash_params( self):
+        '''
+        Returns a tuple of any values (other than the output size) that
+        _compute_coords() depends on.  They become part of the pixel map's
+        cache key.
+        '''
+        return ()
+
+    def _compute_coords( self, positions):
+        '''
+        Returns a pair of int32 arrays holding the output X & Y coordinates
+        for each workspace index.
+        '''
+        raise NotImplementedError( "ImageHisto subclasses must override "
+                                   "_compute_coords()")
+
+    def _compute_pixel_map( self, positions):
+        '''
+        Returns the int32 array that maps workspace indexes to indexes in
+        the flattened output array.
+
+        positions is the (N,3) array returned by _get_detector_positions()
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+        logger.debug( "Creating detector ID to output coordinate map")
+        (all_outX, all_outY) = self._compute_coords( positions)
+        all_outX = np.asarray( all_outX, dtype=np.int32)
+        all_outY = np.asarray( all_outY, dtype=np.int32)
+
+        # Flatten the <x,y> coordinates into indexes into self._output so
+        # that __call__() can scatter a whole chunk's worth of counts at once.
+        pixel_map = all_outX * self._OUTPUT_ARRAY_HEIGHT + all_outY
+
+        logger.debug( "Checking for invalid coordinates in detector ID to output coordinate map")
+        invalid = (all_outX < 0) | (all_outX >= self._OUTPUT_ARRAY_WIDTH) | \
+                  (all_outY < 0) | (all_outY >= self._OUTPUT_ARRAY_HEIGHT)
+        num_invalid = np.count_nonzero( invalid)
+        if num_invalid:
+            # One line for all of them.  There could be thousands.
+            logger.error( "%d of %d pixels map outside the %dx%d output "
+                          "array (e.g. pixel ID %d at %d,%d).  Their events "
+                          "will be discarded." %
+                          (num_invalid, len(pixel_map),
+                           self._OUTPUT_ARRAY_WIDTH,
+                           self._OUTPUT_ARRAY_HEIGHT,
+                           np.flatnonzero( invalid)[0],
+                           all_outX[invalid][0], all_outY[invalid][0]))
+            pixel_map[invalid] = self._discard_bin()
+        logger.debug("Invalid mapping checks complete.")
+
+        # Now, check for cases where 2 pixels map to the same output location...
+        logger.debug( "Checking for duplicates in detector ID to output coordinate map")
+        hits = np.bincount( pixel_map, minlength=self._discard_bin() + 1)
+        hits = hits[:self._discard_bin()]
+        duplicates = np.flatnonzero( hits > 1)
+        if self._expect_duplicates:
+            logger.debug( "%d output locations have more than one pixel"%
+                          len(duplicates))
+        else:
+            for n in duplicates:
+                logger.error( "Duplicate mapping into output array at %d,%d"%
+                              divmod( n, self._OUTPUT_ARRAY_HEIGHT))
+                #TODO: What do we do in this case?
+        logger.debug("Duplicate checks complete.")
+
+        return pixel_map
+
+    def _discard_bin( self):
+        '''
+        Returns the pixel map value for pixels that aren't in the image
+        '''
+        return self._output.size
+
+
+    def _reset( self):
+        '''
+        Reset the histogram array.
+
+        Note: -1 means 'no detector here' and 0 means 'no events for
+        this detector'
+        '''
+        self._output.fill(-1)
+
+        # Every location that actually has a detector is set to 0
+        mapped = self._pixel_map[self._pixel_map != self._discard_bin()]
+        self._output.flat[mapped] = 0
+        self._version += 1
+
+        # Clients in delta mode need a fresh full frame to start from
+        self._force_full = True
+        if self._touched is not None:
+            self._touched.fill(False)
+
+# End of class ImageHisto
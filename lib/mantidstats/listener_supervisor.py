@@ -0,0 +1,251 @@
+'''
+Created on Oct 18, 2026
+
+
+Starts the Mantid live listener and restarts it if it stops.
+
+StartLiveData runs the MonitorLiveData algorithm in the background.  If the
+listener crashes (lost connection to the SMS daemon, an exception in one of
+the processing algorithms, etc..), MonitorLiveData ends and has to be started
+again.  The ListenerSupervisor takes care of that:
+
+- Starting the listener has a time limit (LISTENER_START_TIMEOUT).  A
+  listener that never gets going counts as a failed start instead of
+  hanging the program.
+- Where Mantid supports it, an AlgorithmObserver tells us the moment
+  MonitorLiveData finishes or fails.  Otherwise (and as a backstop) the
+  algorithm is polled every LISTENER_POLL_INTERVAL seconds.
+- Failed starts, and listeners that stop again soon after starting, are
+  retried with exponential backoff (LISTENER_BACKOFF_MIN doubling up to
+  LISTENER_BACKOFF_MAX seconds) so that a persistent problem doesn't turn
+  into a tight restart loop.
+
+Only the Mantid algorithms are restarted.  The PV calc functions (and their
+accumulated state), the worker processes and the publisher are all left
+alone, so the first chunk after a restart picks up where the last one left
+off.
+
+If LISTENER_PVS is set, the number of restarts and the time the most recent
+restart took (from the listener stopping to the new one running) are also
+published as LISTENER_RESTARTS and LISTENER_RESTART_MS.
+'''
+
+import time
+import threading
+import logging
+
+from softioc_files import writeStandardAORecord
+
+RESTARTS_PV = 'LISTENER_RESTARTS'
+RESTART_MS_PV = 'LISTENER_RESTART_MS'
+PV_NAMES = (RESTARTS_PV, RESTART_MS_PV)
+
+DEFAULT_START_TIMEOUT = 60.0
+DEFAULT_POLL_INTERVAL = 0.1
+DEFAULT_BACKOFF_MIN = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+try:
+    from mantid.api import AlgorithmObserver
+
+    class _StopObserver(AlgorithmObserver):
+        '''
+        Sets an event when the observed algorithm finishes or fails
+        '''
+        def __init__(self, event):
+            AlgorithmObserver.__init__( self)
+            self._event = event
+
+        def finishHandle( self):
+            self._event.set()
+
+        def errorHandle( self, message):
+            self._event.set()
+
+except ImportError:
+    # Older versions of Mantid (or no Mantid at all).  Polling still works.
+    _StopObserver = None
+
+
+def generateDbRecord( pv_name):
+    '''
+    Returns the database record for one of the listener PV's
+    '''
+    return writeStandardAORecord( pv_name)
+
+
+class ListenerStartError(RuntimeError):
+    '''
+    Thrown when the live listener doesn't start within the time limit
+    '''
+    pass
+
+
+class ListenerSupervisor(object):
+    '''
+    Keeps the MonitorLiveData algorithm running.
+
+    start_func is called (with no arguments) to start the listener.  It
+    returns the MonitorLiveData algorithm.
+    '''
+
+    def __init__(self, start_func, start_timeout = DEFAULT_START_TIMEOUT,
+                 poll_interval = DEFAULT_POLL_INTERVAL,
+                 backoff_min = DEFAULT_BACKOFF_MIN,
+                 backoff_max = DEFAULT_BACKOFF_MAX):
+        self._start_func = start_func
+        self._start_timeout = start_timeout
+        self._poll_interval = poll_interval
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+
+        self._alg = None          # the running MonitorLiveData algorithm
+        self._stopped = threading.Event()  # set by the observer
+        self._observer = None
+
+        self._start_time = 0.0    # when the current listener started
+        self._stop_time = None    # when we noticed the listener had stopped
+        self._failures = 0        # consecutive failed (or short-lived) starts
+        self._next_attempt = 0.0  # earliest time for the next restart
+
+        self.restarts = 0
+        self.last_restart_latency = 0.0  # seconds
+
+    def start( self):
+        '''
+        Start the listener for the first time.  Throws RuntimeError (or
+        ListenerStartError) if it can't be started.
+        '''
+        self._start()
+
+    def wait( self, timeout):
+        '''
+        Waits up to timeout seconds for the listener to need restarting.
+        Returns True as soon as it has stopped and any backoff delay is over.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            if self._needs_start( now):
+                return True
+            if now >= deadline:
+                return False
+
+            delay = min( deadline - now, self._poll_interval)
+            if self._alg is not None:
+                # Wakes up early if the observer sees the algorithm end
+                self._stopped.wait( delay)
+            else:
+                time.sleep( delay)
+
+    def restart( self):
+        '''
+        Try to start a new listener.  Returns True if it's running.  If it
+        isn't, the next attempt is put off.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.error( "Restarting the live listener algorithm (which " +
+                      "implies that the algorithm crashed somehow).")
+        try:
+            self._start()
+        except RuntimeError, e:
+            self._failures += 1
+            self._next_attempt = time.time() + self._backoff_delay()
+            logger.error( "Couldn't restart the live listener: %s"%e)
+            logger.error( "Trying again in %.1f seconds"%
+                          (self._next_attempt - time.time()))
+            return False
+
+        self.restarts += 1
+        self.last_restart_latency = self._start_time - self._stop_time
+        logger.info( "Live listener restarted %.3f seconds after it "
+                     "stopped (restart #%d)"%(self.last_restart_latency,
+                                              self.restarts))
+        return True
+
+    def stop( self):
+        '''
+        Cancel the listener and wait (up to the start timeout) for it to end
+        '''
+        alg = self._alg
+        self._alg = None
+        if alg is None or not alg.isRunning():
+            return
+
+        alg.cancel()
+        deadline = time.time() + self._start_timeout
+        while alg.isRunning():
+            if time.time() > deadline:
+                logger = logging.getLogger( "MantidStats::%s"% __name__)
+                logger.error( "MonitorLiveData didn't stop after %.1f "
+                              "seconds"%self._start_timeout)
+                break
+            self._stopped.wait( self._poll_interval)
+
+    def _start( self):
+        '''
+        Start the listener and wait for MonitorLiveData to be running
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        self._stopped.clear()
+        alg = self._start_func()
+
+        deadline = time.time() + self._start_timeout
+        if not alg.isRunning():
+            logger.debug( "Waiting for MonitorLiveData algorithm to start")
+        while not alg.isRunning():
+            if time.time() > deadline:
+                try:
+                    alg.cancel()
+                except RuntimeError:
+                    pass
+                raise ListenerStartError( "MonitorLiveData didn't start "
+                                          "within %.1f seconds"%
+                                          self._start_timeout)
+            time.sleep( self._poll_interval)
+
+        if _StopObserver is not None:
+            self._observer = _StopObserver( self._stopped)
+            self._observer.observeFinish( alg)
+            self._observer.observeError( alg)
+
+        self._alg = alg
+        self._start_time = time.time()
+        logger.debug( "MonitorLiveData algorithm now running")
+
+    def _needs_start( self, now):
+        '''
+        Returns True if the listener isn't running and it's time to try
+        starting it again
+        '''
+        if self._alg is not None:
+            if not self._stopped.is_set() and self._alg.isRunning():
+                return False
+            self._listener_stopped( now)
+        return now >= self._next_attempt
+
+    def _listener_stopped( self, now):
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        run_time = now - self._start_time
+        logger.error( "The live listener stopped after running for %.1f "
+                      "seconds"%run_time)
+
+        # A listener that dies right after it starts probably has the same
+        # problem as the last one, so back off
+        if run_time < self._backoff_max:
+            self._failures += 1
+        else:
+            self._failures = 0
+        self._next_attempt = now + self._backoff_delay()
+
+        self._alg = None
+        self._observer = None
+        self._stop_time = now
+
+    def _backoff_delay( self):
+        if self._failures == 0:
+            return 0.0
+        return min( self._backoff_max,
+                    self._backoff_min * 2 ** (self._failures - 1))
+
+# End of class ListenerSupervisor
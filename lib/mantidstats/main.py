@@ -9,9 +9,10 @@ Created on Jan 30, 2014
 TODO List:
 - Figure out how best to store individual PV calc callables (or classes) - probably separate .py files in a package?
 - Document the keyword params that will be passed to the callables
-- There is a perceptible amount of time between the ChunkProcessing and PostProcessing algorithms.  Specifically, it
-  was not uncommon for the EVTCNT and EVTCNT_POST to differ when polled with caget.  Need to discuss this with some
-  of the instrument scientists and determine if that could cause problems.
+- There is a perceptible amount of time between the ChunkProcessing and PostProcessing algorithms.  It used to be
+  common for EVTCNT and EVTCNT_POST to differ when polled with caget.  When the PostProcessing algorithm is in use,
+  the values computed by ChunkProcessing are now held back and published together with the post processing values
+  (in a single CA synchronous group), so the two should always agree.
 - Figure out a way to specify the mantid library location in the config file (the sys.path.append() and import
   statements are normally executed well before the config file is parsed...)
 - Add code to handle improper regex strings in plugin definitions
@@ -40,6 +41,9 @@ import ConfigParser
 
 import logging
 import logging.handlers
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 # Try to figure out where Mantid is installed and set sys.path accordingly
 if os.environ.has_key('MANTIDPATH'):
@@ -66,9 +70,22 @@ Mantid has been installed.
     print "Aborting."
     sys.exit(1)
 
-from epics import PV
-
 from softioc_files import generateCmdFile
+from publisher import Publisher
+from output_backends import CABackend, create_backend
+from chunk_context import ChunkContext
+from plugin_worker import PluginWorker
+from plugin_reload import PluginWatcher, load_plugin, hand_over_state
+from checkpoint import Checkpointer
+from listener_supervisor import ListenerSupervisor
+from listener_supervisor import PV_NAMES as LISTENER_PV_NAMES
+from listener_supervisor import RESTARTS_PV, RESTART_MS_PV
+from listener_supervisor import generateDbRecord as generateListenerDbRecord
+from timing import Timings, CALC, KINDS, timing_pv_name
+from timing import generateDbRecord as generateTimingDbRecord
+from pv_config import get_option, get_pv_option
+from image_histo import image_companions, split_delta_name, DELTA_SUFFIXES, \
+                        delta_max_elements, request_full_frame
 
 # -------------------------------------------------------------------------
 # Commented out for now because pcaspy package doesn't play nice with
@@ -95,6 +112,59 @@ PV_Functions_Post = {}
 PV_Objs = {}
 PROCESS_VARIABLES = []
 
+# The parsed config file.  It's passed along to the PV calc functions so that
+# plugins can read their own options.
+CONFIG = ConfigParser.ConfigParser()
+
+# Records how long each PV's calc function and put take.  (See init_timing().)
+TIMINGS = Timings()
+
+# (PV name, kind) pairs for the timing PV's we're publishing.  Empty unless
+# TIMING_PVS is set in the config file.
+TIMING_PVS = []
+
+# Takes the values computed by the Algorithm objects and puts them to the
+# PV objects.  (See init_publisher().)  init_output() replaces the backend
+# if the config file asks for a different one.
+PUBLISHER = Publisher( CABackend( PV_Objs), TIMINGS)
+
+# Runs the PV functions that are marked thread-safe.  None unless CALC_THREADS
+# is set in the config file.  (See init_calc_pool().)
+CALC_POOL = None
+
+# Maps PV names to the PluginWorker objects for the PV's whose calc functions
+# run in their own processes.  (See init_workers().)
+WORKERS = {}
+
+# Maps plugin module names to the (compiled) chunk & post regex dicts that
+# their register_pvs() functions returned.  Kept so that a single module can
+# be reloaded.  (See reload_plugins().)
+PLUGIN_MODULES = {}
+
+# Watches the plugin dirs for changes.  None unless PLUGIN_RELOAD_INTERVAL is
+# set in the config file.
+PLUGIN_WATCHER = None
+
+# New (chunk, post) function dicts from reload_plugins(), waiting for
+# ChunkProcessing to swap them in.  Protected by PENDING_FUNCTIONS_LOCK.
+PENDING_FUNCTIONS = None
+PENDING_FUNCTIONS_LOCK = threading.Lock()
+
+# Writes the accumulated plugin state to disk.  None unless CHECKPOINT_DIR is
+# set in the config file.  (See init_checkpoints().)
+CHECKPOINTER = None
+CHECKPOINT_INTERVAL = 60.0  # seconds
+LAST_CHECKPOINT = 0.0       # time of the last checkpoint
+CHECKPOINT_RUN_NUM = 0      # run number of the most recent chunk
+# Cleared once the first chunk has had its chance to restore a checkpoint
+CHECKPOINT_RESTORE_PENDING = True
+
+# Starts the live listener and restarts it if it stops.  (See
+# init_supervisor().)
+SUPERVISOR = None
+# True if the listener restart PV's are being published
+LISTENER_PVS = False
+
 # Another global: The name of the logger object.  Using a global so that all
 # the different functions can log to the same location. (And also the two
 # Algorithm objects can also use it.)
@@ -103,6 +173,19 @@ PROCESS_VARIABLES = []
 LOGGER_NAME="MantidStats"
 
 
+def init_output():
+    '''
+    Select the output backend named by OUTPUT_BACKEND in the config file.
+    (See output_backends.py.)  Must be called before any PV's are added.
+    '''
+    PUBLISHER.backend = create_backend( CONFIG, PV_Objs)
+
+def add_output_pv( pv_prefix, name):
+    '''
+    Tell the output backend about a PV.  (For CA, this creates its PV object.)
+    '''
+    PUBLISHER.backend.add_pv( name, pv_prefix + name)
+
 def init_PV_objs( pv_prefix):
     '''
     Create PV objects for each variable in PROCESS_VARIABLES
@@ -110,7 +193,343 @@ def init_PV_objs( pv_prefix):
     
     #logger = logging.getLogger(LOGGER_NAME)
     for name in PROCESS_VARIABLES:
-        PV_Objs[name] = PV( pv_prefix + name)
+        add_output_pv( pv_prefix, name)
+
+def init_publisher():
+    '''
+    Set the per-PV publish rates and, if the config file asks for it, start
+    the publisher thread.
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    for name in PROCESS_VARIABLES:
+        PUBLISHER.set_rate( name, get_pv_option( CONFIG, name, "PUBLISH_RATE",
+                                                 0.0, float))
+        
+        # Deltas that pile up are merged, up to the size of the waveforms
+        (base_name, suffix) = split_delta_name( name)
+        if suffix == DELTA_SUFFIXES[0]:
+            PUBLISHER.set_delta_limit( base_name,
+                                       delta_max_elements( name, CONFIG),
+                                       partial( request_full_frame, base_name))
+    
+    if get_option( CONFIG, "System Config", "ASYNC_PUBLISH", False, bool):
+        logger.info( "Publishing PV values from a separate thread")
+        PUBLISHER.start()
+
+def init_timing( pv_prefix):
+    '''
+    Set how often the timing summary is reported and, if requested, create
+    the PV objects for the <PV>_CALC_MS & <PV>_PUT_MS timing PV's.
+    '''
+    TIMINGS.set_report_interval( get_option( CONFIG, "System Config",
+                                             "TIMING_REPORT_INTERVAL",
+                                             60.0, float))
+    
+    if get_option( CONFIG, "System Config", "TIMING_PVS", False, bool):
+        for name in PROCESS_VARIABLES:
+            for kind in KINDS:
+                timing_name = timing_pv_name( name, kind)
+                TIMING_PVS.append( (name, kind))
+                add_output_pv( pv_prefix, timing_name)
+
+def report_timings():
+    '''
+    If it's time, log the timing summary and post the timing PV's.  Called
+    just before the publisher is flushed.
+    '''
+    if not TIMINGS.report_due():
+        return
+    
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.info( TIMINGS.summary( PROCESS_VARIABLES))
+    for (name, kind) in TIMING_PVS:
+        PUBLISHER.post( timing_pv_name( name, kind), TIMINGS.stats( kind, name))
+    
+def init_calc_pool():
+    '''
+    If CALC_THREADS is set in the config file, create the thread pool that
+    runs the thread-safe PV calc functions.
+    '''
+    global CALC_POOL
+    num_threads = get_option( CONFIG, "System Config", "CALC_THREADS", 0, int)
+    if num_threads > 0:
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.info( "Running thread-safe PV functions on %d threads"%num_threads)
+        CALC_POOL = ThreadPool( num_threads)
+
+def init_workers():
+    '''
+    Start a worker process for each PV with ISOLATE set in its config
+    section.  (See plugin_worker.py.)
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    shm_size = get_option( CONFIG, "System Config", "WORKER_SHM_SIZE",
+                           64, int) * 1024 * 1024
+    timeout = get_option( CONFIG, "System Config", "WORKER_TIMEOUT",
+                          30.0, float)
+    spares = get_option( CONFIG, "System Config", "WORKER_SPARES", 1, int)
+    
+    for name in PROCESS_VARIABLES:
+        if not get_pv_option( CONFIG, name, "ISOLATE", False, bool):
+            continue
+        
+        func = PV_Functions_Chunk.get( name, PV_Functions_Post.get( name))
+        if func is None:
+            continue
+        if not hasattr( func, 'worker_inputs'):
+            logger.error( "The calc function for PV %s doesn't support "
+                          "running in a worker process.  Running it in the "
+                          "main process instead."%name)
+            continue
+        # The PV's that read an image in the main process would never see
+        # it change if the image ran in a worker
+        companions = image_companions( name, PROCESS_VARIABLES, CONFIG)
+        if get_pv_option( CONFIG, name, "DELTA_MODE", False, bool):
+            companions.append( "DELTA_MODE")
+        if companions:
+            logger.error( "PV %s can't run in a worker process.  These need "
+                          "its image in the main process: %s.  Running it "
+                          "in the main process instead."%
+                          (name, ", ".join( companions)))
+            continue
+        
+        WORKERS[name] = PluginWorker( name, func, CONFIG, LOGGER_NAME,
+                                      shm_size, timeout, spares)
+        WORKERS[name].start()
+
+def init_checkpoints():
+    '''
+    If CHECKPOINT_DIR is set in the config file, start the thread that
+    writes the checkpoints.  (See checkpoint.py.)
+    '''
+    global CHECKPOINTER, CHECKPOINT_INTERVAL, LAST_CHECKPOINT
+    checkpoint_dir = get_option( CONFIG, "System Config", "CHECKPOINT_DIR", "")
+    if not checkpoint_dir:
+        return
+    
+    logger = logging.getLogger(LOGGER_NAME)
+    CHECKPOINT_INTERVAL = get_option( CONFIG, "System Config",
+                                      "CHECKPOINT_INTERVAL", 60.0, float)
+    try:
+        checkpointer = Checkpointer( checkpoint_dir)
+        checkpointer.start()
+    except OSError, e:
+        logger.error( "Couldn't start checkpointing to %s: %s"%
+                      (checkpoint_dir, e))
+        return
+    
+    logger.info( "Checkpointing plugin state to %s every %g seconds"%
+                 (checkpoint_dir, CHECKPOINT_INTERVAL))
+    CHECKPOINTER = checkpointer
+    LAST_CHECKPOINT = time.time()
+
+def init_supervisor( instrument, pv_prefix):
+    '''
+    Create the supervisor for the live listener and, if requested, the PV
+    objects for the listener restart PV's.  (See listener_supervisor.py.)
+    '''
+    global SUPERVISOR, LISTENER_PVS
+    SUPERVISOR = ListenerSupervisor(
+        lambda: start_live_listener( instrument),
+        start_timeout = get_option( CONFIG, "System Config",
+                                    "LISTENER_START_TIMEOUT", 60.0, float),
+        poll_interval = get_option( CONFIG, "System Config",
+                                    "LISTENER_POLL_INTERVAL", 0.1, float),
+        backoff_min = get_option( CONFIG, "System Config",
+                                  "LISTENER_BACKOFF_MIN", 1.0, float),
+        backoff_max = get_option( CONFIG, "System Config",
+                                  "LISTENER_BACKOFF_MAX", 60.0, float))
+    
+    LISTENER_PVS = get_option( CONFIG, "System Config", "LISTENER_PVS",
+                               False, bool)
+    if LISTENER_PVS:
+        for name in LISTENER_PV_NAMES:
+            add_output_pv( pv_prefix, name)
+        report_listener_restarts()
+
+def report_listener_restarts():
+    '''
+    Post the listener restart PV's (if they're in use)
+
+    This runs in the main thread, so the values are only posted.  They're
+    published with the next chunk's values, when the chunk thread (or the
+    publisher thread) flushes.
+    '''
+    if not LISTENER_PVS:
+        return
+    PUBLISHER.post( RESTARTS_PV, SUPERVISOR.restarts)
+    PUBLISHER.post( RESTART_MS_PV, SUPERVISOR.last_restart_latency * 1000.0)
+
+def stateful_functions():
+    '''
+    Returns a dict of the callables (or the objects that own them, for bound
+    methods) that have get_state() methods.  Each one is keyed by the first
+    PV (in PROCESS_VARIABLES order) that it calculates, so the keys stay the
+    same from one program run to the next.  Functions that run in worker
+    processes are skipped since their state isn't in this process.
+    '''
+    owners = {}
+    seen = set()
+    for pv_name in PROCESS_VARIABLES:
+        if pv_name in WORKERS:
+            continue
+        func = PV_Functions_Chunk.get( pv_name, PV_Functions_Post.get( pv_name))
+        owner = getattr( func, 'im_self', func)
+        if owner is None or id( owner) in seen or \
+           not hasattr( owner, 'get_state'):
+            continue
+        seen.add( id( owner))
+        owners[pv_name] = owner
+    return owners
+
+def save_checkpoint( run_num, force = False):
+    '''
+    Hand the current plugin state to the checkpointer if CHECKPOINT_INTERVAL
+    has elapsed (or force is True).  Called between chunks.
+    '''
+    global LAST_CHECKPOINT, CHECKPOINT_RUN_NUM
+    if CHECKPOINTER is None:
+        return
+    CHECKPOINT_RUN_NUM = run_num
+    # Run 0 means we're between runs, so there's nothing worth keeping
+    if run_num == 0:
+        return
+    
+    now = time.time()
+    if not force and (now - LAST_CHECKPOINT < CHECKPOINT_INTERVAL or
+                      CHECKPOINTER.busy()):
+        return
+    
+    logger = logging.getLogger(LOGGER_NAME)
+    states = {}
+    for (key, owner) in stateful_functions().items():
+        try:
+            states[key] = owner.get_state()
+        except Exception, e:
+            logger.error( "Failed to get the state for PV %s: %s"%(key, e))
+    
+    if CHECKPOINTER.save( run_num, states):
+        LAST_CHECKPOINT = now
+
+def restore_checkpoint( run_num):
+    '''
+    Called for each chunk, but only does anything for the first one: if
+    there's a checkpoint for the current run, hand its state to the calc
+    functions.
+    '''
+    global CHECKPOINT_RESTORE_PENDING
+    if not CHECKPOINT_RESTORE_PENDING:
+        return
+    CHECKPOINT_RESTORE_PENDING = False
+    if CHECKPOINTER is None or run_num == 0:
+        return
+    
+    logger = logging.getLogger(LOGGER_NAME)
+    states = CHECKPOINTER.load( run_num)
+    if states is None:
+        logger.info( "No checkpoint for run %d"%run_num)
+        return
+    
+    owners = stateful_functions()
+    for key in states:
+        if not key in owners or not hasattr( owners[key], 'set_state'):
+            logger.warning( "Ignoring the checkpointed state for PV %s"%key)
+            continue
+        try:
+            owners[key].set_state( states[key])
+            logger.info( "Restored the state for PV %s from the "
+                         "checkpoint for run %d"%(key, run_num))
+        except Exception, e:
+            logger.error( "Failed to restore the state for PV %s: %s"%
+                          (key, e))
+
+def call_pv_function( func, pv_name, chunkWS, accumWS, context):
+    '''
+    Calls a single PV calculation function and returns its value.
+    '''
+    # Note: Always use keyword args when calling the PV functions.
+    # Positional arguments are not allowed because we didn't want
+    # to force a particular function signature on everyone.
+    # Instead, we document what keywords are passed and what they
+    # mean; authors of PV functions can pick and choose which
+    # keywords are important to their particular function. 
+    start = time.time()
+    value = func( chunkWS = chunkWS,
+                  accumWS = accumWS,
+                  pv_name = pv_name,
+                  run_num = context.run_number(),
+                  logger_name = LOGGER_NAME,
+                  config = CONFIG,
+                  context = context
+                )
+    TIMINGS.record( CALC, pv_name, time.time() - start)
+    # Note: If you change the list of keyword parameters, be sure
+    # to update README.md!!!
+    return value
+
+def call_pv_functions( functions, chunkWS, accumWS, context):
+    '''
+    Calls the calculation function for each PV in PROCESS_VARIABLES that has
+    one in the functions dict, and posts the values to the publisher.
+
+    PV's with a worker process are handed to it first, so they run in
+    parallel with everything else.  If the thread pool exists, the functions
+    marked thread-safe run on it concurrently.  The rest run afterwards, in
+    order, in this thread.  (So they're free to depend on values the
+    thread-safe functions computed.)
+    Doesn't return until every function has been called.
+    '''
+    start = time.time()
+    isolated = [ n for n in PROCESS_VARIABLES if n in functions and n in WORKERS ]
+    for pv_name in isolated:
+        WORKERS[pv_name].submit( context)
+    
+    values = {}
+    try:
+        pending = {}  # PV name -> AsyncResult
+        if CALC_POOL is not None:
+            for pv_name in PROCESS_VARIABLES:
+                if pv_name in functions and not pv_name in WORKERS and \
+                   getattr( functions[pv_name], 'thread_safe', False):
+                    pending[pv_name] = CALC_POOL.apply_async( call_pv_function,
+                        (functions[pv_name], pv_name, chunkWS, accumWS,
+                         context))
+        
+        # Wait for all of them before get() has a chance to throw
+        for result in pending.values():
+            result.wait()
+        
+        for pv_name in pending:
+            # get() re-raises any exception the function threw
+            values[pv_name] = pending[pv_name].get()
+        
+        for pv_name in PROCESS_VARIABLES:
+            if pv_name in functions and not pv_name in pending and \
+               not pv_name in WORKERS:
+                values[pv_name] = call_pv_function( functions[pv_name],
+                                                    pv_name, chunkWS, accumWS,
+                                                    context)
+    finally:
+        # Collect the workers' results even if one of the other functions
+        # threw, so they're not still busy with this chunk when the next one
+        # is submitted
+        for pv_name in isolated:
+            values[pv_name] = WORKERS[pv_name].result()
+            # Includes the time spent waiting for the other functions, so
+            # it's an upper bound
+            TIMINGS.record( CALC, pv_name, time.time() - start)
+            if not WORKERS[pv_name].running():
+                # Out of spare workers.  (See plugin_worker.py.)
+                del WORKERS[pv_name]
+    
+    # Post the values in the same order as PROCESS_VARIABLES
+    for pv_name in PROCESS_VARIABLES:
+        if not pv_name in values:
+            continue
+        value = values[pv_name]
+        # A value of None means the PV shouldn't be updated this time
+        if value is not None:
+            PUBLISHER.post( pv_name, value)
     
 class ChunkProcessing(PythonAlgorithm):
     def PyInit(self):
@@ -122,6 +541,9 @@ class ChunkProcessing(PythonAlgorithm):
         # Run the algorithm
         logger = logging.getLogger(LOGGER_NAME)
         logger.debug( "Running the ChunkProcessing algorithm")
+        
+        # Pick up any reloaded plugins
+        swap_pv_functions()
     
         # TODO: What other parameters might PV functions want to know?
     
@@ -130,30 +552,23 @@ class ChunkProcessing(PythonAlgorithm):
         if not isinstance(inputWS, IEventWorkspace):
             logger.error( "InputWorkspace was a type '%s' instead of an IEventWorkspace"%type(inputWS).__name__)
             logger.error( "Attempting to continue, but this is likely to cause Mantid to crash eventually.")
+        
+        # Holds the values that more than one PV function needs (so they're
+        # only computed once per chunk)
+        context = ChunkContext( inputWS)
+        
+        # Pick up where we left off if the program was restarted mid-run
+        restore_checkpoint( context.run_number())
                         
-        for pv_name in PROCESS_VARIABLES:
-            if pv_name in PV_Functions_Chunk:
-                
-                if not PV_Objs[pv_name].connect():
-                    logger.error( "PV '%s' is not connected!"%PV_Objs[pv_name].pvname)
-                    
-                # Note: Always use keyword args when calling the PV functions.
-                # Positional arguments are not allowed because we didn't want
-                # to force a particular function signature on everyone.
-                # Instead, we document what keywords are passed and what they
-                # mean; authors of PV functions can pick and choose which
-                # keywords are important to their particular function. 
-                PV_Objs[pv_name].value =  \
-                    PV_Functions_Chunk[pv_name]( chunkWS = inputWS,
-                                                 accumWS = None,
-                                                 pv_name = pv_name,
-                                                 run_num = inputWS.getRunNumber(),
-                                                 logger_name = LOGGER_NAME
-                                                )
-                # Note: If you change the list of keyword parameters, be sure
-                # to update README.md!!!
-            #else:
-                #logger.error( "No function for calculating value of %s"%pv_name)
+        call_pv_functions( PV_Functions_Chunk, inputWS, None, context)
+        
+        save_checkpoint( context.run_number())
+        
+        # If the PostProcessing algorithm is in use, it will publish these
+        # values along with its own, so that clients see a consistent set
+        if not len( PV_Functions_Post):
+            report_timings()
+            PUBLISHER.flush()
             
         # Since we don't modify the data in any way, we don't need to copy
         # the input over to the output workspace.
@@ -175,47 +590,44 @@ class PostProcessing(PythonAlgorithm):
         
         # Call each PV's calculation function
         inputWS = self.getProperty("InputWorkspace").value
-        if not isinstance(inputWS, IEventWorkspace):
+        if not isinstance(inputWS, IEventWorkspace) and \
+           post_needs_events( PV_Functions_Post):
             logger.error( "InputWorkspace was a type '%s' instead of an IEventWorkspace"%type(inputWS).__name__)
             logger.error( "Attempting to continue, but this is likely to cause Mantid to crash eventually.")
             # Note:  The workspace *WON'T* be an IEventWorkspace unless the 'PreserveEvents' option
-            # is used when calling StartLiveData.  For now, it's hard-coded to True, but we might
-            # want to make that optional if we start running out of memory because the workspaces
-            # are getting too big.
+            # is used when calling StartLiveData.  That's only turned on if one of the post
+            # processing functions needs the events.  (See post_needs_events().)
+        
+        context = ChunkContext( inputWS)
                         
-        for pv_name in PROCESS_VARIABLES:
-            if pv_name in PV_Functions_Post:
-                
-                if not PV_Objs[pv_name].connect():
-                    logger.error( "PV '%s' is not connected!"%PV_Objs[pv_name].pvname)
-                    
-                # Note: Always use keyword args when calling the PV functions.
-                # Positional arguments are not allowed because we didn't want
-                # to force a particular function signature on everyone.
-                # Instead, we document what keywords are passed and what they
-                # mean; authors of PV functions can pick and choose which
-                # keywords are important to their particular function.
-                PV_Objs[pv_name].value =  \
-                    PV_Functions_Post[pv_name]( chunkWS = None,
-                                                accumWS = inputWS,
-                                                pv_name = pv_name,
-                                                run_num = inputWS.getRunNumber(),
-                                                logger_name = LOGGER_NAME
-                                              )
-                # Note: If you change the list of keyword parameters, be sure
-                # to update README.md!!!
-            #else:
-                #logger.error( "No function for calculating value of %s"%pv_name)
-        
-        # Last step - copy the input over to the output
-        #outputWS = mtd[ self.getPropertyValue("OutputWorkspace")]
-        #outputWS = inputWS
-        # In theory, we shouldn't have to copy the input to the output if we
-        # don't modify the data, but for some reason, we do.  Also, the
-        # outputWS = inputWS line should suffice, but again for some reason
-        # it doesn't.  Russell is looking in to both these problems.  In the
-        # meantime, clone() works fine.
-        inputWS.clone(OutputWorkspace = self.getPropertyValue("OutputWorkspace"))
+        call_pv_functions( PV_Functions_Post, None, inputWS, context)
+        
+        # Publishes the values from ChunkProcessing, too
+        report_timings()
+        PUBLISHER.flush()
+        
+        # Last step - set the output workspace
+        # Nothing downstream of us looks at the output workspace, but
+        # MonitorLiveData insists that there is one.  We used to clone() the
+        # input, but with PreserveEvents on that's a full copy of every
+        # event in the run, every update.  By default, we now hand back a
+        # tiny placeholder instead.  (See POST_OUTPUT in the config file.)
+        post_output = get_option( CONFIG, "System Config", "POST_OUTPUT",
+                                  "placeholder").lower()
+        if post_output == "clone":
+            inputWS.clone(OutputWorkspace = self.getPropertyValue("OutputWorkspace"))
+        elif post_output == "input":
+            # Same workspace object, so no copy
+            self.setProperty( "OutputWorkspace", inputWS)
+        else:
+            if post_output != "placeholder":
+                logger.error( "Unknown POST_OUTPUT value '%s'.  Using "
+                              "'placeholder'."%post_output)
+            alg = self.createChildAlgorithm( "CreateSingleValuedWorkspace")
+            alg.setProperty( "DataValue", 0.0)
+            alg.execute()
+            self.setProperty( "OutputWorkspace",
+                              alg.getProperty( "OutputWorkspace").value)
         logger.debug( "PostProcessing algorithm complete")
         
 AlgorithmFactory.subscribe( PostProcessing())  
@@ -248,14 +660,20 @@ def import_plugins( plugin_dirs, chunk_regex, post_regex, db_regex):
                             # compile the regex strings returned by
                             # register_pvs() into compiled re objects
                             # TODO: Properly handle poorly defined regex strings!
+                            module_chunk = {}
+                            module_post = {}
                             for k in chunk:
-                                chunk_regex[re.compile(k)] = chunk[k]
+                                module_chunk[re.compile(k)] = chunk[k]
                             
                             for k in post:
-                                post_regex[re.compile(k)] = post[k]
+                                module_post[re.compile(k)] = post[k]
 
                             for k in db:
                                 db_regex[re.compile(k)] = db[k]
+                            
+                            chunk_regex.update( module_chunk)
+                            post_regex.update( module_post)
+                            PLUGIN_MODULES[f[:-3]] = (module_chunk, module_post)
 
                         except AttributeError:
                             logger.warning( "Module '%s' in directory '%s' has no 'register_pvs' function.  Ignoring this module" %(f, d))
@@ -265,28 +683,162 @@ def import_plugins( plugin_dirs, chunk_regex, post_regex, db_regex):
         # Done loading plugins from the directory, so remove it from sys.path
         sys.path = sys.path[:-1]
         
-def start_live_listener( instrument, is_restart = True):
+def match_pv_functions( chunk_regex, post_regex, chunk_funcs, post_funcs):
     '''
-    Start up the Live Listener algorithm.  If is_restart is true, write an
-    error message to the log.  (We'd only ever restart if the listener aborted
-    for some reason.)
+    Match all the names in PROCESS_VARIABLES to a pattern in chunk_regex or
+    post_regex and fill in the chunk_funcs and post_funcs dicts.
     '''
+    logger = logging.getLogger(LOGGER_NAME)
+    for pv_name in PROCESS_VARIABLES:
+        function_found = False
+        for r in chunk_regex:
+            if r.match(pv_name):
+                function_found = True
+                chunk_funcs[pv_name] = chunk_regex[r]
+                break
+        
+        if function_found:
+            continue;  # don't bother searching the post_regex dict
+            
+        for r in post_regex:
+            if r.match(pv_name):
+                function_found = True
+                post_funcs[pv_name] = post_regex[r]
+                break
+        
+        if not function_found:
+            logger.error( "Could not match PV '%s' to any calculation function"%pv_name)
+
+def reload_plugins( paths):
+    '''
+    Re-import the plugin modules at the specified paths and work out the new
+    PV functions.  The new functions are swapped in by ChunkProcessing
+    before the next chunk.  (See swap_pv_functions().)
+    '''
+    global PENDING_FUNCTIONS
+    logger = logging.getLogger(LOGGER_NAME)
     
-    logger = logging.getLogger( LOGGER_NAME)
+    for path in paths:
+        logger.info( "Reloading plugin '%s'"%path)
+        try:
+            m = load_plugin( path)
+            (chunk, post, db) = m.register_pvs()
+            module_chunk = {}
+            module_post = {}
+            for k in chunk:
+                module_chunk[re.compile(k)] = chunk[k]
+            for k in post:
+                module_post[re.compile(k)] = post[k]
+        except Exception, e:
+            # Syntax errors, bad regex strings, no register_pvs(), etc..
+            # Keep running the old version.
+            logger.error( "Failed to reload plugin '%s': %s"%(path, e))
+            continue
+        PLUGIN_MODULES[m.__name__] = (module_chunk, module_post)
+    
+    chunk_regex = {}
+    post_regex = {}
+    for (module_chunk, module_post) in PLUGIN_MODULES.values():
+        chunk_regex.update( module_chunk)
+        post_regex.update( module_post)
+    
+    chunk_funcs = {}
+    post_funcs = {}
+    match_pv_functions( chunk_regex, post_regex, chunk_funcs, post_funcs)
+    
+    PENDING_FUNCTIONS_LOCK.acquire()
+    PENDING_FUNCTIONS = (chunk_funcs, post_funcs)
+    PENDING_FUNCTIONS_LOCK.release()
+
+def swap_pv_functions():
+    '''
+    If reload_plugins() has new PV functions waiting, swap them in and hand
+    over the state from the old callables.  Called by ChunkProcessing before
+    it does anything else, so the swap always happens between chunks.
+    '''
+    global PENDING_FUNCTIONS
+    PENDING_FUNCTIONS_LOCK.acquire()
+    pending = PENDING_FUNCTIONS
+    PENDING_FUNCTIONS = None
+    PENDING_FUNCTIONS_LOCK.release()
+    if pending is None:
+        return
+    
+    logger = logging.getLogger(LOGGER_NAME)
+    (chunk_funcs, post_funcs) = pending
+    
+    # Whether the PostProcessing algorithm runs was decided when the live
+    # listener was started, so we can't change that here
+    if bool( post_funcs) != bool( PV_Functions_Post) or \
+       post_needs_events( post_funcs) != post_needs_events( PV_Functions_Post):
+        logger.error( "Reloaded plugins change whether post processing is "
+                      "needed.  Restart the program to pick them up.")
+        return
     
-    if is_restart:
-        logger.error( "Restarting the live listener algorithm (which " +
-                      "implies that the algorithm crashed somehow).")
+    # Callables are often shared between PV's (or are bound methods of a
+    # shared object), so only hand over each object's state once
+    handed_over = set()
+    for pv_name in PROCESS_VARIABLES:
+        old = PV_Functions_Chunk.get( pv_name, PV_Functions_Post.get( pv_name))
+        new = chunk_funcs.get( pv_name, post_funcs.get( pv_name))
+        if old is new or new is None:
+            continue
+        
+        old_owner = getattr( old, 'im_self', old)
+        new_owner = getattr( new, 'im_self', new)
+        if not id( old_owner) in handed_over:
+            handed_over.add( id( old_owner))
+            if hand_over_state( old_owner, new_owner):
+                logger.info( "Handed over the state for PV %s"%pv_name)
         
+        if pv_name in WORKERS:
+            # A worker with the new function would have to be forked, which
+            # isn't safe now that there are other threads running
+            logger.warning( "PV %s will run in the main process until the "
+                            "program is restarted, since it can't be "
+                            "isolated again after a reload.  Its accumulated "
+                            "state is lost."%pv_name)
+            WORKERS[pv_name].stop()
+            del WORKERS[pv_name]
+    
+    PV_Functions_Chunk.clear()
+    PV_Functions_Chunk.update( chunk_funcs)
+    PV_Functions_Post.clear()
+    PV_Functions_Post.update( post_funcs)
+    logger.info( "Swapped in the reloaded PV functions")
+
+def post_needs_events( post_funcs):
+    '''
+    Returns True if any of the post processing functions need the events in
+    the accumulation workspace.  Functions can say they don't by having a
+    'needs_events' attribute that's False.
+    '''
+    for func in post_funcs.values():
+        if getattr( func, 'needs_events', True):
+            return True
+    return False
+
+def start_live_listener( instrument):
+    '''
+    Start up the Live Listener algorithm and return the MonitorLiveData
+    algorithm.  (The ListenerSupervisor waits for it to actually start.)
+    '''
+    
+    logger = logging.getLogger( LOGGER_NAME)
+    
     # Check to see if we need the PostProcessing algorithm.  Not calling
     # it will save a fair amount of CPU time.  Also, if we don't need
     # it, then we don't need to preserve events, which could save a fair
     # amount of RAM, especially on long running runs.  (We have to set
     # the value to True in order to force the workspace passed to the
     # PostProcessing alg to be an EventWorkspace.)
+    # Note: the standard _POST PV's are accumulated from the chunks (see
+    # accumulator.py), so normally neither one is needed.
     if len( PV_Functions_Post):
         post_proc_alg = 'PostProcessing'
-        preserve_events = True
+        preserve_events = post_needs_events( PV_Functions_Post)
+        logger.info( "Post processing functions in use.  PreserveEvents = %s"%
+                     preserve_events)
     else:
         post_proc_alg = None
         preserve_events = False
@@ -324,15 +876,7 @@ def start_live_listener( instrument, is_restart = True):
         AccumulationWorkspace = 'accumWS',
         )
     
-    mld_alg = sld_return[-1] # last element in sld_return is the MonitorLiveData algorithm
-    # Wait for the mld algorithm to actually start
-    # TODO: Put some kind of timeout in here!
-    if not mld_alg.isRunning():
-        logger.debug( "Waiting for MonitorLiveData algorithm to start")
-        time.sleep(0.1)
-    
-    logger.debug( "MonitorLiveData algorithm now running")
-    return mld_alg   
+    return sld_return[-1] # last element in sld_return is the MonitorLiveData algorithm
 
 def generate_softioc_files(pv_names, prefix, db_regex):
     '''
@@ -352,12 +896,22 @@ def generate_softioc_files(pv_names, prefix, db_regex):
         for r in db_regex:
             if r.match(n):
                 function_found = True
-                db_file.write( db_regex[r](n))
+                db_file.write( db_regex[r](n, config = CONFIG))
                 break
         if function_found == False:
             logger.error( "Could not find record generation function for "
                           "PV '%s'" % n)
             # TODO: This should probably throw an exception
+    
+    # The timing PV's (if any) are handled by the main program itself
+    if get_option( CONFIG, "System Config", "TIMING_PVS", False, bool):
+        for n in pv_names:
+            for kind in KINDS:
+                db_file.write( generateTimingDbRecord( timing_pv_name( n, kind)))
+    
+    if get_option( CONFIG, "System Config", "LISTENER_PVS", False, bool):
+        for n in LISTENER_PV_NAMES:
+            db_file.write( generateListenerDbRecord( n))
         
     db_file.close()
         
@@ -478,7 +1032,7 @@ def main_continued( options):
         write_pidfile( options.pidfile)
         
     # Read the config file
-    config = ConfigParser.ConfigParser()  
+    config = CONFIG
     try:
         config_file = open( options.config)
     except IOError, e:
@@ -572,35 +1126,35 @@ def main_continued( options):
     # Now match all the requested PV names to a pattern in chunk_regex or
     # post_regex and build up the PV_Functions_Chunk and PV_Functions_Post
     # dictionaries.
-    for pv_name in PROCESS_VARIABLES:
-        function_found = False
-        for r in chunk_regex:
-            if r.match(pv_name):
-                function_found = True
-                PV_Functions_Chunk[pv_name] = chunk_regex[r]
-                break
-        
-        if function_found:
-            continue;  # don't bother searching the post_regex dict
-            
-        for r in post_regex:
-            if r.match(pv_name):
-                function_found = True
-                PV_Functions_Post[pv_name] = post_regex[r]
-                break
-        
-        if not function_found:
-            logger.error( "Could not match PV '%s' to any calculation function"%pv_name)
-            
+    match_pv_functions( chunk_regex, post_regex,
+                        PV_Functions_Chunk, PV_Functions_Post)
     
     # TODO: Verify that a requested PV only matches a single callable
     
+    # The worker processes have to be forked before anything starts a thread
+    # (including CA, which starts its own when the PV objects are created).
+    # See plugin_worker.py.
+    init_workers()
+    
     # Create the PV objects
+    init_output()
     init_PV_objs( PV_PREFIX) 
+    init_timing( PV_PREFIX)
+    init_publisher()
+    init_calc_pool()
+    init_checkpoints()
+    init_supervisor( INSTRUMENT, PV_PREFIX)
+    
+    # Watch the plugin dirs for changes, if we've been asked to
+    global PLUGIN_WATCHER
+    reload_interval = get_option( CONFIG, "System Config",
+                                  "PLUGIN_RELOAD_INTERVAL", 0.0, float)
+    if reload_interval > 0:
+        PLUGIN_WATCHER = PluginWatcher( plugin_dirs, reload_interval)
     
     # Attempt the start the mantid live listener
     try:
-        mld_alg = start_live_listener( INSTRUMENT, False)
+        SUPERVISOR.start()
     except RuntimeError, e:
         # If we can't even start the live listener, there probably isn't much
         # point in continuing.
@@ -651,21 +1205,17 @@ def main_continued( options):
     while keep_running and not sigterm_received:
     #for i in range(25):
         try:
-            if not mld_alg.isRunning():
-                try:
-                    mld_alg = start_live_listener(INSTRUMENT) 
-                except RuntimeError, e:
-                    # Most exceptions that the live listener will throw are caught one level up and just
-                    # cause the monitor algorithm to end.  If an exception actually propagates all the
-                    # way out to this level, something really bad has happened.
-                    logger.critical( "Caught RuntimeError starting live listener: %s"%e)
-                    logger.critical( "It may be worthwhile to check the Mantid log file for more details")
-                    logger.critical( "Aborting.")
-                    sys.exit( -1)
+            # Returns as soon as the listener needs restarting.  (Failed
+            # restarts are retried with backoff, rather than aborting.)
+            # Otherwise, this is what keeps us from spinlocking the CPU...
+            if SUPERVISOR.wait( 2.0):
+                if SUPERVISOR.restart():
+                    report_listener_restarts()
             
-            # Assuming everything is running normally, we don't want to
-            # spinlock the CPU...
-            time.sleep(2.0) 
+            if PLUGIN_WATCHER is not None:
+                changed = PLUGIN_WATCHER.changed_files()
+                if changed:
+                    reload_plugins( changed)
         except KeyboardInterrupt:
             logger.debug( "Keyboard interrupt")
             keep_running = False # Exit from the loop
@@ -673,10 +1223,22 @@ def main_continued( options):
             
     
     # Stop the monitor live data algorithm (and wait for it to actually stop)
-    if mld_alg.isRunning():
-        mld_alg.cancel()
-        while mld_alg.isRunning():
-            time.sleep(0.1)
+    SUPERVISOR.stop()
+    
+    if CALC_POOL is not None:
+        CALC_POOL.close()
+        CALC_POOL.join()
+    
+    for name in WORKERS:
+        WORKERS[name].stop()
+    
+    # Save a final checkpoint so that a restart can pick up from here
+    if CHECKPOINTER is not None:
+        CHECKPOINTER.stop()
+        save_checkpoint( CHECKPOINT_RUN_NUM, force = True)
+    
+    # Publish anything that's still waiting to go out
+    PUBLISHER.stop()
             
     logger.info( "Exiting.")
     
@@ -0,0 +1,545 @@
+'''
+Created on Oct 18, 2026
+
+
+Output backends:  where the Publisher sends the PV values.
+
+ca     - EPICS Channel Access puts to the softIoc process (the default)
+shm    - a memory-mapped file that processes on the same host can read
+         directly (see below)
+null   - throws the values away.  Useful for benchmarking the calculations
+         without any publishing cost.
+
+The backend is chosen with the OUTPUT_BACKEND option in the config file.
+
+Shared memory layout
+--------------------
+The shm backend writes the latest value of every PV into a single file
+(SHM_PATH, normally under /dev/shm) that readers mmap.  The file starts with
+a header (SHM_HEADER_DTYPE), followed by a table of max_entries entries
+(SHM_ENTRY_DTYPE) and then the data area.  Each PV gets an entry the first
+time it's published.  num_entries in the header is only incremented after
+the entry is filled in.  When a PV's value outgrows its block, it moves to
+a block twice the size and the old block is reused for other PV's.
+
+Each entry has its own sequence number that works as a seqlock:  the writer
+makes it odd before it touches the entry or its data and even again when
+it's done.  A reader copies the data and re-reads the sequence number.  If
+it was odd, or has changed, the copy may be torn and the reader tries again.
+(SharedMemoryReader does all this.)  The data is always a flat array.  Image
+PV's are published the same way they are over CA, so the reader reshapes
+them itself.
+
+The file is recreated each time the program starts, so readers should
+reopen it if SharedMemoryReader.stale() says so.
+'''
+
+import os
+import mmap
+import time
+import threading
+import logging
+
+import numpy as np
+
+from epics import PV, ca, dbr
+from epics.ca import CAThread
+
+from pv_config import get_option
+
+# Seconds to wait for a group of puts to complete
+PUT_TIMEOUT = 5.0
+
+# The exceptions the ca module raises when a call fails
+CA_ERRORS = (ca.ChannelAccessException, ca.CASeverityException)
+
+DEFAULT_SHM_PATH = "/dev/shm/mantidstats"
+DEFAULT_SHM_SIZE = 64      # MB
+DEFAULT_SHM_ENTRIES = 1024
+
+SHM_MAGIC = "MSTATSHM"
+SHM_VERSION = 1
+
+SHM_HEADER_DTYPE = np.dtype( [ ('magic', 'S8'),
+                               ('version', '<u4'),
+                               ('max_entries', '<u4'),
+                               ('num_entries', '<u4'),
+                               ('pad', '<u4'),
+                               ('created', '<f8'),
+                               ('data_start', '<u8'),
+                               ('size', '<u8'),
+                               ('reserved', 'V16') ])   # 64 bytes
+
+SHM_ENTRY_DTYPE = np.dtype( [ ('name', 'S64'),
+                              ('dtype', 'S8'),       # NumPy type string
+                              ('seq', '<u8'),
+                              ('offset', '<u8'),     # of the data in the file
+                              ('capacity', '<u8'),   # bytes reserved for it
+                              ('nbytes', '<u8'),     # bytes actually used
+                              ('timestamp', '<f8'),
+                              ('reserved', 'V8') ])  # 128 bytes
+
+# Data blocks start on cache line boundaries
+_ALIGN = 64
+
+# Seconds a reader waits before retrying a read that overlapped a write
+_RETRY_DELAY = 0.0005
+
+
+def _align( n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class OutputBackend(object):
+    '''
+    Base class for the output backends
+    '''
+
+    # Name used for the OUTPUT_BACKEND option
+    name = None
+
+    # The type of thread the publisher thread should be
+    thread_class = threading.Thread
+
+    def add_pv( self, pv_name, full_name):
+        '''
+        Called once for each PV before anything is published.  full_name
+        includes the beamline prefix.
+        '''
+        pass
+
+    def put_values( self, items, record_time, wait = True):
+        '''
+        Publish a list of (PV name, value) pairs.  record_time( pv_name,
+        seconds) should be called with the time spent publishing each value.
+
+        wait is False when the caller is Mantid's live data thread.  The
+        backend shouldn't block waiting for the values to be delivered then.
+        '''
+        raise NotImplementedError( "OutputBackend subclasses must override "
+                                   "put_values()")
+
+    def close( self):
+        pass
+
+# End of class OutputBackend
+
+
+class CABackend(OutputBackend):
+    '''
+    Puts the values to the PV's in the softIoc process with Channel Access
+    '''
+    name = 'ca'
+    thread_class = CAThread
+
+    def __init__(self, pv_objs):
+        '''
+        pv_objs is the dict mapping PV names to their epics.PV objects
+        '''
+        self._pv_objs = pv_objs
+
+        # Groups whose puts were sent without waiting for them to complete:
+        # (group id, time they were sent).  See _reap_groups().
+        self._unfinished = []
+
+    def add_pv( self, pv_name, full_name):
+        self._pv_objs[pv_name] = PV( full_name)
+
+    def put_values( self, items, record_time, wait = True):
+        '''
+        Puts all the values to their PV objects as a single CA synchronous
+        group, so they're sent with one flush and show up as a consistent
+        set.  Falls back to individual puts if the group can't be used.
+
+        With wait set (the publisher thread), this waits for the group to
+        complete.  Otherwise, the puts are just flushed and the group is
+        deleted by a later call, once it's done.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        self._reap_groups()
+
+        connected = []
+        for (pv_name, value) in items:
+            pv = self._pv_objs[pv_name]
+            if not pv.connect():
+                logger.error( "PV '%s' is not connected!"%pv.pvname)
+                continue
+            connected.append( (pv_name, pv, value))
+
+        if not connected:
+            return
+
+        try:
+            gid = ca.sg_create()
+        except CA_ERRORS, e:
+            logger.warn( "Couldn't create a CA synchronous group (%s). "
+                         "Putting PV's individually."%e)
+            for (pv_name, pv, value) in connected:
+                start = time.time()
+                pv.value = value
+                record_time( pv_name, time.time() - start)
+            return
+
+        put_times = []
+        sent = False
+        try:
+            for (pv_name, pv, value) in connected:
+                start = time.time()
+                try:
+                    ca.sg_put( gid, pv.chid, value)
+                except CA_ERRORS, e:
+                    logger.error( "Failed to put value for PV '%s': %s"%
+                                  (pv.pvname, e))
+                put_times.append( (pv_name, time.time() - start))
+
+            start = time.time()
+            if wait:
+                self._block( gid)
+            else:
+                ca.flush_io()
+                self._unfinished.append( (gid, time.time()))
+                sent = True
+        finally:
+            if not sent:
+                ca.sg_delete( gid)
+
+        # sg_put() only queues the value.  The sending (and waiting) is done
+        # for the whole group, so each PV gets an even share of it.
+        share = (time.time() - start) / len( put_times)
+        for (pv_name, elapsed) in put_times:
+            record_time( pv_name, elapsed + share)
+
+    def close( self):
+        for (gid, sent) in self._unfinished:
+            self._block( gid)
+            ca.sg_delete( gid)
+        self._unfinished = []
+
+    def _block( self, gid):
+        '''
+        Waits (up to PUT_TIMEOUT seconds) for the group's puts to complete
+        '''
+        status = ca.sg_block( gid, PUT_TIMEOUT)
+        if status != dbr.ECA_NORMAL:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( "PV puts didn't complete: %s"%ca.message( status))
+
+    def _reap_groups( self):
+        '''
+        Deletes the groups from earlier calls that have completed.  Groups
+        that take longer than PUT_TIMEOUT are given up on.
+        '''
+        now = time.time()
+        unfinished = []
+        for (gid, sent) in self._unfinished:
+            try:
+                ca.sg_test( gid)
+            except CA_ERRORS:
+                # Still in progress
+                if now - sent < PUT_TIMEOUT:
+                    unfinished.append( (gid, sent))
+                    continue
+                logger = logging.getLogger( "MantidStats::%s"% __name__)
+                logger.error( "PV puts didn't complete within %.1f seconds"%
+                              PUT_TIMEOUT)
+            ca.sg_delete( gid)
+        self._unfinished = unfinished
+
+# End of class CABackend
+
+
+class NullBackend(OutputBackend):
+    '''
+    Discards every value
+    '''
+    name = 'null'
+
+    def put_values( self, items, record_time, wait = True):
+        pass
+
+# End of class NullBackend
+
+
+class SharedMemoryBackend(OutputBackend):
+    '''
+    Writes the values into a memory-mapped file.  (See the layout notes at
+    the top of this file.)
+    '''
+    name = 'shm'
+
+    def __init__(self, path = DEFAULT_SHM_PATH,
+                 size = DEFAULT_SHM_SIZE * 1024 * 1024,
+                 max_entries = DEFAULT_SHM_ENTRIES):
+        data_start = _align( SHM_HEADER_DTYPE.itemsize +
+                             max_entries * SHM_ENTRY_DTYPE.itemsize)
+        if size <= data_start:
+            raise ValueError( "Shared memory size (%d bytes) is too small"%size)
+
+        # Start with a new file, so that readers of the old one can tell
+        # (by its inode) that it's been replaced
+        if os.path.exists( path):
+            os.remove( path)
+        f = open( path, "w+b")
+        try:
+            f.truncate( size)
+            self._mmap = mmap.mmap( f.fileno(), size)
+        finally:
+            f.close()
+
+        self._header = np.frombuffer( self._mmap, dtype=SHM_HEADER_DTYPE,
+                                      count=1)
+        self._entries = np.frombuffer( self._mmap, dtype=SHM_ENTRY_DTYPE,
+                                       count=max_entries,
+                                       offset=SHM_HEADER_DTYPE.itemsize)
+        self._header['version'] = SHM_VERSION
+        self._header['max_entries'] = max_entries
+        self._header['num_entries'] = 0
+        self._header['created'] = time.time()
+        self._header['data_start'] = data_start
+        self._header['size'] = size
+        # Readers check the magic string, so it goes in last
+        self._header['magic'] = SHM_MAGIC
+
+        self._path = path
+        self._size = size
+        self._next_free = data_start
+        self._free_blocks = []  # (offset, capacity) of blocks PV's outgrew
+        self._index = {}     # PV name -> entry number
+        self._warned = set() # PV's we've already logged an error for
+        self._lock = threading.Lock()
+
+    def add_pv( self, pv_name, full_name):
+        self._lock.acquire()
+        try:
+            self._entry( pv_name)
+        finally:
+            self._lock.release()
+
+    def put_values( self, items, record_time, wait = True):
+        self._lock.acquire()
+        try:
+            for (pv_name, value) in items:
+                start = time.time()
+                self._put( pv_name, value)
+                record_time( pv_name, time.time() - start)
+        finally:
+            self._lock.release()
+
+    def close( self):
+        # The file is left behind so readers can still see the last values
+        self._header = None
+        self._entries = None
+        self._mmap.flush()
+        self._mmap.close()
+
+    def _entry( self, pv_name):
+        '''
+        Returns the entry number for the PV, adding an entry if necessary.
+        Returns None if the table is full.
+        '''
+        if pv_name in self._index:
+            return self._index[pv_name]
+
+        num = int( self._header['num_entries'][0])
+        if num >= len( self._entries):
+            self._error_once( pv_name, "No room in the shared memory table "
+                              "for PV %s"%pv_name)
+            return None
+
+        entry = self._entries[num:num + 1]
+        entry['name'] = pv_name
+        entry['seq'] = 0
+        entry['capacity'] = 0
+        entry['nbytes'] = 0
+        self._header['num_entries'] = num + 1
+        self._index[pv_name] = num
+        return num
+
+    def _put( self, pv_name, value):
+        num = self._entry( pv_name)
+        if num is None:
+            return
+
+        value = np.ascontiguousarray( value).ravel()
+        if not value.dtype.kind in 'biuf':
+            self._error_once( pv_name, "Can't publish %s values for PV %s in "
+                              "shared memory"%(value.dtype, pv_name))
+            return
+
+        entry = self._entries[num:num + 1]
+        capacity = int( entry['capacity'][0])
+        block = None    # unless it grows, the data stays where it is
+        if value.nbytes > capacity:
+            # Double the space each time, so a PV that keeps growing only
+            # moves a few times
+            block = self._allocate( max( value.nbytes, 2 * capacity))
+            if block is None:
+                self._error_once( pv_name, "Not enough shared memory for PV "
+                                  "%s (%d bytes)"%(pv_name, value.nbytes))
+                return
+
+        # Odd while we're writing
+        seq = int( entry['seq'][0])
+        entry['seq'] = seq + 1
+
+        if block is not None:
+            if capacity:
+                # A reader still copying from the old block will see the
+                # new seq and retry, so the block can be reused right away
+                self._free_blocks.append( (int( entry['offset'][0]), capacity))
+            (entry['offset'], entry['capacity']) = block
+        dest = np.frombuffer( self._mmap, dtype=np.uint8, count=value.nbytes,
+                              offset=int( entry['offset'][0]))
+        dest[:] = value.view( np.uint8)
+        entry['dtype'] = value.dtype.str
+        entry['nbytes'] = value.nbytes
+        entry['timestamp'] = time.time()
+
+        entry['seq'] = seq + 2
+
+    def _allocate( self, nbytes):
+        '''
+        Returns the (offset, capacity) of a block of at least nbytes:  the
+        smallest free block that's big enough, or else new space from the
+        end of the data area.  Returns None if there's no room.
+        '''
+        fits = [ b for b in self._free_blocks if b[1] >= nbytes ]
+        if fits:
+            block = min( fits, key=lambda b: b[1])
+            self._free_blocks.remove( block)
+            return block
+
+        capacity = _align( nbytes)
+        if self._next_free + capacity > self._size:
+            return None
+        block = (self._next_free, capacity)
+        self._next_free += capacity
+        return block
+
+    def _error_once( self, pv_name, msg):
+        if not pv_name in self._warned:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( msg)
+            self._warned.add( pv_name)
+
+# End of class SharedMemoryBackend
+
+
+class SharedMemoryReader(object):
+    '''
+    Reads the values written by a SharedMemoryBackend (normally from another
+    process)
+    '''
+
+    def __init__(self, path = DEFAULT_SHM_PATH):
+        self._path = path
+        f = open( path, "rb")
+        try:
+            self._inode = os.fstat( f.fileno()).st_ino
+            self._mmap = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        header = np.frombuffer( self._mmap, dtype=SHM_HEADER_DTYPE, count=1)
+        if header['magic'][0] != SHM_MAGIC or \
+           header['version'][0] != SHM_VERSION:
+            raise ValueError( "%s isn't a MantidStats shared memory file"%path)
+        self._header = header
+        self._entries = np.frombuffer( self._mmap, dtype=SHM_ENTRY_DTYPE,
+                                       count=int( header['max_entries'][0]),
+                                       offset=SHM_HEADER_DTYPE.itemsize)
+
+    def names( self):
+        '''
+        Returns the names of the PV's that have been published so far
+        '''
+        num = int( self._header['num_entries'][0])
+        return list( self._entries['name'][:num])
+
+    def read( self, pv_name, timeout = 1.0):
+        '''
+        Returns (sequence number, timestamp, value) for the PV, where value
+        is a copy of the latest array.  Returns None if the PV hasn't been
+        published yet.  (The sequence number goes up by 2 for each update.)
+
+        If the writer is updating the PV, the read is retried for up to
+        timeout seconds.
+        '''
+        num = int( self._header['num_entries'][0])
+        matches = np.flatnonzero( self._entries['name'][:num] == pv_name)
+        if len( matches) == 0:
+            return None
+        entry = self._entries[matches[0]:matches[0] + 1]
+
+        deadline = time.time() + timeout
+        while True:
+            seq = int( entry['seq'][0])
+            if seq == 0:
+                return None
+            if seq % 2:
+                # The writer is busy
+                if time.time() > deadline:
+                    break
+                time.sleep( _RETRY_DELAY)
+                continue
+            dtype = np.dtype( entry['dtype'][0])
+            nbytes = int( entry['nbytes'][0])
+            offset = int( entry['offset'][0])
+            timestamp = float( entry['timestamp'][0])
+            value = np.frombuffer( self._mmap, dtype=np.uint8, count=nbytes,
+                                   offset=offset).copy()
+            if int( entry['seq'][0]) == seq:
+                return (seq, timestamp, value.view( dtype))
+            if time.time() > deadline:
+                break
+        raise RuntimeError( "Couldn't get a consistent read of %s"%pv_name)
+
+    def stale( self):
+        '''
+        Returns True if the file has been replaced (ie: the program was
+        restarted) and the reader should be recreated
+        '''
+        try:
+            return os.stat( self._path).st_ino != self._inode
+        except OSError:
+            return True
+
+    def close( self):
+        self._header = None
+        self._entries = None
+        self._mmap.close()
+
+# End of class SharedMemoryReader
+
+
+BACKENDS = dict( [ (b.name, b) for b in (CABackend, SharedMemoryBackend,
+                                         NullBackend) ])
+
+
+def create_backend( config, pv_objs):
+    '''
+    Returns the backend selected by the OUTPUT_BACKEND option.  pv_objs is
+    the dict that the CA backend keeps its epics.PV objects in.
+    '''
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+    name = get_option( config, "System Config", "OUTPUT_BACKEND",
+                       CABackend.name).lower()
+    if not name in BACKENDS:
+        logger.error( "Unknown OUTPUT_BACKEND '%s'.  Using '%s'."%
+                      (name, CABackend.name))
+        name = CABackend.name
+
+    if name == SharedMemoryBackend.name:
+        path = get_option( config, "System Config", "SHM_PATH",
+                           DEFAULT_SHM_PATH)
+        size = get_option( config, "System Config", "SHM_SIZE",
+                           DEFAULT_SHM_SIZE, int) * 1024 * 1024
+        max_entries = get_option( config, "System Config", "SHM_ENTRIES",
+                                  DEFAULT_SHM_ENTRIES, int)
+        logger.info( "Publishing PV values to shared memory in %s"%path)
+        return SharedMemoryBackend( path, size, max_entries)
+    elif name == NullBackend.name:
+        logger.warn( "Using the null output backend.  PV values will NOT be "
+                     "published.")
+        return NullBackend()
+    return CABackend( pv_objs)
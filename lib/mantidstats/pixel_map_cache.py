@@ -0,0 +1,140 @@
+'''
+Created on Oct 18, 2026
+
+
+Utility functions for caching detector-to-output-array maps on disk.
+
+Building one of these maps means walking every detector in the instrument,
+which takes a while for the larger instruments.  The finished maps are saved
+as .npy files so that later startups (and listener restarts) can simply
+memory-map them.  Each file name includes a hash of the instrument geometry,
+so a changed instrument definition automatically gets a new map.
+
+The hash is built from things that are cheap to get (the instrument
+definition and the number of spectra) rather than the detector positions
+themselves, so that a cache hit doesn't have to walk the detectors at all.
+'''
+
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+
+def instrument_id( instrument):
+    '''
+    Returns a hex string identifying the instrument: a hash of its name and
+    (if Mantid will tell us where it is) its instrument definition file.
+
+    instrument is the Mantid instrument object for the workspace
+    '''
+    h = hashlib.sha1()
+    h.update( instrument.getName())
+
+    # Include the instrument definition file itself, if Mantid will tell
+    # us where it is.  (Older versions of Mantid won't.)
+    try:
+        idf = open( instrument.getFilename(), 'rb')
+        h.update( idf.read())
+        idf.close()
+    except (AttributeError, RuntimeError, IOError):
+        pass
+
+    return h.hexdigest()
+
+
+def geometry_hash( inst_id, num_spectra, *params):
+    '''
+    Returns a hex string that uniquely identifies a detector geometry
+
+    inst_id is the string returned by instrument_id()
+    num_spectra is the number of spectra (workspace indexes) in the workspace
+    params are any extra values (output array size, etc..) that the map
+      depends on.  They're included in the hash so that changing them
+      also invalidates the cached map.
+
+    Note: Detectors that are moved after the instrument is loaded (by a
+    sample log, for instance) aren't covered by the hash.  Clear the cache
+    directory if that happens.
+    '''
+    h = hashlib.sha1()
+    h.update( inst_id)
+    h.update( repr( (int( num_spectra),) + params))
+    return h.hexdigest()
+
+
+def _cache_file_name( cache_dir, name, geom_hash):
+    return os.path.join( cache_dir, "%s_%s.npy"%(name, geom_hash))
+
+
+def load_pixel_map( cache_dir, name, geom_hash, num_spectra):
+    '''
+    Returns the cached map for the specified name and geometry hash as a
+    read-only, memory-mapped NumPy array, or None if there's no usable
+    cached map.
+
+    num_spectra is the expected length of the map.  A file that doesn't
+      match it is ignored.
+    '''
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+    fname = _cache_file_name( cache_dir, name, geom_hash)
+    if not os.path.isfile( fname):
+        logger.debug( "No cached pixel map at '%s'"%fname)
+        return None
+
+    try:
+        pixel_map = np.load( fname, mmap_mode='r')
+    except (IOError, ValueError), e:
+        logger.warning( "Failed to load cached pixel map '%s': %s"%(fname, e))
+        return None
+
+    if pixel_map.shape != (num_spectra,) or pixel_map.dtype != np.int32:
+        logger.warning( "Cached pixel map '%s' has the wrong size or type. "
+                        "Ignoring it."%fname)
+        return None
+
+    logger.info( "Loaded cached pixel map from '%s'"%fname)
+    return pixel_map
+
+
+def save_pixel_map( cache_dir, name, geom_hash, pixel_map):
+    '''
+    Writes the map to the cache directory and removes any older maps saved
+    under the same name.
+
+    Failures are logged, but otherwise ignored.  (Not having a cache just
+    means a slower startup next time.)
+    '''
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+    fname = _cache_file_name( cache_dir, name, geom_hash)
+    try:
+        if not os.path.isdir( cache_dir):
+            os.makedirs( cache_dir)
+
+        # Write to a temporary file and rename it so that nobody can ever
+        # mmap a partially written map
+        tmp_fname = "%s.%d.tmp"%(fname, os.getpid())
+        tmp_file = open( tmp_fname, 'wb')
+        np.save( tmp_file, np.asarray( pixel_map, dtype=np.int32))
+        tmp_file.close()
+        os.rename( tmp_fname, fname)
+
+        # Any other maps with the same name are for a geometry we no longer
+        # have, so they're just taking up space
+        # (Checking the length keeps us from matching a different name that
+        # happens to start with this one.)
+        prefix = "%s_"%name
+        for f in os.listdir( cache_dir):
+            if f.startswith( prefix) and f.endswith( '.npy') and \
+               len(f) == len(os.path.basename( fname)) and \
+               os.path.join( cache_dir, f) != fname:
+                logger.debug( "Removing stale pixel map '%s'"%f)
+                os.remove( os.path.join( cache_dir, f))
+    except (IOError, OSError), e:
+        logger.warning( "Failed to save pixel map to '%s': %s"%(fname, e))
+        return
+
+    logger.info( "Saved pixel map to '%s'"%fname)
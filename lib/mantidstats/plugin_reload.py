@@ -0,0 +1,105 @@
+'''
+Created on Oct 18, 2026
+
+
+Support for reloading plugins while the program is running.
+
+A PluginWatcher keeps track of the modification times of the .py files in
+the plugin directories.  When one changes, the main program re-imports it,
+calls its register_pvs() again and swaps the new callables in between two
+chunks.  (See reload_plugins() and swap_pv_functions() in main.py.)
+
+Plugins that accumulate values over a run can keep them across a reload by
+giving their callables a pair of methods:
+
+    get_state()       - returns an object holding the accumulated values
+    set_state(state)  - called on the new callable with the old one's state
+
+Callables without them simply start over.
+'''
+
+import os
+import imp
+import time
+import logging
+
+
+def load_plugin( path):
+    '''
+    (Re-)imports the plugin module at path and returns the module object.
+    Whatever exception the import throws is passed on to the caller.
+    '''
+    name = os.path.splitext( os.path.basename( path))[0]
+    return imp.load_source( name, path)
+
+
+def hand_over_state( old, new):
+    '''
+    Passes the state from an old callable to its replacement, if both sides
+    support it.  Returns True if the state was handed over.
+    '''
+    if old is new:
+        return False
+    if not (hasattr( old, 'get_state') and hasattr( new, 'set_state')):
+        return False
+
+    logger = logging.getLogger( "MantidStats::%s"% __name__)
+    try:
+        new.set_state( old.get_state())
+    except Exception, e:
+        logger.error( "Failed to hand over plugin state: %s"%e)
+        return False
+    return True
+
+
+class PluginWatcher(object):
+    '''
+    Watches the plugin directories for new and modified .py files.
+    '''
+
+    def __init__(self, plugin_dirs, interval):
+        '''
+        interval is the minimum time (in seconds) between scans
+        '''
+        self._dirs = plugin_dirs
+        self._interval = interval
+        self._mtimes = self._scan()
+        self._last_scan = time.time()
+
+    def _scan( self):
+        '''
+        Returns a dict mapping the full path of every .py file in the plugin
+        directories to its modification time
+        '''
+        mtimes = {}
+        for d in self._dirs:
+            try:
+                names = os.listdir( d)
+            except OSError:
+                continue
+            for f in names:
+                path = os.path.join( d, f)
+                if f[-3:] == '.py' and os.path.isfile( path):
+                    try:
+                        mtimes[path] = os.path.getmtime( path)
+                    except OSError:
+                        pass  # deleted since we listed the directory
+        return mtimes
+
+    def changed_files( self):
+        '''
+        Returns a list of the .py files that are new or have been modified
+        since the last call.  Returns an empty list if it's been less than
+        interval seconds since the last scan.
+        '''
+        now = time.time()
+        if now - self._last_scan < self._interval:
+            return []
+        self._last_scan = now
+
+        mtimes = self._scan()
+        changed = [ p for p in mtimes if self._mtimes.get( p) != mtimes[p] ]
+        self._mtimes = mtimes
+        return sorted( changed)
+
+# End of class PluginWatcher
@@ -0,0 +1,406 @@
+'''
+Created on Oct 18, 2026
+
+
+Runs PV calc functions in separate worker processes.
+
+Normally, every calc function runs inside the Mantid process, where they all
+compete for the GIL and a misbehaving function can stall the live listener.
+Setting ISOLATE = True in a PV's config section runs its calc function in a
+worker process of its own instead.  (See init_workers() in main.py.)
+
+A worker has no access to the workspace.  Instead, the calc function lists
+the chunk context products it needs (see chunk_context.py):
+
+    worker_inputs       - products sent with every chunk
+    worker_init_inputs  - products sent with the first chunk a (new) worker
+                          sees, for one-time initialization
+
+Inside the worker, the function's 'context' keyword is a WorkerContext that
+holds just those products, and chunkWS & accumWS are both None.  Asking the
+WorkerContext for any other product fetches it from the main process, but
+only once the main process gets around to collecting the result, so that's
+meant for expensive products that are rarely needed (the detector positions
+when the pixel map isn't cached, for instance).  Once fetched, a product is
+kept like a worker_init_inputs product.  NumPy
+arrays (the products themselves and any array the function returns) are
+passed through shared memory, so nothing large is ever pickled.
+
+The function's state (accumulated counts, etc..) lives in the worker.  If a
+worker crashes or takes longer than WORKER_TIMEOUT, it's killed and replaced,
+and that state starts over.
+
+Forking a process that has other threads running is risky:  if one of them
+holds a lock (inside libc, libca, Mantid, etc..) at that moment, the lock
+stays held forever in the child.  So the workers are only ever forked at
+startup, before the program starts any threads of its own.  Along with each
+worker, WORKER_SPARES idle spares are forked.  A worker that has to be
+replaced is swapped for one of those.  Once they've all been used up, the
+PV's calc function runs in the main process instead.
+'''
+
+import mmap
+import logging
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+from epics.multiproc import CAProcess
+
+from chunk_context import ChunkContext
+
+# Array offsets in the shared buffers are aligned to this many bytes
+_ALIGN = 64
+
+DEFAULT_SHM_SIZE = 64 * 1024 * 1024  # bytes (each for input and output)
+DEFAULT_TIMEOUT = 30.0  # seconds
+DEFAULT_SPARES = 1
+
+
+class WorkerError(Exception):
+    pass
+
+
+class SharedBuffer(object):
+    '''
+    A block of anonymous shared memory that both the main process and a
+    (forked) worker process can see, with helpers for storing NumPy arrays
+    in it.
+    '''
+
+    def __init__(self, size):
+        # An anonymous mmap is shared with any processes we fork afterwards.
+        # The pages aren't actually allocated until they're written.
+        self._mmap = mmap.mmap( -1, size)
+        self.size = size
+
+    def write( self, values):
+        '''
+        Stores the values (a dict) in the buffer.  Returns a layout that
+        read() can use to get them back.
+
+        NumPy arrays are copied into the buffer.  Anything else is kept in
+        the layout itself (which gets pickled), so it should be small.
+        '''
+        layout = []
+        offset = 0
+        for (name, value) in values.items():
+            if isinstance( value, np.ndarray):
+                value = np.ascontiguousarray( value)
+                if offset + value.nbytes > self.size:
+                    raise WorkerError( "Shared buffer is too small for '%s' "
+                                       "(%d bytes)"%(name, value.nbytes))
+                dest = np.frombuffer( self._mmap, dtype=value.dtype,
+                                      count=value.size, offset=offset)
+                dest[:] = value.ravel()
+                layout.append( (name, 'array', (value.dtype.str, value.shape,
+                                                offset)))
+                offset += (value.nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+            else:
+                layout.append( (name, 'value', value))
+        return layout
+
+    def read( self, layout):
+        '''
+        Returns a dict of the values described by layout.  The arrays are
+        views into the buffer, so they're only valid until the next write().
+        '''
+        values = {}
+        for (name, kind, desc) in layout:
+            if kind == 'array':
+                (dtype, shape, offset) = desc
+                count = int( np.prod( shape))
+                values[name] = np.frombuffer( self._mmap, dtype=dtype,
+                                              count=count,
+                                              offset=offset).reshape( shape)
+            else:
+                values[name] = desc
+        return values
+
+# End of class SharedBuffer
+
+
+class WorkerContext(ChunkContext):
+    '''
+    The context passed to calc functions running in a worker.  It only has
+    the products that were sent from the main process, plus any that fetch
+    (if it's given) can get.
+    '''
+
+    def __init__(self, values, fetch = None):
+        ChunkContext.__init__( self, None)
+        self._cache.update( values)
+        self._fetch = fetch
+
+    def product( self, name):
+        if not name in self._cache:
+            if self._fetch is None:
+                raise KeyError( "Product '%s' isn't available in a worker "
+                                "process.  Add it to the calc function's "
+                                "worker_inputs."%name)
+            self._cache[name] = self._fetch( name)
+        return self._cache[name]
+
+# End of class WorkerContext
+
+
+def _worker_main( conn, func, pv_name, config, logger_name, in_buf, out_buf):
+    '''
+    Main loop for the worker process.  Waits for requests from the main
+    process, calls the function and sends back the result.
+    '''
+    init_values = {}
+
+    def fetch( name):
+        '''
+        Gets a product from the main process.  It arrives in the output
+        buffer, which isn't in use until the function returns.
+        '''
+        conn.send( ('need', name))
+        (kind, payload) = conn.recv()
+        if kind != 'product':
+            raise KeyError( "Couldn't get product '%s' from the main "
+                            "process: %s"%(name, payload))
+        value = out_buf.read( payload)[name]
+        if isinstance( value, np.ndarray):
+            value = value.copy()
+        init_values[name] = value
+        return value
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if msg[0] == 'stop':
+            break
+
+        (run_num, layout, init_names) = msg[1:]
+        try:
+            values = in_buf.read( layout)
+            for name in init_names:
+                # These have to outlast the next write to the input buffer
+                value = values[name]
+                if isinstance( value, np.ndarray):
+                    value = value.copy()
+                init_values[name] = value
+            values.update( init_values)
+
+            value = func( chunkWS = None,
+                          accumWS = None,
+                          pv_name = pv_name,
+                          run_num = run_num,
+                          logger_name = logger_name,
+                          config = config,
+                          context = WorkerContext( values, fetch))
+
+            if isinstance( value, (np.ndarray, np.flatiter)):
+                layout = out_buf.write( { 'value' : np.asarray( value) })
+                conn.send( ('array', layout))
+            else:
+                conn.send( ('value', value))
+        except Exception:
+            conn.send( ('error', traceback.format_exc()))
+
+
+class PluginWorker(object):
+    '''
+    The main process's handle on one worker process.  Each worker runs the
+    calc function for a single PV.
+    '''
+
+    def __init__(self, pv_name, func, config, logger_name,
+                 shm_size = DEFAULT_SHM_SIZE, timeout = DEFAULT_TIMEOUT,
+                 spares = DEFAULT_SPARES):
+        self._pv_name = pv_name
+        self._func = func
+        self._config = config
+        self._logger_name = logger_name
+        self._timeout = timeout
+        self._num_spares = spares
+
+        self._in_buf = SharedBuffer( shm_size)
+        self._out_buf = SharedBuffer( shm_size)
+
+        self._proc = None
+        self._conn = None
+        self._spares = []   # idle (process, connection) pairs for restarts
+        self._fresh = True  # True until the worker has seen its first chunk
+        self._busy = False  # True while we're waiting for a result
+        self._context = None  # the context of the chunk being worked on
+
+    def start( self):
+        '''
+        Start the worker process and its spares.  Must be called before the
+        program starts any other threads.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.info( "Starting worker process (and %d spares) for PV %s"%
+                     (self._num_spares, self._pv_name))
+
+        (self._proc, self._conn) = self._fork()
+        for i in range( self._num_spares):
+            self._spares.append( self._fork())
+        self._fresh = True
+        self._busy = False
+
+    def running( self):
+        '''
+        Returns False once the worker has failed and there's no spare left
+        to replace it
+        '''
+        return self._proc is not None
+
+    def stop( self):
+        '''
+        Ask the worker process and the spares to exit (and kill any that
+        don't)
+        '''
+        if self._proc is not None:
+            self._spares.insert( 0, (self._proc, self._conn))
+            self._proc = None
+            self._conn = None
+        for (proc, conn) in self._spares:
+            try:
+                conn.send( ('stop',))
+            except (IOError, OSError):
+                pass
+        for (proc, conn) in self._spares:
+            proc.join( self._timeout)
+            self._kill( proc, conn)
+        self._spares = []
+
+    def restart( self):
+        '''
+        Kill the worker process and switch to a spare.  (No new process is
+        forked, since there are other threads running by now.)
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        if self._proc is not None:
+            self._kill( self._proc, self._conn)
+            self._proc = None
+            self._conn = None
+        self._busy = False
+
+        if not self._spares:
+            logger.error( "The worker process for PV %s failed and there are "
+                          "no spares left.  Running it in the main process "
+                          "from now on."%self._pv_name)
+            return
+
+        logger.error( "Replacing the worker process for PV %s with a spare "
+                      "(%d left).  Any state it had accumulated is lost."%
+                      (self._pv_name, len( self._spares) - 1))
+        (self._proc, self._conn) = self._spares.pop( 0)
+        self._fresh = True
+
+    def _send_product( self, context, name):
+        '''
+        Sends a product the worker asked for (through the output buffer,
+        which the worker isn't using while it waits).  If it can't be
+        computed, the worker gets the error message instead.
+        '''
+        try:
+            layout = self._out_buf.write( { name : context.product( name) })
+        except Exception, e:
+            self._conn.send( ('error', "%s: %s"%(type(e).__name__, e)))
+            return
+        self._conn.send( ('product', layout))
+
+    def _fork( self):
+        '''
+        Forks a worker process.  Returns (process, connection).
+        '''
+        (conn, child_conn) = mp.Pipe()
+        proc = CAProcess( target = _worker_main,
+                          name = "%s worker"%self._pv_name,
+                          args = (child_conn, self._func, self._pv_name,
+                                  self._config, self._logger_name,
+                                  self._in_buf, self._out_buf))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        return (proc, conn)
+
+    def _kill( self, proc, conn):
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+        conn.close()
+
+    def submit( self, context):
+        '''
+        Send the products for this chunk to the worker and let it start
+        working.  The result is collected with result().
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        if self._busy:
+            # The result for the last chunk was never collected.  The worker
+            # may still be reading the input buffer, so wait for it (and
+            # throw the result away) before overwriting it.
+            logger.error( "The result from the worker for PV %s wasn't "
+                          "collected.  Discarding it."%self._pv_name)
+            self.result()
+        if self._proc is None:
+            return
+
+        names = list( getattr( self._func, 'worker_inputs', ()))
+        init_names = []
+        if self._fresh:
+            init_names = list( getattr( self._func, 'worker_init_inputs', ()))
+
+        try:
+            values = {}
+            for name in names + init_names:
+                values[name] = context.product( name)
+            layout = self._in_buf.write( values)
+            self._conn.send( ('call', context.run_number(), layout,
+                              init_names))
+        except (WorkerError, IOError, OSError), e:
+            logger.error( "Couldn't send chunk to the worker for PV %s: %s"%
+                          (self._pv_name, e))
+            return
+
+        self._fresh = False
+        self._busy = True
+        self._context = context
+
+    def result( self):
+        '''
+        Waits for (and returns) the value the worker computed for the last
+        chunk sent with submit().  Returns None if there was a problem.
+        '''
+        if not self._busy:
+            return None
+        self._busy = False
+        context = self._context
+        self._context = None
+
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        try:
+            while True:
+                if not self._conn.poll( self._timeout):
+                    logger.error( "Worker for PV %s timed out"%self._pv_name)
+                    self.restart()
+                    return None
+                (kind, payload) = self._conn.recv()
+                if kind != 'need':
+                    break
+                self._send_product( context, payload)
+        except (EOFError, IOError, OSError), e:
+            logger.error( "Lost contact with the worker for PV %s: %s"%
+                          (self._pv_name, e))
+            self.restart()
+            return None
+
+        if kind == 'error':
+            logger.error( "Exception in the worker for PV %s:\n%s"%
+                          (self._pv_name, payload))
+            return None
+        elif kind == 'array':
+            # Copy it out of the buffer before the worker overwrites it
+            return self._out_buf.read( payload)['value'].copy()
+        return payload
+
+# End of class PluginWorker
@@ -7,34 +7,24 @@ Holds calculation functions for some of the more basic process variables
 '''
 
 from softioc_files import writeStandardAORecord
+from accumulator import Accumulator
 
+import re
 import logging
 # -----------------------------------------------------------------------------
 
-def calc_evtcnt( chunkWS, **extra_kwargs):
+class calc_evtcnt(Accumulator):
     '''
-    Calculates the EVTCNT process variable.
+    Calculates the EVTCNT and EVTCNT_POST process variables.
     '''
     # Note: We're operating on the chunkWS, which means we need to keep a
-    # running sum of the events in a static variable and add the events
-    # in chunkWS to it.  (And reset it to 0 when the run # changes.)
-        
-    # The try...except paragraph initializes a couple of attributes on
-    # the function.  This is the python equivalent of static variables
-    try:
-        calc_evtcnt.run_num
-        calc_evtcnt.events
-    except AttributeError:
-        calc_evtcnt.run_num = chunkWS.getRunNumber()
-        calc_evtcnt.events = 0
-        
-    if calc_evtcnt.run_num != chunkWS.getRunNumber():
-        # new run - reset the event count
-        calc_evtcnt.events = 0
-        calc_evtcnt.run_num = chunkWS.getRunNumber()
-        
-    calc_evtcnt.events += chunkWS.getNumberEvents()
-    return calc_evtcnt.events
+    # running sum of the events and add the events in chunkWS to it.  The
+    # Accumulator base class resets it to 0 when the run # changes.
+    # EVTCNT_POST used to be calculated from the accumulation workspace,
+    # but that's just the same sum.
+
+    def update( self, state, context, pv_name):
+        return state + context.total_events()
 
 # -----------------------------------------------------------------------------
 
@@ -45,44 +35,25 @@ def calc_runnum( run_num, **extra_kwargs):
     
     # This one is just stupid simple...    
     return run_num   
+
+calc_runnum.thread_safe = True
     
 # -----------------------------------------------------------------------------
 
-def calc_protoncharge( chunkWS, **extra_kwargs):
+class calc_protoncharge(Accumulator):
     '''
     Calculates the PROTONCHARGE process variable.
     '''
-    
-    # The try...except paragraph initializes a couple of attributes on
-    # the function.  This is the python equivalent of static variables
-    try:
-        calc_protoncharge.run_num
-        calc_protoncharge.accum_charge
-    except AttributeError:
-        calc_protoncharge.run_num = chunkWS.getRunNumber()
-        calc_protoncharge.accum_charge = 0
-        
-    if calc_protoncharge.run_num != chunkWS.getRunNumber():
-        # new run - reset the accumulated charge
-        calc_protoncharge.accum_charge = 0
-        calc_protoncharge.run_num = chunkWS.getRunNumber()
-    
-    run = chunkWS.run()
-    # For reasons that are unclear, calling run.getProtonCharge() causes the program to
-    # crash with an error about unknown property "gd_prtn_chrg" 
-    if run.hasProperty( 'proton_charge'):
-        # the proton_charge property is the charge for each pulse.  We need to
-        # sum all of those charge values
-        p_charge = run.getProperty('proton_charge')
-        
-        calc_protoncharge.accum_charge += p_charge.value.sum()
-        # Note: the value attribute is a NumPy array
-        
-    return calc_protoncharge.accum_charge
-        
+
+    def update( self, state, context, pv_name):
+        # the proton_charge property is the charge for each pulse.  The
+        # context sums all of those charge values (once per chunk -
+        # CALCULATED_POWER uses the same sum)
+        return state + context.proton_charge_sum()
+
 # -----------------------------------------------------------
 
-def calc_calc_power( chunkWS, **extra_kwargs):
+def calc_calc_power( context, **extra_kwargs):
     '''
     Calculates the CALCULATED_POWER process variable
     '''
@@ -91,19 +62,16 @@ def calc_calc_power( chunkWS, **extra_kwargs):
     _BEAM_ENERGY = 9.395e8  # 939.5 MeV in eV
     logger = logging.getLogger("calc_calc_power")
     
-    run = chunkWS.run()
-    # For reasons that are unclear, calling run.getProtonCharge() causes the program to
-    # crash with an error about unknown property "gd_prtn_chrg" 
-    if run.hasProperty( 'proton_charge'):
+    p_charge = context.product( 'proton_charge_log')
+    if p_charge is not None:
         # the proton_charge property is the charge for each pulse.  We need to
         # sum all of those charge values
-        p_charge = run.getProperty('proton_charge')
         
         if (p_charge.size() > 1):
             # delta_t is in seconds, delta_c is in coulombs
             delta_t = (p_charge.lastTime() - p_charge.firstTime()).total_microseconds()/1000000.0
             
-            accum_charge = p_charge.value.sum()
+            accum_charge = context.proton_charge_sum()
             accum_charge /= 1.0e12 # convert to coulombs from picocoulombs
             
             #logger.debug( "elapsed time for charge: %e s" % (finish - start))
@@ -125,91 +93,48 @@ def calc_calc_power( chunkWS, **extra_kwargs):
     
     return 0  # Normally, we won't get here
 
+calc_calc_power.thread_safe = True
+
 # -----------------------------------------------------------
 
-def calc_evtcnt_post( accumWS, **extra_kwargs):
+_MON_PV_RE = re.compile( r'^M([0-9]+)CNT(_POST)?$')
+
+class calc_beam_mon_cnt(Accumulator):
     '''
-    Calculates the EVTCNT_POST process variable.
+    Calculate values for the beam monitor event count process variables
+    (M1CNT, M2CNT, ... and M1CNT_POST, M2CNT_POST, ...)
     '''
-        
-    return accumWS.getNumberEvents()
+    # The _POST versions used to come from the 'monitor<N>_counts'
+    # properties of the accumulation workspace.  Adding the chunks together
+    # sums those properties, so the running sum here gives the same value.
 
-# -----------------------------------------------------------
+    def initial_state( self, pv_name):
+        # None until we've actually seen the monitor.  (Returns -1, same as
+        # when the property is missing from the accumulation workspace.)
+        return None
 
-class calc_beam_mon_cnt:
-    '''
-    Calculate values for beam monitor event count process variable
-    '''
-    
-    def __init__(self):
-        
-        # create all the attributes that the __call__() function is going to
-        # need
-        
-        # Since this class will work for multiple PV names, we use these
-        # dicts map a particular name to its associated value 
-        self._counts = {} # the accumulated beam monitor counts 
-        self._last_run_num = {} # The previous run number (so we know when to
-                                # reset the counts.
-                                
-    def __call__( self, chunkWS, pv_name, run_num, **kwargs):
+    def update( self, state, context, pv_name):
         # Sanity check pv_name
-        # Note: expects the name to be something like M1CNT, M2CNT, M99CNT, etc...
-        if pv_name[0] != 'M' or pv_name[-3:] != 'CNT':
+        # Note: expects the name to be something like M1CNT, M99CNT_POST, etc.
+        m = _MON_PV_RE.match( pv_name)
+        if m is None:
             # HACK!! What should we do here? Throw an exception?
-            return -1
-        
-        try:
-            int( pv_name[1:-3])
-        except ValueError:  # couldn't figure out the monitor number...
-            # HACK!! Again, should probably throw some other exception
-            return -1
-        
-        # initialize the counts and last run num, if necessary
-        if not pv_name in self._counts:
-            self._counts[pv_name] = 0;
-            self._last_run_num[pv_name] = run_num
-        
-        # do we need to reset the accumulated count?
-        if run_num != self._last_run_num[pv_name]:
-            self._counts[pv_name] = 0;
-            self._last_run_num[pv_name] = run_num
-        
-        
-        prop_name = "monitor" + pv_name[1:-3] + "_counts"
-        if chunkWS.run().hasProperty( prop_name):
-            prop = chunkWS.run().getProperty( prop_name)
-            self._counts[pv_name] += prop.value
-            return self._counts[pv_name]
-        else:
+            return state
+        mon_num = int( m.group(1))
+
+        # The monitor counts come from the 'monitor<N>_counts' properties
+        monitor_counts = context.monitor_counts()
+        if mon_num in monitor_counts:
+            if state is None:
+                state = 0
+            state += monitor_counts[mon_num]
+        return state
+
+    def value( self, state, pv_name):
+        if state is None:
             # HACK: should we throw an exception in this case?
             return -1
-# -----------------------------------------------------------    
-
-def calc_beam_mon_cnt_post( accumWS, pv_name, **kwargs):
-    '''
-    Calculate values for beam monitor event count process variables
-    '''
-    
-    # Sanity check pv_name
-    # Note: expects the name to be something like M1CNT, M2CNT, M99CNT, etc...
-    if pv_name[0] != 'M' or pv_name[-8:] != 'CNT_POST':
-        # HACK!! What should we do here? Throw an exception?
-        return -1
-    
-    try:
-        int( pv_name[1:-8])
-    except ValueError:  # couldn't figure out the monitor number...
-        # HACK!! Again, should probably throw some other exception
-        return -1
-    
-    prop_name = "monitor" + pv_name[1:-8] + "_counts"
-    if accumWS.run().hasProperty( prop_name):
-        prop = accumWS.run().getProperty( prop_name)
-        return prop.value
-    else:
-        # HACK: should we throw an exception in this case?
-        return -1
+        return state
 
 # -----------------------------------------------------------    
 
@@ -237,17 +162,22 @@ def register_pvs():
     pv_functions_post = {}
     pv_functions_dbrecord = {}
 
-    pv_functions_chunk[r'^PROTONCHARGE$'] = calc_protoncharge
+    pv_functions_chunk[r'^PROTONCHARGE$'] = calc_protoncharge()
     pv_functions_chunk[r'^CALCULATED_POWER$'] = calc_calc_power    
     pv_functions_chunk[r'^RUNNUM$'] = calc_runnum
-    pv_functions_chunk[r'^EVTCNT$'] = calc_evtcnt
-    pv_functions_post[r'^EVTCNT_POST$'] = calc_evtcnt_post
+    
+    # The _POST PV's are accumulated from the chunks, so they don't need
+    # the PostProcessing algorithm (or PreserveEvents) any more.
+    # Note that these are instances of the classes
+    evtcnt = calc_evtcnt()
+    pv_functions_chunk[r'^EVTCNT$'] = evtcnt
+    pv_functions_chunk[r'^EVTCNT_POST$'] = evtcnt
     
     # should match M1CNT, M2CNT...M99CNT...M1001CNT, etc..
-    pv_functions_chunk[r'^M[0-9]+CNT$'] = calc_beam_mon_cnt()  # note that this is an instance of the class
-
-    # should match M1CNT, M2CNT_POST...M99CNT_POST...M1001CNT_POST, etc..
-    pv_functions_post[r'^M[0-9]+CNT_POST$'] = calc_beam_mon_cnt_post
+    # and M1CNT_POST, M2CNT_POST...M99CNT_POST...M1001CNT_POST, etc..
+    beam_mon_cnt = calc_beam_mon_cnt()
+    pv_functions_chunk[r'^M[0-9]+CNT$'] = beam_mon_cnt
+    pv_functions_chunk[r'^M[0-9]+CNT_POST$'] = beam_mon_cnt
     
     # Map the same regex strings to the function that generates records for
     # the softIOC program.
@@ -0,0 +1,260 @@
+'''
+Created on Oct 18, 2026
+
+
+Holds calculation function for the generic detector image PV's
+(DETIMAGE, DETIMAGE1, DETIMAGE2, etc..)
+
+Unlike EVTHISTO, which is hard-coded for CORELLI, these PV's work out how to
+project the detectors onto a 2D image from the instrument geometry.  The
+options for each PV are read from its own section in the config file.  For
+example:
+
+[DETIMAGE Config]
+PROJECTION = auto     ; auto, cylindrical, flat or raster
+WIDTH = 512           ; size of the output image
+HEIGHT = 512
+ROW_LENGTH = 256      ; raster only: pixels per tube
+BIN_X = 1             ; raster only: tubes per image column
+BIN_Y = 1             ; raster only: pixels per image row
+
+'auto' picks one of the other three based on the detector positions.  (It
+only looks at them when the pixel map has to be built.  A map cached in
+PIXEL_MAP_CACHE_DIR is reused as is.)
+'''
+
+import logging
+
+from softioc_files import writeStandardWaveformRecord
+from pv_config import get_pv_option
+from image_histo import ImageHisto, cylindrical_coords, flat_coords, \
+                        raster_coords, raster_size, guess_projection, split_delta_name, \
+                        delta_max_elements, split_binned_name, binned_shape, \
+                        waveform_ftvl
+# -----------------------------------------------------------------------------
+
+PROJECTIONS = ('auto', 'cylindrical', 'flat', 'raster')
+
+DEFAULT_WIDTH = 512
+DEFAULT_HEIGHT = 512
+DEFAULT_ROW_LENGTH = 256
+
+
+def _image_size( pv_name, config):
+    '''
+    Returns the (width, height) of the image for the specified PV
+    '''
+    return (get_pv_option( config, pv_name, 'WIDTH', DEFAULT_WIDTH, int),
+            get_pv_option( config, pv_name, 'HEIGHT', DEFAULT_HEIGHT, int))
+
+
+class DetectorImage(ImageHisto):
+    '''
+    Accumulates events into an image whose projection is chosen from the
+    config file (or from the instrument geometry) at init time.
+    '''
+
+    def __init__(self, pv_name, config):
+
+        (width, height) = _image_size( pv_name, config)
+
+        # Unless the image has at least as many elements as there are pixels,
+        # some pixels are going to share an element
+        ImageHisto.__init__( self, width, height, expect_duplicates=True)
+
+        self._projection = get_pv_option( config, pv_name, 'PROJECTION',
+                                          'auto').lower()
+        if self._projection not in PROJECTIONS:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( "Unknown projection '%s' for PV %s.  Using 'auto'." %
+                          (self._projection, pv_name))
+            self._projection = 'auto'
+
+        self._row_length = get_pv_option( config, pv_name, 'ROW_LENGTH',
+                                          DEFAULT_ROW_LENGTH, int)
+        self._bin_x = get_pv_option( config, pv_name, 'BIN_X', 1, int)
+        self._bin_y = get_pv_option( config, pv_name, 'BIN_Y', 1, int)
+        self._pv_name = pv_name
+
+
+    def _init_projection(self, num_spectra, pv_name, config):
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.info( "Using '%s' projection for %d pixels into a %dx%d "
+                     "image for PV %s" %
+                     (self._projection, num_spectra,
+                      self._OUTPUT_ARRAY_WIDTH, self._OUTPUT_ARRAY_HEIGHT,
+                      pv_name))
+
+        if self._projection == 'raster':
+            self._check_raster_size( num_spectra)
+
+    def _check_raster_size(self, num_spectra):
+        (width, height) = raster_size( num_spectra, self._row_length,
+                                       self._bin_x, self._bin_y)
+        if width > self._OUTPUT_ARRAY_WIDTH or \
+           height > self._OUTPUT_ARRAY_HEIGHT:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( "The raster projection of %d pixels needs a "
+                          "%dx%d image, but PV %s is only %dx%d.  Set "
+                          "WIDTH = %d and HEIGHT = %d (or change ROW_LENGTH, "
+                          "BIN_X & BIN_Y) in its config section.  Until "
+                          "then, the pixels that don't fit are discarded." %
+                          (num_spectra, width, height, self._pv_name,
+                           self._OUTPUT_ARRAY_WIDTH,
+                           self._OUTPUT_ARRAY_HEIGHT,
+                           max( width, self._OUTPUT_ARRAY_WIDTH),
+                           max( height, self._OUTPUT_ARRAY_HEIGHT)))
+
+    def _hash_params(self):
+        # 'auto' stays 'auto' here.  Which projection it picks depends only
+        # on the geometry, which the pixel map's cache key already covers.
+        return (self._projection, self._row_length, self._bin_x, self._bin_y)
+
+    def _compute_coords(self, positions):
+        projection = self._projection
+        if projection == 'auto':
+            # Only needed when the pixel map is built, which is the only
+            # time the positions are collected
+            projection = guess_projection( positions)
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.info( "'auto' picked the '%s' projection for PV %s" %
+                         (projection, self._pv_name))
+            if projection == 'raster':
+                self._check_raster_size( len(positions))
+
+        if projection == 'cylindrical':
+            return cylindrical_coords( positions, self._OUTPUT_ARRAY_WIDTH,
+                                       self._OUTPUT_ARRAY_HEIGHT)
+        elif projection == 'flat':
+            return flat_coords( positions, self._OUTPUT_ARRAY_WIDTH,
+                                self._OUTPUT_ARRAY_HEIGHT)
+        else:
+            return raster_coords( len(positions), self._row_length,
+                                  self._bin_x, self._bin_y)
+
+# End of class DetectorImage
+
+# -----------------------------------------------------------
+
+class calc_detector_image:
+    '''
+    Calculates values for the detector image PV's
+    '''
+
+    # Each PV has its own DetectorImage object
+    thread_safe = True
+
+    # In a worker process (see plugin_worker.py), this object only ever
+    # sees its own PV, so it just needs the same inputs as the image
+    worker_inputs = ImageHisto.worker_inputs
+    worker_init_inputs = ImageHisto.worker_init_inputs
+
+    def __init__(self):
+        # Since this class will work for multiple PV names, we use this
+        # dict to map a particular name to its DetectorImage object
+        self._images = {}
+
+        # States from set_state() for images that haven't been created yet
+        self._pending_states = {}
+
+    def __call__( self, pv_name, config = None, **kwargs):
+        if not pv_name in self._images:
+            # The image is always built from the current config.  A pending
+            # state is only restored if it still fits.
+            image = DetectorImage( pv_name, config)
+            if pv_name in self._pending_states:
+                image.set_state( self._pending_states.pop( pv_name))
+            self._images[pv_name] = image
+
+        return self._images[pv_name]( pv_name = pv_name, config = config,
+                                      **kwargs)
+
+    def get_delta( self, pv_name, **kwargs):
+        '''
+        Returns the value for one of the delta PV's (DETIMAGE_DELTA_IDX, etc..)
+        '''
+        base_name = split_delta_name( pv_name)[0]
+        if not base_name in self._images:
+            # The image PV hasn't been calculated yet
+            return None
+        return self._images[base_name].get_delta( pv_name)
+
+    def get_binned( self, pv_name, **kwargs):
+        '''
+        Returns the value for one of the binned image PV's (DETIMAGE_2X2, etc..)
+        '''
+        base_name = split_binned_name( pv_name)[0]
+        if not base_name in self._images:
+            # The image PV hasn't been calculated yet
+            return None
+        return self._images[base_name].get_binned( pv_name)
+
+    def get_state( self):
+        '''
+        Returns the state of all the images (see plugin_reload.py)
+        '''
+        images = dict( self._pending_states)
+        for pv_name in self._images:
+            images[pv_name] = self._images[pv_name].get_state()
+        return { 'images' : images }
+
+    def set_state( self, state):
+        # The images need the config, so they aren't created until their
+        # first chunk arrives
+        for pv_name in state.get( 'images', {}):
+            if pv_name in self._images:
+                self._images[pv_name].set_state( state['images'][pv_name])
+            else:
+                self._pending_states[pv_name] = state['images'][pv_name]
+
+# -----------------------------------------------------------
+
+def generateDbRecord( pv_name, config = None, **kwargs):
+    '''
+    Returns a string defining the database record for the specified pv_name
+
+    Called by the main program when it needs to generate the config files
+    for the softIOC program.
+    '''
+    suffix = split_delta_name( pv_name)[1]
+    if suffix == '_DELTA_VAL':
+        return writeStandardWaveformRecord( pv_name,
+                                            delta_max_elements( pv_name, config),
+                                            waveform_ftvl( pv_name, config))
+    elif suffix is not None:
+        return writeStandardWaveformRecord( pv_name,
+                                            delta_max_elements( pv_name, config))
+
+    (base_name, factor) = split_binned_name( pv_name)
+    (width, height) = _image_size( base_name, config)
+    if factor is not None:
+        (width, height) = binned_shape( width, height, factor)
+        return writeStandardWaveformRecord( pv_name, width * height)
+    return writeStandardWaveformRecord( pv_name, width * height,
+                                        waveform_ftvl( pv_name, config))
+
+def register_pvs():
+    '''
+    Called by the main plugin loader.  This function sets up the mappings
+    between process variable names and the callables that calculate their
+    values and generate their .db records.
+    '''
+
+    pv_functions_chunk = {}
+    pv_functions_dbrecord = {}
+
+    # should match DETIMAGE, DETIMAGE1, DETIMAGE2, etc..
+    detector_image = calc_detector_image() # note that this is an instance of the class
+    pv_functions_chunk[r'^DETIMAGE[0-9]*$'] = detector_image
+    pv_functions_dbrecord[r'^DETIMAGE[0-9]*$'] = generateDbRecord
+
+    # The delta PV's are computed along with the image PV's
+    pv_functions_chunk[r'^DETIMAGE[0-9]*_DELTA_(IDX|VAL)$'] = detector_image.get_delta
+    pv_functions_dbrecord[r'^DETIMAGE[0-9]*_DELTA_(IDX|VAL)$'] = generateDbRecord
+
+    # And so are the reduced resolution versions
+    pv_functions_chunk[r'^DETIMAGE[0-9]*_(2X2|4X4|8X8)$'] = detector_image.get_binned
+    pv_functions_dbrecord[r'^DETIMAGE[0-9]*_(2X2|4X4|8X8)$'] = generateDbRecord
+
+    # Note: No post processing, so returning an empty dict
+    return (pv_functions_chunk, {}, pv_functions_dbrecord)
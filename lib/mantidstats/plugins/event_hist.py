@@ -13,6 +13,10 @@ import logging
 import math
 
 from softioc_files import writeStandardWaveformRecord
+from image_histo import ImageHisto, GeometryError, cylindrical_coords, \
+                        get_detector_positions, split_delta_name, \
+                        delta_max_elements, split_binned_name, binned_shape, \
+                        waveform_ftvl
 # -----------------------------------------------------------------------------
 
 
@@ -44,33 +48,19 @@ array, we'll calculate the angle off the Z axis on the X-Z plane
 '''
 
 
-class GeometryError(Exception):
-    '''
-    An exception that is thrown if the instrument geometry doesn't match
-    what we were expecting.
-    '''
-    pass
-
-
-class calc_evthisto:
+class calc_evthisto(ImageHisto):
     '''
     Calculates the EVTHISTO process variable.
     '''
-    # Note: We're operating on the chunkWS, which means we need to keep a
-    # running sum of the events for each pixel in a static variable and add
-    # the events in chunkWS to it.  (And reset all the elements to 0 when the
-    # run # changes.)
+    # Note: The accumulation itself is handled by the ImageHisto base class.
+    # This class just supplies CORELLI's geometry.
                    
     def __init__(self):
        
-        # create all the attributes that the __call__() function is going to
-        # need
-        self._last_run_num = -1
-              
         # Geometry constants - we need to verify these are still true
         # before we do much else.  (If they're not true, it probably
         # means somebody messed with the instrument definition file.)
-        # See _finish_init()
+        # See _validate_geometry()
         self._NUM_PIXELS = 372736
         self._MIN_ALPHA = -0.424492
         self._MAX_ALPHA = 2.652780
@@ -82,92 +72,26 @@ class calc_evthisto:
         self._PIXEL_HEIGHT = 3.26531982422e-3 # vertical size, in meters
         
         # The actual dimensions of the array data we'll output
-        self._OUTPUT_ARRAY_WIDTH = 610
-        self._OUTPUT_ARRAY_HEIGHT = 800
-        
-        
-        # Need to keep track of the run numbers so we can reset the output
-        # at run transitions
-        self._run_num = -99
-        
-        # there isn't too much we can do until we actually have a workspace
-        # to work with, so just set a boolean.  We'll test it down in
-        # __call__() and complete the initialization then.
-        self._is_init = False
-        
-        # maps pixel ID's to their <x,y> coordinates in the output array
-        self._pixel_id_map = { }
-        
-        # holds the actual histogram data
-        self._output = np.empty((self._OUTPUT_ARRAY_WIDTH,
-                                 self._OUTPUT_ARRAY_HEIGHT), int)
-        self._reset()
-
-        
-    def __call__( self, chunkWS, pv_name, run_num, **kwargs):
-        '''
-        Process the chunk workspace and update the histogram array with
-        any new events
-        '''
-        
-        # TODO: main.py defines the LOGGER_NAME variable.  It'd be nice if
-        # that definition could make it down into this module somehow...
-        logger = logging.getLogger( "MantidStats::%s"% __name__)
-        #logger.debug( "Inside __call__")
+        ImageHisto.__init__( self, 610, 800)
         
-        if not self._is_init:
-            self._finish_init( chunkWS)
-        
-        # Zero the entries in the output array when the run number changes    
-        if self._run_num != run_num:
-            self._reset()
-            self._run_num = run_num
-        
-        # This serves as both a sanity check and (in the case of 0 events)
-        # a means of skipping a bunch of unnecessary work.
-        total_event_count = chunkWS.getNumberEvents()
-        
-        if total_event_count > 0:
-            running_event_count = 0
-            
-            # loop through all the spectra in the workspace
-            num_spectra = chunkWS.getNumberHistograms()
-            for i in range(num_spectra):
-                num_events = chunkWS.getEventList(i).getNumberEvents()
-                if num_events > 0:
-                    try:
-                        (x,y) = self._pixel_id_map[i]
-                        #logger.debug( "Spectrum %d maps to %d,%d" % (i, x, y))
-                        #logger.debug( "Old value at %d,%d: %d" % (x, y, self._output[x,y]))
-                        self._output[x,y] += num_events
-                        #logger.debug( "New value at %d,%d: %d" % (x, y, self._output[x,y]))
-                        running_event_count += num_events
-                    except KeyError:
-                        logger.error( "Spectrum #%d wasn't in the pixel map!"%i)
-                
-            # end of for loop
-            if running_event_count != total_event_count:
-                logger.error( "Running event count (%d) doesn't match the "
-                              "workspace total event count (%d)!" % 
-                              (running_event_count, total_event_count))
-        else:
-            logger.debug( "0 events in this chunk workspace")
-            
-            
-        #logger.debug("About to return from __call__")
-        
-        # This looks a little strange, but it works.  'flat' is an iterator
-        # over the entire array and the value attribute on PV's (which this
-        # is passed directly to) wants a sequence (when the PV type is
-        # a waveform)
-        return self._output.flat
-
     
-    def _finish_init( self, chunkWS):
+    def _get_detector_positions(self, context):
+        if context.ws is None:
+            # In a worker process, so the positions had to be handed to us
+            return context.product( 'detector_positions')
+        
+        # EventWorkspace docs say the workspace index and detector ID
+        # should always be equal, so we won't look at the detector ID
+        # except in this one check
+        return get_detector_positions( context.ws, check_ids=True)
+    
+    def _hash_params(self):
+        return (self._MIN_ALPHA, self._MAX_ALPHA, self._MIN_Y, self._MAX_Y)
+    
+    def _compute_coords(self, positions):
+        '''
+        Maps the detector positions to <X,Y> coordinates in the output array.
         '''
-        Complete all the initialization steps that had to be deferred until
-        we had an actual workspace.
-        '''            
         # We need to map detector ID's to a set of <X,Y> coordinates.  Since
         # the detectors basically form a cylinder wrapped around the Y axis,
         # we'll essentially 'unroll' them.
@@ -198,92 +122,22 @@ class calc_evthisto:
         # the top, left corner and 609,799 at the bottom, right corner.
         # Because of the coordinate system in use at the beamline, this
         # means that 0,0 in the output array will correspond to 
-        # MAX_ALPHA,MAX_Y and and 609,799 will be MIN_ALPHA,MIN_Y. 
-        
-                
-        logger = logging.getLogger( "MantidStats::%s"% __name__)
-        logger.debug( "Inside _finish_init()")
-        
-        self._validate_geometry(chunkWS)
-        
-        ins = chunkWS.getInstrument()
-        num_spectra = chunkWS.getNumberHistograms() 
-        logger.debug( "Num spectra: %d"%num_spectra)
-        
-        # A couple of constants that get used repeatedly down below.
-        # Calculated once here to save time
-        total_height = self._MAX_Y - self._MIN_Y
-        total_angle = self._MAX_ALPHA - self._MIN_ALPHA
-        
-        logger.debug( "Creating detector ID to output coordinate map")
-        for ws_index in range( num_spectra):
-            det = ins.getDetector( ws_index)
-            if (ws_index != det.getID()):
-                logger.error( "Detector ID / workspace index mismatch: "
-                                "%d != %d"%(ws_index, det.getID()))
-                # EventWorkspace docs say the workspace index and detector ID
-                # should always be equal, so we won't look at the detector ID
-                # except in this one check
-                
-            pos = det.getPos()
-            alpha = self._compute_alpha( pos.getX(), pos.getZ())
-            y = pos.getY()
-            outX = int(((self._MAX_ALPHA - alpha) / total_angle) * (self._OUTPUT_ARRAY_WIDTH - 1))
-            outY = int(((self._MAX_Y - y) / total_height) * (self._OUTPUT_ARRAY_HEIGHT - 1))
-            
-            self._pixel_id_map[ws_index] = (outX, outY);  
-        
-        # Now, check for cases where 2 pixels map to the same output location...
-        logger.debug( "Checking for duplicates in detector ID to output coordinate map")
-        locations = self._pixel_id_map.values()
-        locations.sort()
-        for n in range(len(locations) - 1):
-            if locations[n] == locations[n+1]:
-                logger.error( "Duplicate mapping into output array at %d,%d"%(locations[n][0], locations[n][1]))
-                #TODO: What do we do in this case?
-        logger.debug("Duplicate checks complete.")        
-                
-        logger.debug( "Checking for invalid coordinates in detector ID to output coordinate map")
-        for location in self._pixel_id_map:
-            outX = self._pixel_id_map[location][0];
-            outY = self._pixel_id_map[location][1];
-            if outX < 0 or outX >= self._OUTPUT_ARRAY_WIDTH or \
-               outY < 0 or outY >= self._OUTPUT_ARRAY_HEIGHT:
-                logger.error( "Pixel ID %d maps to invalid coordinates in the"
-                              " output array (%d,%d).  Remapping to 0,0." %
-                              (location, outX, outY))
-                self._pixel_id_map[location] = (0,0)
-        logger.debug("Invalid mapping checks complete.")        
-                
-        self._reset() # set the initial value for the output array
-        self._is_init = True
+        # MAX_ALPHA,MAX_Y and and 609,799 will be MIN_ALPHA,MIN_Y.
+        return cylindrical_coords( positions,
+                                   self._OUTPUT_ARRAY_WIDTH,
+                                   self._OUTPUT_ARRAY_HEIGHT,
+                                   self._MIN_ALPHA, self._MAX_ALPHA,
+                                   self._MIN_Y, self._MAX_Y,
+                                   round_coords=False)
         
 
-    def _reset( self):
-        '''
-        Reset the histogram array.
-        
-        Note: -1 means 'no detector here' and 0 means 'no events for
-        this detector'
-        '''
-        self._output.fill(-1)
-        
-        # Every location that actually has a detector is set to 0
-        for n in self._pixel_id_map.values():
-            self._output[n[0], n[1]] = 0
-            
-        # Note: it would probably be faster to fill with 0 and then individually
-        # set 'no detector' positions to -1, except that I don't have a list of
-        # of locations that *don't* have detectors.  I could make one, but it's
-        # probably not worth the cost in memory usage
-        
-        
-
-    def _validate_geometry(self, chunkWS):
+    def _validate_geometry(self, positions):
         '''
         Compute various values for the geometry of the instrument and verify
         that they match what we're expecting.
         
+        positions is the (N,3) array returned by _get_detector_positions()
+        
         Note: The function returns no value.  If it detects a problem with
         the geometry, it throws an exception.
         '''
@@ -291,55 +145,25 @@ class calc_evthisto:
         logger = logging.getLogger( "MantidStats::%s"% __name__)
         logger.debug( "Validating instrument geometry")
         
-        ins = chunkWS.getInstrument()
-        num_spectra = chunkWS.getNumberHistograms()
+        num_spectra = len(positions)
 
         if (num_spectra != self._NUM_PIXELS):
             raise GeometryError( "Pixel count is wrong.  Expected %d, but "
                                  "actual value is %d"%(self._NUM_PIXELS,
-                                                       chunkWS.getNumberHistograms()))
+                                                       num_spectra))
         
-        min_alpha = 999999.0
-        max_alpha = -9999999.0       
-        min_y = 9999999.0
-        max_y = -9999999.0
-        min_radius = 99999.0
-        max_radius = -99999.0
-        radius_sum = 0  # for computing the average radius
+        x = positions[:,0]
+        y = positions[:,1]
+        z = positions[:,2]
         
-        for ws_index in range( num_spectra):
-            det = ins.getDetector( ws_index)
-                
-            # Strictly speaking, we should use a second 'if' clause instead of
-            # an 'elif' in the tests below as it could cause an error in one
-            # particular case: if the actual maximum value happens to be the
-            # first value tested, it will probably still be less than the
-            # initial min value set above, so we will set min_<whatever> and
-            # then skip the test for max_<whatever>.
-            #
-            # Using 'else if' speeds things up noticeably, though, so I'm using
-            # it anyway.  
-            pos = det.getPos()
-            temp = pos.getY()
-            if (temp < min_y):
-                min_y = temp
-            elif (temp > max_y):
-                max_y = temp
-                
-            temp = self._compute_alpha( pos.getX(), pos.getZ())
-            if (temp < min_alpha):
-                min_alpha = temp
-            elif (temp > max_alpha):
-                max_alpha = temp
-                
-            temp = self._compute_radius( pos.getX(), pos.getY(), pos.getZ())
-            if (temp < min_radius):
-                min_radius = temp
-            elif (temp > max_radius):
-                max_radius = temp
-                
-            radius_sum += temp
-            
+        alpha = self._compute_alpha( x, z)
+        min_alpha = alpha.min()
+        max_alpha = alpha.max()
+        
+        min_y = y.min()
+        max_y = y.max()
+        
+        radius_sum = self._compute_radius( x, y, z).sum()
         
         if not self._approx_equal(min_alpha, self._MIN_ALPHA, 6):
             raise GeometryError( "Unexpected minimum alpha value. Expected "
@@ -370,12 +194,14 @@ class calc_evthisto:
         logger.debug( "Instrument geometry validated.")
         
                 
+    # Note: the x, y & z parameters to these two functions can be either
+    # scalars or NumPy arrays
     def _compute_alpha(self, x, z):
         #TODO: probably don't need a separate function for this...
-        return math.atan2( x, z)  # arctan of x/z
+        return np.arctan2( x, z)  # arctan of x/z
     
     def _compute_radius(self, x, y, z):
-        return math.sqrt((x*x) + (y*y) + (z*z))
+        return np.sqrt((x*x) + (y*y) + (z*z))
     
     def _approx_equal(self, a, b, sigfig):
         return abs(a-b) < (1.0 / math.pow(10, sigfig))        
@@ -384,17 +210,33 @@ class calc_evthisto:
    
 # -----------------------------------------------------------    
 
-# This module only calculates a single PV, so the function to create the
-# EPICS db record is pretty simple
-def generateDbRecord( pv_name, **kwargs):
+# This module only calculates a single PV (plus its optional delta and binned
+# PV's), so the function to create the EPICS db record is pretty simple
+def generateDbRecord( pv_name, config = None, **kwargs):
     '''
     Returns a string defining the database record for the specified pv_name
     
     Called by the main program when it needs to generate the config files
     for the softIOC program.
     '''
+    suffix = split_delta_name( pv_name)[1]
+    if suffix == '_DELTA_VAL':
+        return writeStandardWaveformRecord( pv_name,
+                                            delta_max_elements( pv_name, config),
+                                            waveform_ftvl( pv_name, config))
+    elif suffix is not None:
+        return writeStandardWaveformRecord( pv_name,
+                                            delta_max_elements( pv_name, config))
+    
     ce = calc_evthisto()
-    return writeStandardWaveformRecord( pv_name, (ce._OUTPUT_ARRAY_WIDTH * ce._OUTPUT_ARRAY_HEIGHT) )
+    factor = split_binned_name( pv_name)[1]
+    if factor is not None:
+        (width, height) = binned_shape( ce._OUTPUT_ARRAY_WIDTH,
+                                        ce._OUTPUT_ARRAY_HEIGHT, factor)
+        return writeStandardWaveformRecord( pv_name, width * height)
+
+    return writeStandardWaveformRecord( pv_name, (ce._OUTPUT_ARRAY_WIDTH * ce._OUTPUT_ARRAY_HEIGHT),
+                                        waveform_ftvl( pv_name, config))
         
 def register_pvs():
     '''
@@ -407,8 +249,17 @@ def register_pvs():
     pv_functions_dbrecord = {}
 
     # Match 'EVTHISTO' exactly    
-    pv_functions_chunk[r'^EVTHISTO$'] = calc_evthisto() # pass back an instance of the class
+    evthisto = calc_evthisto()
+    pv_functions_chunk[r'^EVTHISTO$'] = evthisto # pass back an instance of the class
     pv_functions_dbrecord[r'^EVTHISTO$'] = generateDbRecord
     
+    # The delta PV's are computed along with EVTHISTO itself
+    pv_functions_chunk[r'^EVTHISTO_DELTA_(IDX|VAL)$'] = evthisto.get_delta
+    pv_functions_dbrecord[r'^EVTHISTO_DELTA_(IDX|VAL)$'] = generateDbRecord
+    
+    # So are the reduced resolution versions
+    pv_functions_chunk[r'^EVTHISTO_(2X2|4X4|8X8)$'] = evthisto.get_binned
+    pv_functions_dbrecord[r'^EVTHISTO_(2X2|4X4|8X8)$'] = generateDbRecord
+    
     # Note: No post processing, so returning an empty dict
     return (pv_functions_chunk, {}, pv_functions_dbrecord)
@@ -0,0 +1,279 @@
+'''
+Created on Oct 18, 2026
+
+
+Holds calculation functions for the rate PV's: events per second, beam
+monitor counts per second, proton charge per second and beam power, each
+averaged over a sliding time window.
+
+The PV names say what's being measured and over how long:
+
+EVTRATE_<N>S       - events/s over the last N seconds
+M<k>RATE_<N>S      - counts/s for beam monitor k
+CHARGERATE_<N>S    - proton charge (picocoulombs)/s
+POWER_<N>S         - beam power (watts), calculated from the charge rate
+
+So EVTRATE_10S, EVTRATE_60S & EVTRATE_300S give 10 sec, 1 min & 5 min
+averages.  Each of these also has a _HISTORY PV (EVTRATE_HISTORY,
+M1RATE_HISTORY, POWER_HISTORY, etc..) that's a waveform holding the rate for
+each of the most recent chunks, oldest first.  Its length is set by the
+HISTORY_LENGTH option in the PV's config section.  For example:
+
+[EVTRATE_HISTORY Config]
+HISTORY_LENGTH = 300
+
+Each quantity keeps its per-chunk totals in a fixed-size ring buffer along
+with a running sum for each window, so updating the rates costs the same no
+matter how long the windows are.  Windows longer than RING_SIZE chunks are
+cut short.
+'''
+
+import re
+import time
+import threading
+
+import numpy as np
+
+from softioc_files import writeStandardAORecord, writeStandardWaveformRecord
+from pv_config import get_pv_option
+from chunk_context import register_product
+# -----------------------------------------------------------------------------
+
+_BEAM_ENERGY = 9.395e8  # 939.5 MeV in eV
+
+# Number of chunks kept for each quantity
+RING_SIZE = 2048
+
+DEFAULT_HISTORY_LENGTH = 300
+
+# Matches all the rate PV's.  Group 1 is the quantity, group 2 is either the
+# window length or 'HISTORY'
+_PV_RE = re.compile( r'^(EVTRATE|CHARGERATE|M[0-9]+RATE|POWER)_([0-9]+S|HISTORY)$')
+_MON_RE = re.compile( r'^M([0-9]+)RATE$')
+
+
+def _arrival_time( context):
+    '''
+    The time the chunk was first looked at.  (A product so that every
+    quantity uses the same time for the same chunk.)
+    '''
+    return time.time()
+
+register_product( 'arrival_time', _arrival_time)
+
+
+def _history_length( pv_name, config):
+    length = get_pv_option( config, pv_name, 'HISTORY_LENGTH',
+                            DEFAULT_HISTORY_LENGTH, int)
+    return max( 1, min( length, RING_SIZE))
+
+
+class RateTracker(object):
+    '''
+    Per-chunk totals and durations for one quantity, stored in a ring buffer,
+    plus running sums over each of the time windows that have been asked for.
+    '''
+
+    def __init__(self, size = RING_SIZE):
+        self._times = np.zeros( size, dtype=np.float64)   # chunk end times
+        self._totals = np.zeros( size, dtype=np.float64)
+        self._durations = np.zeros( size, dtype=np.float64)
+        self._size = size
+        self._next = 0   # sequence number of the next chunk
+
+        # For each window (in seconds): the sequence number of the oldest
+        # chunk in the window and the sums of the totals & durations
+        self._tails = {}
+        self._sums = {}
+
+        self._last_time = None  # end of the previous chunk
+
+    def add_window( self, window):
+        '''
+        Start tracking a new window.  Its sums are built from the chunks
+        already in the ring.
+        '''
+        self._tails[window] = max( 0, self._next - self._size)
+        self._sums[window] = [0.0, 0.0]
+        for seq in xrange( self._tails[window], self._next):
+            i = seq % self._size
+            self._sums[window][0] += self._totals[i]
+            self._sums[window][1] += self._durations[i]
+        if self._next:
+            self._expire( window, self._times[(self._next - 1) % self._size])
+
+    def add( self, now, total):
+        '''
+        Add a chunk that ended at time 'now'.  The first chunk only sets the
+        start time, since we don't know how long it covered.
+        '''
+        if self._last_time is None:
+            self._last_time = now
+            return
+        duration = now - self._last_time
+        self._last_time = now
+
+        # The oldest chunk is about to be overwritten, so it has to leave
+        # any window that still includes it
+        oldest = self._next - self._size
+        if oldest >= 0:
+            for window in self._tails:
+                if self._tails[window] == oldest:
+                    self._pop( window)
+
+        i = self._next % self._size
+        self._times[i] = now
+        self._totals[i] = total
+        self._durations[i] = duration
+        self._next += 1
+
+        for window in self._tails:
+            self._sums[window][0] += total
+            self._sums[window][1] += duration
+            self._expire( window, now)
+
+    def _pop( self, window):
+        i = self._tails[window] % self._size
+        self._sums[window][0] -= self._totals[i]
+        self._sums[window][1] -= self._durations[i]
+        self._tails[window] += 1
+
+    def _expire( self, window, now):
+        # Drop the chunks that ended before the window started.  (Each chunk
+        # is only dropped once, so this is O(1) on average.)
+        while self._tails[window] < self._next and \
+              self._times[self._tails[window] % self._size] <= now - window:
+            self._pop( window)
+
+    def rate( self, window):
+        '''
+        Returns the average rate over the window (0 if there's no data yet)
+        '''
+        if not window in self._sums:
+            self.add_window( window)
+        (total, duration) = self._sums[window]
+        if duration <= 0:
+            return 0.0
+        return total / duration
+
+    def history( self, out):
+        '''
+        Fills the array out with the rates of the most recent len(out)
+        chunks, oldest first.  If there aren't enough chunks yet, the
+        beginning is filled with zeros.
+        '''
+        count = min( len(out), self._next, self._size)
+        out[:len(out) - count] = 0
+        if count:
+            idx = np.arange( self._next - count, self._next) % self._size
+            durations = self._durations[idx]
+            rates = out[len(out) - count:]
+            np.divide( self._totals[idx], durations, out=rates,
+                       where=durations > 0)
+            rates[durations <= 0] = 0
+        return out
+
+# End of class RateTracker
+
+
+class calc_rates:
+    '''
+    Calculates all the rate PV's.  A single instance handles all of them so
+    that the trackers are shared between the PV's for the same quantity.
+    '''
+
+    # The trackers are protected by a lock
+    thread_safe = True
+
+    def __init__(self):
+        self._trackers = {}     # quantity -> RateTracker
+        self._updated = {}      # quantity -> arrival time of the last chunk added
+        self._histories = {}    # history PV name -> output array
+        self._lock = threading.Lock()
+
+    def _chunk_total( self, quantity, context):
+        '''
+        Returns the amount of the quantity in this chunk
+        '''
+        if quantity == 'EVTRATE':
+            return context.total_events()
+        elif quantity == 'CHARGERATE':
+            return context.proton_charge_sum()
+        mon_num = int( _MON_RE.match( quantity).group(1))
+        return context.monitor_counts().get( mon_num, 0)
+
+    def _tracker( self, quantity, context):
+        '''
+        Returns the tracker for the quantity, after adding this chunk to it
+        (if that hasn't been done already)
+        '''
+        if not quantity in self._trackers:
+            self._trackers[quantity] = RateTracker()
+        tracker = self._trackers[quantity]
+        # All the PV's for the same quantity see the same chunk, but it
+        # should only be added once
+        arrival_time = context.product( 'arrival_time')
+        if self._updated.get( quantity) != arrival_time:
+            tracker.add( arrival_time, self._chunk_total( quantity, context))
+            self._updated[quantity] = arrival_time
+        return tracker
+
+    def __call__( self, pv_name, context, config = None, **kwargs):
+        m = _PV_RE.match( pv_name)
+        if m is None:
+            return None
+        (quantity, period) = m.groups()
+
+        # Power is just the charge rate in different units
+        scale = 1.0
+        if quantity == 'POWER':
+            quantity = 'CHARGERATE'
+            scale = _BEAM_ENERGY * 1.0e-12  # pC/s -> W
+
+        self._lock.acquire()
+        try:
+            tracker = self._tracker( quantity, context)
+            if period == 'HISTORY':
+                if not pv_name in self._histories:
+                    self._histories[pv_name] = np.zeros(
+                        _history_length( pv_name, config), dtype=np.float64)
+                out = tracker.history( self._histories[pv_name])
+                if scale != 1.0:
+                    out *= scale
+                return out
+
+            return tracker.rate( int( period[:-1])) * scale
+        finally:
+            self._lock.release()
+
+# -----------------------------------------------------------
+
+def generateDbRecord( pv_name, config = None, **kwargs):
+    '''
+    Returns a string defining the database record for the specified pv_name
+
+    Called by the main program when it needs to generate the config files
+    for the softIOC program.
+    '''
+    if pv_name.endswith( '_HISTORY'):
+        return writeStandardWaveformRecord( pv_name,
+                                            _history_length( pv_name, config),
+                                            ftvl = "DOUBLE")
+    return writeStandardAORecord( pv_name)
+
+def register_pvs():
+    '''
+    Called by the main plugin loader.  This function sets up the mappings
+    between process variable names and the callables that calculate their
+    values and generate their .db records.
+    '''
+
+    pv_functions_chunk = {}
+    pv_functions_dbrecord = {}
+
+    regex = _PV_RE.pattern
+    pv_functions_chunk[regex] = calc_rates() # note that this is an instance of the class
+    pv_functions_dbrecord[regex] = generateDbRecord
+
+    # Note: No post processing, so returning an empty dict
+    return (pv_functions_chunk, {}, pv_functions_dbrecord)
@@ -0,0 +1,383 @@
+'''
+Created on Oct 18, 2026
+
+
+Holds calculation functions for the region-of-interest PV's:
+
+BANKCNTS - waveform holding the number of events in each detector bank
+           (16-pack) so far in the run
+ROI1, ROI2, ... - number of events in a region so far in the run
+
+Each ROI PV is defined in its own config section, either as a set of pixel
+ID's read from a file:
+
+[ROI1 Config]
+PIXEL_FILE = /SNS/CORELLI/shared/roi/sample_area.txt
+
+or as a rectangle on one of the image PV's (x0, y0, x1, y1 in image
+elements, inclusive, with 0,0 at the top left):
+
+[ROI2 Config]
+IMAGE = EVTHISTO
+RECT = 100, 50, 140, 90
+
+A pixel file holds pixel ID's separated by whitespace or commas.  Ranges
+like 1000-1999 are allowed and anything after a # is a comment.
+
+These have to be fast even with hundreds of ROI's.  The pixel ROI's (and the
+banks) are turned into label arrays once, with each workspace index labeled
+with the region it belongs to.  Each chunk, a single bincount() of the
+per-spectrum event counts gives the totals for every region at once.
+(Overlapping ROI's need more than one label array.)  The rectangles are
+looked up in O(1) from the image's summed-area table, so list the ROI PV's
+after the image PV in PROCESS_VARIABLES.  Rectangle ROI's don't work if the
+image PV is isolated in a worker process.
+'''
+
+import re
+import weakref
+import threading
+import logging
+
+import numpy as np
+
+from softioc_files import writeStandardAORecord, writeStandardWaveformRecord
+from pv_config import get_pv_option, pv_section
+from chunk_context import register_product
+from accumulator import Accumulator
+from image_histo import find_image, DEFAULT_RECT_IMAGE
+# -----------------------------------------------------------------------------
+
+DEFAULT_PIXELS_PER_BANK = 16 * 256  # 16 tubes of 256 pixels
+DEFAULT_NUM_BANKS = 128
+
+_ROI_SECTION_RE = re.compile( r'^(ROI[0-9]+) Config$')
+
+
+def _detector_ids( context):
+    '''
+    NumPy array holding the detector ID for each workspace index
+    '''
+    ws = context.ws
+    num_spectra = ws.getNumberHistograms()
+    ids = np.empty( num_spectra, dtype=np.int64)
+    for ws_index in range( num_spectra):
+        ids[ws_index] = ws.getDetector( ws_index).getID()
+    return ids
+
+register_product( 'detector_ids', _detector_ids)
+
+
+def read_pixel_file( filename):
+    '''
+    Returns a NumPy array of the pixel ID's listed in the file
+    '''
+    ids = []
+    for line in open( filename):
+        line = line.split( '#')[0]
+        for item in line.replace( ',', ' ').split():
+            if '-' in item[1:]:
+                (first, last) = item.split( '-', 1)
+                ids.extend( range( int( first), int( last) + 1))
+            else:
+                ids.append( int( item))
+    return np.array( ids, dtype=np.int64)
+
+
+class LabelCounter(object):
+    '''
+    Totals the per-spectrum counts for a set of non-overlapping regions with
+    one bincount() call.
+    '''
+
+    def __init__(self, labels, num_labels):
+        '''
+        labels holds the region number for each workspace index, or -1 for
+        indexes that aren't in any region
+        '''
+        # Shifted by 1 so that the unlabeled indexes land in bin 0 (which is
+        # thrown away) and the labels never need masking
+        self._bins = (labels + 1).astype( np.intp)
+        self._num_labels = num_labels
+
+    def counts( self, spectrum_counts):
+        '''
+        Returns an array holding the total counts for each region
+        '''
+        totals = np.bincount( self._bins, weights=spectrum_counts,
+                              minlength=self._num_labels + 1)
+        return totals[1:self._num_labels + 1]
+
+# End of class LabelCounter
+
+
+def _get_spectrum_counts( context, pv_name):
+    counts = context.spectrum_counts()
+    if counts is None and context.total_events() > 0:
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.error( "No per-spectrum counts.  Skipping this chunk for "
+                      "PV %s."%pv_name)
+    return counts
+
+
+class calc_bank_counts(Accumulator):
+    '''
+    Calculates the BANKCNTS process variable.  Element i holds the events
+    for pixel ID's i*PIXELS_PER_BANK through (i+1)*PIXELS_PER_BANK - 1.
+    '''
+
+    def __init__(self):
+        Accumulator.__init__( self)
+        self._num_banks = {}  # PV name -> number of banks
+        self._counter = {}    # PV name -> LabelCounter
+
+    def __call__( self, pv_name, run_num, context, config = None, **kwargs):
+        if not pv_name in self._counter:
+            pixels_per_bank = get_pv_option( config, pv_name, 'PIXELS_PER_BANK',
+                                             DEFAULT_PIXELS_PER_BANK, int)
+            num_banks = get_pv_option( config, pv_name, 'NUM_BANKS',
+                                       DEFAULT_NUM_BANKS, int)
+            labels = context.product( 'detector_ids') // pixels_per_bank
+            labels[(labels < 0) | (labels >= num_banks)] = -1
+            self._num_banks[pv_name] = num_banks
+            self._counter[pv_name] = LabelCounter( labels, num_banks)
+        return Accumulator.__call__( self, pv_name, run_num, context)
+
+    def initial_state( self, pv_name):
+        return np.zeros( self._num_banks[pv_name], dtype=np.int32)
+
+    def update( self, state, context, pv_name):
+        if len( state) != self._num_banks[pv_name]:
+            # Restored from a checkpoint made with a different NUM_BANKS
+            state = self.initial_state( pv_name)
+
+        counts = _get_spectrum_counts( context, pv_name)
+        if counts is not None:
+            np.add( state, self._counter[pv_name].counts( counts), out=state,
+                    casting='unsafe')
+        return state
+
+# End of class calc_bank_counts
+
+
+class _PixelRois(Accumulator):
+    '''
+    Run totals for the ROI's defined by pixel files
+    '''
+
+    # Only ever called from calc_roi, which has its own lock
+    thread_safe = False
+
+    def __init__(self):
+        Accumulator.__init__( self)
+        self._layers = []  # LabelCounter objects
+        self._where = {}   # PV name -> (layer, label)
+
+        # The layer counts for the most recent chunk and (a weak reference
+        # to) the context they came from
+        self._chunk_context = None
+        self._chunk_counts = None
+
+    def build( self, rois, detector_ids):
+        '''
+        rois is a list of (PV name, array of pixel ID's).  Each ROI goes in
+        the first layer that none of its pixels are already in.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+        # For looking up the workspace indexes of the pixel ID's
+        order = np.argsort( detector_ids)
+        sorted_ids = detector_ids[order]
+
+        layers = []  # [label array, number of labels]
+        for (pv_name, pixel_ids) in rois:
+            pixel_ids = np.unique( pixel_ids)
+            pos = np.searchsorted( sorted_ids, pixel_ids)
+            pos[pos == len( sorted_ids)] = 0
+            found = sorted_ids[pos] == pixel_ids
+            indexes = order[pos[found]]
+            if len( indexes) != len( pixel_ids):
+                logger.warning( "%d of the pixels for PV %s aren't in the "
+                                "instrument"%(len( pixel_ids) - len( indexes),
+                                              pv_name))
+            for (layer, (labels, num_labels)) in enumerate( layers):
+                if (labels[indexes] == -1).all():
+                    break
+            else:
+                layers.append( [ np.empty( len( detector_ids), dtype=np.intp),
+                                 0 ])
+                layers[-1][0].fill( -1)
+                layer = len( layers) - 1
+            layers[layer][0][indexes] = layers[layer][1]
+            self._where[pv_name] = (layer, layers[layer][1])
+            layers[layer][1] += 1
+
+        self._layers = [ LabelCounter( labels, num_labels)
+                         for (labels, num_labels) in layers ]
+        logger.info( "%d pixel ROI's in %d layer(s)"%(len( rois),
+                                                      len( layers)))
+
+    def has_roi( self, pv_name):
+        return pv_name in self._where
+
+    def initial_state( self, pv_name):
+        return 0
+
+    def update( self, state, context, pv_name):
+        # All the ROI's are counted on the first call for each chunk
+        if self._chunk_context is None or self._chunk_context() is not context:
+            counts = _get_spectrum_counts( context, pv_name)
+            if counts is None:
+                self._chunk_counts = None
+            else:
+                self._chunk_counts = [ layer.counts( counts)
+                                       for layer in self._layers ]
+            self._chunk_context = weakref.ref( context)
+
+        if self._chunk_counts is None:
+            return state
+        (layer, label) = self._where[pv_name]
+        return state + int( self._chunk_counts[layer][label])
+
+# End of class _PixelRois
+
+
+class calc_roi:
+    '''
+    Calculates the ROI1, ROI2, etc.. process variables
+    '''
+
+    # Not thread safe, so that it runs after the image PV's have been
+    # updated.  (See CALC_THREADS.)
+
+    def __init__(self):
+        self._pixel_rois = None
+        self._rects = {}     # PV name -> (image PV name, x0, y0, x1, y1)
+        self._warned = set() # PV's we've already logged an error for
+        self._pending_state = None  # from set_state(), until we're initialized
+        self._lock = threading.Lock()
+
+    def _init( self, context, config):
+        '''
+        Reads all the ROI definitions from the config file
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        pixel_rois = []
+        sections = []
+        if config is not None:
+            sections = config.sections()
+        for section in sections:
+            m = _ROI_SECTION_RE.match( section)
+            if m is None:
+                continue
+            pv_name = m.group(1)
+
+            rect = get_pv_option( config, pv_name, 'RECT')
+            filename = get_pv_option( config, pv_name, 'PIXEL_FILE')
+            if rect is not None:
+                try:
+                    (x0, y0, x1, y1) = [ int( v) for v in rect.split( ',') ]
+                except ValueError:
+                    logger.error( "Invalid RECT '%s' in section [%s]"%
+                                  (rect, section))
+                    continue
+                image = get_pv_option( config, pv_name, 'IMAGE',
+                                       DEFAULT_RECT_IMAGE)
+                self._rects[pv_name] = (image, x0, y0, x1, y1)
+            elif filename is not None:
+                try:
+                    pixel_rois.append( (pv_name, read_pixel_file( filename)))
+                except (IOError, ValueError), e:
+                    logger.error( "Couldn't read the pixel file for PV %s: "
+                                  "%s"%(pv_name, e))
+
+        self._pixel_rois = _PixelRois()
+        if pixel_rois:
+            self._pixel_rois.build( pixel_rois,
+                                    context.product( 'detector_ids'))
+        if self._pending_state is not None:
+            self._pixel_rois.set_state( self._pending_state)
+            self._pending_state = None
+
+    def _warn( self, pv_name, msg):
+        if not pv_name in self._warned:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( msg)
+            self._warned.add( pv_name)
+
+    def __call__( self, pv_name, run_num, context, config = None, **kwargs):
+        self._lock.acquire()
+        try:
+            if self._pixel_rois is None:
+                self._init( context, config)
+
+            if pv_name in self._rects:
+                (image_name, x0, y0, x1, y1) = self._rects[pv_name]
+                image = find_image( image_name)
+                if image is None:
+                    self._warn( pv_name, "Image PV %s isn't available for "
+                                "ROI PV %s"%(image_name, pv_name))
+                    return None
+                return image.rect_sum( x0, y0, x1, y1)
+
+            if self._pixel_rois.has_roi( pv_name):
+                return self._pixel_rois( pv_name = pv_name, run_num = run_num,
+                                         context = context)
+
+            self._warn( pv_name, "No ROI defined for PV %s.  (Add a [%s] "
+                        "section to the config file.)"%(pv_name,
+                                                        pv_section( pv_name)))
+            return None
+        finally:
+            self._lock.release()
+
+    # These two let the pixel ROI totals survive a plugin reload.  (The
+    # rectangles come straight from the image.)
+    def get_state( self):
+        if self._pixel_rois is None:
+            return self._pending_state
+        return self._pixel_rois.get_state()
+
+    def set_state( self, state):
+        # The ROI's aren't set up until the first chunk arrives, so just
+        # hang on to it until then
+        self._pending_state = state
+
+# End of class calc_roi
+
+# -----------------------------------------------------------
+
+def generateDbRecord( pv_name, config = None, **kwargs):
+    '''
+    Returns a string defining the database record for the specified pv_name
+
+    Called by the main program when it needs to generate the config files
+    for the softIOC program.
+    '''
+    if pv_name == 'BANKCNTS':
+        return writeStandardWaveformRecord( pv_name,
+                                            get_pv_option( config, pv_name,
+                                                           'NUM_BANKS',
+                                                           DEFAULT_NUM_BANKS,
+                                                           int))
+    return writeStandardAORecord( pv_name)
+
+def register_pvs():
+    '''
+    Called by the main plugin loader.  This function sets up the mappings
+    between process variable names and the callables that calculate their
+    values and generate their .db records.
+    '''
+
+    pv_functions_chunk = {}
+    pv_functions_dbrecord = {}
+
+    # note that these are instances of the classes
+    pv_functions_chunk[r'^BANKCNTS$'] = calc_bank_counts()
+    pv_functions_chunk[r'^ROI[0-9]+$'] = calc_roi()
+
+    pv_functions_dbrecord[r'^BANKCNTS$'] = generateDbRecord
+    pv_functions_dbrecord[r'^ROI[0-9]+$'] = generateDbRecord
+
+    # Note: No post processing, so returning an empty dict
+    return (pv_functions_chunk, {}, pv_functions_dbrecord)
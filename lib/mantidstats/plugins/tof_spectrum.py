@@ -0,0 +1,268 @@
+'''
+Created on Oct 18, 2026
+
+
+Holds calculation functions for the time-of-flight spectrum PV's:
+
+TOFSPEC     - histogram of the TOF of every detector event in the run
+M<k>TOFSPEC - the same thing for beam monitor k (M1TOFSPEC, M2TOFSPEC, ...)
+
+Both are waveforms that are reset at the start of each run.  The binning for
+each PV is read from its own section in the config file.  For example:
+
+[TOFSPEC Config]
+TOF_MIN = 0           ; microseconds
+TOF_MAX = 16667
+NUM_BINS = 1000
+BINNING = linear      ; linear or log
+
+Each bin includes its lower edge but not its upper edge.  Events outside
+TOF_MIN..TOF_MAX are ignored.
+
+There are far too many events to look at one by one (or even one spectrum at
+a time) in Python.  Instead, Mantid's SumSpectra algorithm collapses the
+chunk into a single event list (in C++) and all the TOF's come out in one
+NumPy array, which is binned with a single bincount() call.
+
+The monitor PV's need the monitor events, which are only there if the live
+listener provides an event mode monitor workspace along with the chunk.  (If
+the monitors are histogrammed, the PV's just aren't updated.)  Monitor k is
+workspace index k-1 of the monitor workspace.
+'''
+
+import re
+import math
+import logging
+
+import numpy as np
+
+from softioc_files import writeStandardWaveformRecord
+from pv_config import get_pv_option
+from chunk_context import register_product
+from accumulator import Accumulator
+# -----------------------------------------------------------------------------
+
+DEFAULT_TOF_MIN = 0.0
+DEFAULT_TOF_MAX = 16667.0  # one 60Hz frame, in microseconds
+DEFAULT_NUM_BINS = 1000
+
+_MON_PV_RE = re.compile( r'^M([0-9]+)TOFSPEC$')
+
+
+def _get_tofs( ws, index):
+    '''
+    Returns a NumPy array of the TOF's of the events in one spectrum, or
+    None if the workspace doesn't hold events (a histogram workspace)
+    '''
+    try:
+        spectrum = ws.getSpectrum( index)
+    except AttributeError:
+        # Older versions of Mantid
+        try:
+            spectrum = ws.getEventList( index)
+        except AttributeError:
+            return None
+    try:
+        return spectrum.getTofs()
+    except AttributeError:
+        return None
+
+def _event_tofs( context):
+    '''
+    NumPy array holding the TOF of every event in the chunk
+    '''
+    if context.total_events() == 0:
+        return np.zeros( 0, dtype=np.float64)
+
+    from mantid.api import AlgorithmManager
+    alg = AlgorithmManager.createUnmanaged( "SumSpectra")
+    alg.initialize()
+    alg.setChild( True)
+    alg.setProperty( "InputWorkspace", context.ws)
+    alg.setPropertyValue( "OutputWorkspace", "__tofspec_summed")
+    alg.execute()
+    return _get_tofs( alg.getProperty( "OutputWorkspace").value, 0)
+
+def _monitor_workspace( context):
+    '''
+    The monitor workspace that came with the chunk, or None
+    '''
+    try:
+        return context.ws.getMonitorWorkspace()
+    except (AttributeError, RuntimeError):
+        return None
+
+register_product( 'event_tofs', _event_tofs)
+register_product( 'monitor_workspace', _monitor_workspace)
+
+
+class TofBinning(object):
+    '''
+    Linear or logarithmic TOF bins, with a vectorized histogram function
+    '''
+
+    def __init__(self, tof_min, tof_max, num_bins, log_bins = False):
+        self.tof_min = float( tof_min)
+        self.tof_max = float( tof_max)
+        self.num_bins = num_bins
+        self.log_bins = log_bins
+
+        if log_bins:
+            self._scale = num_bins / math.log( self.tof_max / self.tof_min)
+        else:
+            self._scale = num_bins / (self.tof_max - self.tof_min)
+
+    @classmethod
+    def from_config( cls, pv_name, config):
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        tof_min = get_pv_option( config, pv_name, 'TOF_MIN',
+                                 DEFAULT_TOF_MIN, float)
+        tof_max = get_pv_option( config, pv_name, 'TOF_MAX',
+                                 DEFAULT_TOF_MAX, float)
+        num_bins = get_pv_option( config, pv_name, 'NUM_BINS',
+                                  DEFAULT_NUM_BINS, int)
+        binning = get_pv_option( config, pv_name, 'BINNING', 'linear').lower()
+
+        if not binning in ('linear', 'log'):
+            logger.error( "Unknown BINNING '%s' for PV %s.  Using linear "
+                          "bins."%(binning, pv_name))
+            binning = 'linear'
+        if binning == 'log' and tof_min <= 0:
+            logger.error( "Log binning needs TOF_MIN > 0 (PV %s).  Using "
+                          "TOF_MIN = 1."%pv_name)
+            tof_min = 1.0
+        if tof_max <= tof_min or num_bins < 1:
+            logger.error( "Invalid TOF binning for PV %s.  Using the "
+                          "defaults."%pv_name)
+            (tof_min, tof_max, num_bins) = (DEFAULT_TOF_MIN, DEFAULT_TOF_MAX,
+                                            DEFAULT_NUM_BINS)
+            binning = 'linear'
+
+        return cls( tof_min, tof_max, num_bins, binning == 'log')
+
+    def histogram( self, tofs):
+        '''
+        Returns the number of TOF's in each bin
+        '''
+        if self.log_bins:
+            # TOF_MIN is > 0, so TOF's <= 0 are out of range anyway
+            x = np.log( tofs[tofs > 0] / self.tof_min)
+        else:
+            x = tofs - self.tof_min
+        x *= self._scale
+
+        in_range = (x >= 0) & (x < self.num_bins)
+        return np.bincount( x[in_range].astype( np.intp),
+                            minlength = self.num_bins)
+
+# End of class TofBinning
+
+
+class TofSpectrum(Accumulator):
+    '''
+    Accumulates a TOF histogram for each PV over the run.  Subclasses supply
+    the TOF's via _get_chunk_tofs().
+    '''
+
+    def __init__(self):
+        Accumulator.__init__( self)
+        self._binning = {}  # PV name -> TofBinning
+
+    def __call__( self, pv_name, run_num, context, config = None, **kwargs):
+        if not pv_name in self._binning:
+            self._binning[pv_name] = TofBinning.from_config( pv_name, config)
+        return Accumulator.__call__( self, pv_name, run_num, context)
+
+    def initial_state( self, pv_name):
+        # int32 to match the LONG waveform record
+        return np.zeros( self._binning[pv_name].num_bins, dtype=np.int32)
+
+    def update( self, state, context, pv_name):
+        if len( state) != self._binning[pv_name].num_bins:
+            # Restored from a checkpoint made with different binning
+            state = self.initial_state( pv_name)
+
+        tofs = self._get_chunk_tofs( context, pv_name)
+        if tofs is not None and len( tofs):
+            counts = self._binning[pv_name].histogram( tofs)
+            np.add( state, counts, out=state, casting='unsafe')
+        return state
+
+    def _get_chunk_tofs( self, context, pv_name):
+        raise NotImplementedError( "TofSpectrum subclasses must override "
+                                   "_get_chunk_tofs()")
+
+# End of class TofSpectrum
+
+
+class calc_tof_spectrum(TofSpectrum):
+    '''
+    Calculates the TOFSPEC process variable
+    '''
+
+    # Can run in a worker process (see plugin_worker.py)
+    worker_inputs = ('event_tofs',)
+
+    def _get_chunk_tofs( self, context, pv_name):
+        return context.product( 'event_tofs')
+
+# End of class calc_tof_spectrum
+
+
+class calc_monitor_tof_spectrum(TofSpectrum):
+    '''
+    Calculates the M1TOFSPEC, M2TOFSPEC, etc.. process variables
+    '''
+
+    def __init__(self):
+        TofSpectrum.__init__( self)
+        self._warned = set()  # PV's we've already logged an error for
+
+    def _get_chunk_tofs( self, context, pv_name):
+        mon_num = int( _MON_PV_RE.match( pv_name).group(1))
+        mon_ws = context.product( 'monitor_workspace')
+        tofs = None
+        if mon_ws is not None and 1 <= mon_num <= mon_ws.getNumberHistograms():
+            # None if the monitors were histogrammed rather than event mode
+            tofs = _get_tofs( mon_ws, mon_num - 1)
+
+        if tofs is None and not pv_name in self._warned:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.error( "No events for monitor %d.  PV %s won't be "
+                          "updated."%(mon_num, pv_name))
+            self._warned.add( pv_name)
+        return tofs
+
+# End of class calc_monitor_tof_spectrum
+
+# -----------------------------------------------------------
+
+def generateDbRecord( pv_name, config = None, **kwargs):
+    '''
+    Returns a string defining the database record for the specified pv_name
+
+    Called by the main program when it needs to generate the config files
+    for the softIOC program.
+    '''
+    num_bins = TofBinning.from_config( pv_name, config).num_bins
+    return writeStandardWaveformRecord( pv_name, num_bins)
+
+def register_pvs():
+    '''
+    Called by the main plugin loader.  This function sets up the mappings
+    between process variable names and the callables that calculate their
+    values and generate their .db records.
+    '''
+
+    pv_functions_chunk = {}
+    pv_functions_dbrecord = {}
+
+    # note that these are instances of the classes
+    pv_functions_chunk[r'^TOFSPEC$'] = calc_tof_spectrum()
+    pv_functions_chunk[r'^M[0-9]+TOFSPEC$'] = calc_monitor_tof_spectrum()
+
+    pv_functions_dbrecord[r'^TOFSPEC$'] = generateDbRecord
+    pv_functions_dbrecord[r'^M[0-9]+TOFSPEC$'] = generateDbRecord
+
+    # Note: No post processing, so returning an empty dict
+    return (pv_functions_chunk, {}, pv_functions_dbrecord)
@@ -0,0 +1,304 @@
+'''
+Created on Oct 18, 2026
+
+
+Decouples the calculation of PV values from the Channel Access puts that
+publish them.
+
+The ChunkProcessing and PostProcessing algorithms post their results to a
+Publisher, which keeps only the latest value for each PV.  In threaded mode,
+a separate thread flushes those values to the output backend (EPICS, unless
+the config file says otherwise - see output_backends.py), so Mantid's live
+data thread never waits on the network.  Each PV can also have a maximum
+publish rate.  Values that arrive faster than that are coalesced and only the
+newest one is published.
+
+The delta PV's of the images (<PV>_DELTA_IDX & <PV>_DELTA_VAL) are the
+exception.  Each delta only holds the elements that changed since the one
+before it, so dropping one would leave the clients with a stale image.
+Instead, they're queued and any that pile up are merged into a single delta
+when they're published.  If the merged delta is too big for the waveforms,
+it's dropped and the image is asked for a full frame instead.
+'''
+
+import threading
+import time
+import logging
+
+import numpy as np
+
+from timing import PUT
+from image_histo import split_delta_name, DELTA_SUFFIXES
+
+
+def _snapshot( value):
+    '''
+    Returns a copy of any array-like value.
+
+    Image PV's return views of arrays that they keep
+    modifying, so the publisher thread needs its own copy.
+    '''
+    if isinstance( value, (np.ndarray, np.flatiter)):
+        return np.array( value)
+    return value
+
+
+class Publisher(object):
+    '''
+    Holds the latest value for each PV and hands them to the output backend.
+    '''
+
+    def __init__(self, backend, timings = None):
+        '''
+        backend is the OutputBackend that actually publishes the values
+        timings is an (optional) timing.Timings object that records how long
+          each put takes
+        '''
+        self.backend = backend
+        self._timings = timings
+
+        self._pending = {}    # PV name -> latest unpublished value
+        self._intervals = {}  # PV name -> minimum seconds between puts
+        self._last_put = {}   # PV name -> time of the last put
+        self._coalesced = 0   # number of values that were never published
+        self._merged = 0      # number of deltas merged into a later one
+
+        # Image PV name -> (max delta elements, function that requests a full
+        # frame).  (See set_delta_limit().)
+        self._delta_limits = {}
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop_requested = False
+
+
+    def set_rate( self, pv_name, rate):
+        '''
+        Limit the PV to at most 'rate' updates per second.  A rate of 0 (the
+        default) means every value is published.
+        '''
+        if rate > 0:
+            self._intervals[pv_name] = 1.0 / rate
+        elif pv_name in self._intervals:
+            del self._intervals[pv_name]
+
+
+    def set_delta_limit( self, pv_name, max_elements, request_full_frame):
+        '''
+        Set the size of the delta waveforms for the image PV.  If merging
+        its queued deltas ends up with more elements than that, the deltas
+        are dropped and request_full_frame() is called (with no arguments).
+        '''
+        self._delta_limits[pv_name] = (max_elements, request_full_frame)
+
+
+    def start( self):
+        '''
+        Start the publisher thread.  Until this is called, values are only
+        published when flush() is called.
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.debug( "Starting publisher thread")
+
+        self._stop_requested = False
+        # The CA backend uses a CAThread, which makes sure the thread uses the
+        # same CA context as the rest of the program
+        self._thread = self.backend.thread_class( target=self._run,
+                                                  name="PV Publisher")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop( self):
+        '''
+        Stop the publisher thread (if it's running) and publish anything
+        that's still pending.
+        '''
+        if self._thread is not None:
+            self._cond.acquire()
+            self._stop_requested = True
+            self._cond.notify()
+            self._cond.release()
+            self._thread.join()
+            self._thread = None
+
+        self._put_values( self._take_pending( ignore_rates = True), True)
+        self.backend.close()
+
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        if self._coalesced:
+            logger.info( "Publisher coalesced %d values"%self._coalesced)
+        if self._merged:
+            logger.info( "Publisher merged %d deltas"%self._merged)
+
+
+    def post( self, pv_name, value):
+        '''
+        Set the latest value for a PV.  Replaces any value for the same PV
+        that hasn't been published yet.  (Except for the delta PV's, which
+        are queued.)
+        '''
+        if self._thread is not None:
+            value = _snapshot( value)
+
+        self._cond.acquire()
+        if split_delta_name( pv_name)[1] is not None:
+            self._pending.setdefault( pv_name, []).append( value)
+        else:
+            if pv_name in self._pending:
+                self._coalesced += 1
+            self._pending[pv_name] = value
+
+            # A full frame supersedes any deltas that are still queued
+            for suffix in DELTA_SUFFIXES:
+                if pv_name + suffix in self._pending:
+                    self._merged += len( self._pending.pop( pv_name + suffix))
+        self._cond.release()
+
+
+    def flush( self):
+        '''
+        Called at the end of each chunk.  In threaded mode, this just wakes
+        up the publisher thread.  Otherwise, it puts all the values that are
+        due right now.
+        '''
+        if self._thread is not None:
+            self._cond.acquire()
+            self._cond.notify()
+            self._cond.release()
+        else:
+            # In Mantid's thread, so don't wait for the puts to complete
+            self._put_values( self._take_pending(), False)
+
+
+    def _take_pending( self, ignore_rates = False):
+        '''
+        Removes and returns the (name, value) pairs that are due to be
+        published.
+        '''
+        now = time.time()
+        self._cond.acquire()
+        due = [ n for n in self._pending
+                if ignore_rates or self._next_put_time( n) <= now ]
+        items = []
+        deltas = []
+        for n in due:
+            (base_name, suffix) = split_delta_name( n)
+            if suffix is None:
+                items.append( (n, self._pending.pop(n)))
+            elif suffix == DELTA_SUFFIXES[0]:
+                deltas.extend( self._take_delta( base_name))
+        self._cond.release()
+
+        # Any full frame has to go out before the (newer) deltas that follow
+        # it, or clients would end up showing the old frame
+        return items + deltas
+
+
+    def _take_delta( self, pv_name):
+        '''
+        Removes the queued deltas for the image PV and returns the
+        (name, value) pairs for its delta PV's, with the deltas merged into
+        one.  Must be called with the lock held.
+        '''
+        names = [ pv_name + suffix for suffix in DELTA_SUFFIXES ]
+        queues = [ self._pending.get( n, []) for n in names ]
+
+        # The _DELTA_VAL for the last chunk may not have been posted yet
+        count = min( [ len( q) for q in queues ])
+        if count == 0:
+            return []
+        (idx_parts, val_parts) = [ q[:count] for q in queues ]
+        for (n, q) in zip( names, queues):
+            del q[:count]
+            if not q:
+                del self._pending[n]
+
+        if count == 1:
+            (idx, val) = (idx_parts[0], val_parts[0])
+        else:
+            # The values are the new element values (not increments), so
+            # only the newest value for each element is kept
+            idx = np.concatenate( idx_parts)[::-1]
+            val = np.concatenate( val_parts)[::-1]
+            (idx, newest) = np.unique( idx, return_index = True)
+            val = val[newest]
+            self._merged += count - 1
+
+        (max_elements, request_full_frame) = \
+            self._delta_limits.get( pv_name, (None, None))
+        if max_elements is not None and len( idx) > max_elements:
+            logger = logging.getLogger( "MantidStats::%s"% __name__)
+            logger.debug( "Merged delta for PV %s is too big (%d elements).  "
+                          "Requesting a full frame."%(pv_name, len( idx)))
+            request_full_frame()
+            return []
+        return zip( names, (idx, val))
+
+
+    def _next_put_time( self, pv_name):
+        put_time = self._last_put.get( pv_name, 0.0) + \
+                   self._intervals.get( pv_name, 0.0)
+
+        # Deltas are held back until any pending full frame of their image
+        # is published, since they're newer than it
+        (base_name, suffix) = split_delta_name( pv_name)
+        if suffix is not None and base_name in self._pending:
+            put_time = max( put_time, self._next_put_time( base_name))
+        return put_time
+
+
+    def _put_values( self, items, wait):
+        '''
+        Hands the values to the backend and notes when each PV was last
+        published (for the rate limits).  wait says whether the backend may
+        block until the values are delivered.
+        '''
+        if not items:
+            return
+        self.backend.put_values( items, self._record_time, wait)
+
+        now = time.time()
+        for (pv_name, value) in items:
+            self._last_put[pv_name] = now
+
+
+    def _record_time( self, pv_name, seconds):
+        if self._timings is not None:
+            self._timings.record( PUT, pv_name, seconds)
+
+
+    def _run( self):
+        '''
+        Main loop for the publisher thread
+        '''
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+
+        while True:
+            self._cond.acquire()
+            while not self._stop_requested:
+                if self._pending:
+                    # Sleep until the earliest pending value is due (or until
+                    # someone posts a new value)
+                    wait_time = min( [ self._next_put_time( n)
+                                       for n in self._pending ]) - time.time()
+                    if wait_time <= 0:
+                        break
+                    self._cond.wait( wait_time)
+                else:
+                    self._cond.wait()
+            stop = self._stop_requested
+            self._cond.release()
+
+            if stop:
+                break
+
+            try:
+                self._put_values( self._take_pending(), True)
+            except Exception, e:
+                # Don't let one bad value kill the thread
+                logger.error( "Exception publishing PV values: %s"%e)
+
+        logger.debug( "Publisher thread exiting")
+
+# End of class Publisher
@@ -0,0 +1,59 @@
+'''
+Created on Oct 18, 2026
+
+
+Helpers for reading optional values out of the config file.
+
+System-wide options live in the [System Config] section.  Options for an
+individual process variable live in a section named after the PV.  For
+example, options for the EVTHISTO PV go in a section called
+[EVTHISTO Config].
+'''
+
+import logging
+
+
+def pv_section( pv_name):
+    '''
+    Returns the name of the config file section for the specified PV
+    '''
+    return "%s Config"%pv_name
+
+
+def get_option( config, section, option, default = None, opt_type = str):
+    '''
+    Returns the value of an option from the config file, or default if the
+    option (or the whole section) isn't there.
+
+    config is a ConfigParser object.  (May be None, in which case the default
+      is always returned.)
+    opt_type is one of str, int, float or bool
+
+    A value that can't be converted to opt_type is logged and the default
+    is returned instead.
+    '''
+    if config is None or not config.has_option( section, option):
+        return default
+
+    getters = { str   : config.get,
+                int   : config.getint,
+                float : config.getfloat,
+                bool  : config.getboolean }
+    try:
+        return getters[opt_type]( section, option)
+    except ValueError:
+        logger = logging.getLogger( "MantidStats::%s"% __name__)
+        logger.error( "Invalid value '%s' for option '%s' in section [%s]. "
+                      "Using the default (%s) instead." %
+                      (config.get( section, option), option, section,
+                       str(default)))
+        return default
+
+
+def get_pv_option( config, pv_name, option, default = None, opt_type = str):
+    '''
+    Returns the value of an option from the PV's own config section.
+
+    See get_option() for details.
+    '''
+    return get_option( config, pv_section( pv_name), option, default, opt_type)
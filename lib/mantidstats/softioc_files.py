@@ -53,17 +53,18 @@ def writeStandardAORecord( pv_name):
     record += '\n'
     return record
 
-def writeStandardWaveformRecord( pv_name, num_elements):
+def writeStandardWaveformRecord( pv_name, num_elements, ftvl = "LONG"):
     '''
     Returns a single 'record' block of type 'waveform'
 
     pv_name is the name part of the process variable string
     num_elements is the number of individual values in the waveform
+    ftvl is the EPICS type of the individual values (LONG, DOUBLE, etc..)
     '''
     record = 'record( waveform, "$(PREFIX):%s"){\n' % pv_name
     record += '  field(DTYP,"Soft Channel")\n'
     record += '  field(SCAN,"Passive")\n'
-    record += '  field(FTVL,"LONG")\n'
+    record += '  field(FTVL,"%s")\n'%ftvl
     record += '  field(NELM,"%d")\n'%num_elements
     record += '  field(UDF,1)\n'
     record += '}\n'
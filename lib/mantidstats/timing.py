@@ -0,0 +1,165 @@
+'''
+Created on Oct 18, 2026
+
+
+Lightweight timing of the PV calc functions and PV puts.
+
+The main program records how long each calc function and each put takes.
+For every PV, the last few hundred samples are kept in a ring buffer and
+summarized as p50/p95/max (in milliseconds).  The summaries are written to
+the log periodically and can also be published as extra PV's:
+
+<PV>_CALC_MS  - time spent in the PV's calc function
+<PV>_PUT_MS   - time spent putting the PV's value.  For CA, that's the time
+                to queue the value in the group put, plus an even share of
+                the time to send the group.  (And, with ASYNC_PUBLISH, to
+                wait for the IOC to process it.)
+
+Each of these is a 3 element waveform holding [p50, p95, max].
+'''
+
+import threading
+import time
+
+import numpy as np
+
+from softioc_files import writeStandardWaveformRecord
+
+CALC = 'CALC'
+PUT = 'PUT'
+KINDS = (CALC, PUT)
+
+# Number of samples kept for each PV
+DEFAULT_WINDOW = 256
+
+
+def timing_pv_name( pv_name, kind):
+    '''
+    Returns the name of the PV that publishes the timing stats of the given
+    kind (CALC or PUT) for pv_name
+    '''
+    return "%s_%s_MS"%(pv_name, kind)
+
+
+def generateDbRecord( pv_name):
+    '''
+    Returns the database record for one of the timing PV's
+    '''
+    return writeStandardWaveformRecord( pv_name, 3, ftvl = "DOUBLE")
+
+
+class RollingHistogram(object):
+    '''
+    Keeps the most recent 'window' samples in a preallocated ring buffer.
+    Recording a sample is O(1); the percentiles are only computed when
+    someone asks for them.
+    '''
+
+    def __init__(self, window = DEFAULT_WINDOW):
+        self._samples = np.zeros( window, dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def record( self, value):
+        self._samples[self._next] = value
+        self._next = (self._next + 1) % len(self._samples)
+        if self._count < len(self._samples):
+            self._count += 1
+
+    def __len__( self):
+        return self._count
+
+    def stats( self):
+        '''
+        Returns an array holding [p50, p95, max] of the current samples.
+        (All zeros if there are no samples yet.)
+        '''
+        if self._count == 0:
+            return np.zeros( 3, dtype=np.float64)
+        samples = self._samples[:self._count]
+        (p50, p95) = np.percentile( samples, [50, 95])
+        return np.array( [p50, p95, samples.max()], dtype=np.float64)
+
+# End of class RollingHistogram
+
+
+class Timings(object):
+    '''
+    Holds a RollingHistogram of calc times and one of put times for each PV.
+
+    Puts may be timed from the publisher thread, so recording is protected
+    by a lock.
+    '''
+
+    def __init__(self, window = DEFAULT_WINDOW):
+        self._window = window
+        self._hists = {}     # (kind, PV name) -> RollingHistogram
+        self._lock = threading.Lock()
+
+        self._report_interval = 0.0   # seconds; 0 disables reports
+        self._last_report = time.time()
+
+    def set_report_interval( self, interval):
+        '''
+        Sets how often (in seconds) report_due() returns True.  0 means never.
+        '''
+        self._report_interval = interval
+
+    def record( self, kind, pv_name, seconds):
+        '''
+        Records one sample.  kind is CALC or PUT.
+        '''
+        self._lock.acquire()
+        try:
+            key = (kind, pv_name)
+            if not key in self._hists:
+                self._hists[key] = RollingHistogram( self._window)
+            self._hists[key].record( seconds * 1000.0)
+        finally:
+            self._lock.release()
+
+    def stats( self, kind, pv_name):
+        '''
+        Returns [p50, p95, max] (in milliseconds) for the PV
+        '''
+        self._lock.acquire()
+        try:
+            if not (kind, pv_name) in self._hists:
+                return np.zeros( 3, dtype=np.float64)
+            return self._hists[(kind, pv_name)].stats()
+        finally:
+            self._lock.release()
+
+    def report_due( self):
+        '''
+        Returns True (once) each time the report interval has elapsed
+        '''
+        if self._report_interval <= 0:
+            return False
+        now = time.time()
+        if now - self._last_report < self._report_interval:
+            return False
+        self._last_report = now
+        return True
+
+    def summary( self, pv_names):
+        '''
+        Returns a multi-line string summarizing the timings for the PV's,
+        slowest p95 calc time first
+        '''
+        rows = []
+        for name in pv_names:
+            calc = self.stats( CALC, name)
+            put = self.stats( PUT, name)
+            rows.append( (calc[1], name, calc, put))
+        rows.sort( reverse=True)
+
+        lines = [ "  %-20s %23s  %23s" % ("PV timings (ms)",
+                                          "calc p50/p95/max",
+                                          "put p50/p95/max") ]
+        for (_, name, calc, put) in rows:
+            lines.append( "  %-20s %7.2f/%7.2f/%7.2f  %7.2f/%7.2f/%7.2f" %
+                          ((name,) + tuple(calc) + tuple(put)))
+        return "\n".join( lines)
+
+# End of class Timings
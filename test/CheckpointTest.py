@@ -0,0 +1,127 @@
+'''
+Created on Oct 18, 2026
+
+
+Checks that the detector image state survives a checkpoint, and that
+restoring it always uses the current config.  Doesn't need Mantid or EPICS.
+
+Example:
+    python CheckpointTest.py
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import ConfigParser
+
+import numpy as np
+
+_LIB_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                         os.pardir, 'lib')
+sys.path[:0] = [ _LIB_DIR, os.path.join( _LIB_DIR, 'mantidstats'),
+                 os.path.join( _LIB_DIR, 'mantidstats', 'plugins') ]
+
+from checkpoint import Checkpointer
+from plugin_worker import WorkerContext
+from detector_image import calc_detector_image
+
+PV_NAME = 'DETIMAGE'
+RUN_NUM = 1234
+NUM_PIXELS = 64
+
+
+def make_config( **options):
+    '''
+    Returns the config for an 8x8 raster image of the 64 pixels, with any
+    of its options overridden
+    '''
+    values = { 'PROJECTION' : 'raster',
+               'WIDTH' : '8',
+               'HEIGHT' : '8',
+               'ROW_LENGTH' : '8' }
+    values.update( options)
+
+    config = ConfigParser.ConfigParser()
+    config.add_section( 'DETIMAGE Config')
+    for (name, value) in values.items():
+        config.set( 'DETIMAGE Config', name, value)
+    return config
+
+
+def make_context( counts):
+    positions = np.zeros( (NUM_PIXELS, 3))
+    positions[:, 2] = 1.0
+    return WorkerContext( { 'detector_positions' : positions,
+                            'instrument_id' : 'TEST',
+                            'num_spectra' : NUM_PIXELS,
+                            'spectrum_counts' : counts,
+                            'total_events' : int( counts.sum()) })
+
+
+def run_chunk( func, config, counts):
+    return func( chunkWS = None, pv_name = PV_NAME, run_num = RUN_NUM,
+                 config = config, context = make_context( counts))
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp( self):
+        self._dir = tempfile.mkdtemp()
+        self._counts = np.arange( NUM_PIXELS, dtype=np.int64) * 1000
+
+        # Accumulate a couple of chunks and checkpoint the result
+        old = calc_detector_image()
+        config = make_config()
+        run_chunk( old, config, self._counts)
+        self._expected = np.array( run_chunk( old, config, self._counts))
+
+        checkpointer = Checkpointer( self._dir)
+        self.assertTrue( checkpointer.save( RUN_NUM, { PV_NAME : old.get_state() }))
+        self._states = checkpointer.load( RUN_NUM)
+
+    def tearDown( self):
+        shutil.rmtree( self._dir)
+
+    def restore( self, config):
+        '''
+        Restores the checkpoint into a new image and returns what it
+        publishes for a chunk with no events
+        '''
+        new = calc_detector_image()
+        new.set_state( self._states[PV_NAME])
+        return run_chunk( new, config, np.zeros( NUM_PIXELS, np.int64))
+
+    def test_round_trip( self):
+        self.assertEqual( self._states.keys(), [PV_NAME])
+        self.assertFalse( 'config' in self._states[PV_NAME])
+
+        output = self.restore( make_config())
+        self.assertTrue( np.array_equal( output, self._expected))
+
+    def test_changed_waveform_type( self):
+        # The settings come from the current config and the counts are
+        # converted (and saturated) to the new type
+        output = self.restore( make_config( WAVEFORM_TYPE = 'SHORT'))
+        self.assertEqual( output.dtype, np.int16)
+        self.assertTrue( np.array_equal( output,
+                                         np.minimum( self._expected, 32767)))
+
+        output = self.restore( make_config( WAVEFORM_TYPE = 'FLOAT'))
+        self.assertEqual( output.dtype, np.float32)
+        self.assertTrue( np.array_equal( output, self._expected))
+
+    def test_changed_geometry( self):
+        # A different binning means a different pixel map, so the old image
+        # is discarded
+        output = self.restore( make_config( BIN_X = '2'))
+        self.assertTrue( output.max() == 0)
+
+        output = self.restore( make_config( WIDTH = '16'))
+        self.assertEqual( output.size, 16 * 8)
+        self.assertTrue( output.max() == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
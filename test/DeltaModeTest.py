@@ -0,0 +1,113 @@
+'''
+Created on Oct 18, 2026
+
+
+Checks the delta PV's of the detector image, including with a WAVEFORM_TYPE
+that saturates.  Doesn't need Mantid or EPICS.
+
+Example:
+    python DeltaModeTest.py
+'''
+
+import os
+import sys
+import unittest
+import ConfigParser
+
+import numpy as np
+
+_LIB_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                         os.pardir, 'lib')
+sys.path[:0] = [ _LIB_DIR, os.path.join( _LIB_DIR, 'mantidstats'),
+                 os.path.join( _LIB_DIR, 'mantidstats', 'plugins') ]
+
+from plugin_worker import WorkerContext
+from detector_image import calc_detector_image
+
+PV_NAME = 'DETIMAGE'
+NUM_PIXELS = 64
+
+
+def make_config( **options):
+    '''
+    Returns the config for an 8x8 raster image of the 64 pixels in delta
+    mode, with any of its options overridden
+    '''
+    values = { 'PROJECTION' : 'raster',
+               'WIDTH' : '8',
+               'HEIGHT' : '8',
+               'ROW_LENGTH' : '8',
+               'DELTA_MODE' : 'True',
+               'FULL_FRAME_EVERY' : '1000' }
+    values.update( options)
+
+    config = ConfigParser.ConfigParser()
+    config.add_section( 'DETIMAGE Config')
+    for (name, value) in values.items():
+        config.set( 'DETIMAGE Config', name, value)
+    return config
+
+
+class DeltaModeTest(unittest.TestCase):
+
+    def run_chunk( self, counts):
+        '''
+        Returns (image, delta indexes, delta values) for a chunk
+        '''
+        positions = np.zeros( (NUM_PIXELS, 3))
+        context = WorkerContext( { 'detector_positions' : positions,
+                                   'instrument_id' : 'TEST',
+                                   'num_spectra' : NUM_PIXELS,
+                                   'spectrum_counts' : counts,
+                                   'total_events' : int( counts.sum()) })
+        image = self._func( chunkWS = None, pv_name = PV_NAME, run_num = 1,
+                            config = self._config, context = context)
+        return (image,
+                self._func.get_delta( PV_NAME + '_DELTA_IDX'),
+                self._func.get_delta( PV_NAME + '_DELTA_VAL'))
+
+    def check_deltas( self, waveform_type):
+        self._config = make_config( WAVEFORM_TYPE = waveform_type)
+        self._func = calc_detector_image()
+
+        # The first chunk is always a full frame
+        counts = np.ones( NUM_PIXELS, np.int64)
+        (image, idx, val) = self.run_chunk( counts)
+        self.assertTrue( image is not None)
+        self.assertTrue( idx is None)
+        expected = np.array( image)
+
+        # After that, only the pixels with new events are in the delta,
+        # even though every pixel already has counts
+        for pixels in ([3, 10], [10, 63], []):
+            counts = np.zeros( NUM_PIXELS, np.int64)
+            counts[pixels] = 50000
+            (image, idx, val) = self.run_chunk( counts)
+            self.assertTrue( image is None)
+            if not pixels:
+                self.assertTrue( idx is None)
+                continue
+            self.assertEqual( list( idx), pixels)
+            expected[idx] = val
+            self.assertEqual( val.dtype, expected.dtype)
+
+        # Applying the deltas gives the same image as a full frame
+        self._func._images[PV_NAME].request_full_frame()
+        (image, idx, val) = self.run_chunk( np.zeros( NUM_PIXELS, np.int64))
+        self.assertTrue( np.array_equal( image, expected))
+        return image
+
+    def test_long( self):
+        image = self.check_deltas( 'LONG')
+        self.assertEqual( image[10], 100001)
+
+    def test_short( self):
+        # Saturates at 32767 instead of wrapping around
+        image = self.check_deltas( 'SHORT')
+        self.assertEqual( image[3], 32767)
+        self.assertEqual( image[10], 32767)
+        self.assertEqual( image[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,27 @@ Created on Jul 2, 2014
 
 @author: xmr
 
-Used to test the EVT_HISTO process variables - reads the data and converts it to an image file
+Used to test the EVT_HISTO process variables - subscribes to the PV and
+converts the images it publishes to image files
+
+Each update is colored with a lookup table built from one of the
+map_color_* functions below, so coloring a frame is a couple of NumPy
+operations instead of a Python call per pixel.  Frames are written as PNG's
+(or as .npz files holding the raw counts) at most FRAME_RATE times a second.
+Updates that arrive faster than that are skipped.
+
+Example:
+    python HistoTest.py -p BL9:CS:EVTHISTO -o /tmp/evthisto -r 1
 '''
 
 from epics import PV
 import numpy as np
 from PIL import Image  # @UnresolvedImport
 import math
+import os
+import time
+import threading
+from optparse import OptionParser
 
 # Some constants we'll need
 # (Make sure these stay up-to-date with the main program!)
@@ -18,7 +32,12 @@ ARRAY_HEIGHT = 800
 
 PV_NAME = "BL9_TEST:CS:EVTHISTO"
 #PV_NAME = "BL9:CS:EVTHISTO"
-        
+
+# Number of entries in the color lookup table.  Counts are mapped to the
+# table on a log scale.  (map_color_2 uses 16 bits of color, so the table
+# needs 65536 entries to reproduce it.)
+LUT_SIZE = 65536
+
 
 # some globals that may be useful for mapping the colors
 max_val = 0
@@ -28,58 +47,203 @@ half_log_max = 0
 one_third_log_max = 0
 two_thirds_log_max = 0
 
-def main():
+
+class FrameMonitor(object):
+    '''
+    Holds the most recent value of the image PV.  The PV's monitor callback
+    only copies the data.  The coloring & writing happen in the main loop.
+    '''
+    def __init__(self, pv_name):
+        self._lock = threading.Lock()
+        self._data = None
+        self._timestamp = None
+        self._count = 0     # number of updates received
+        self.pv = PV( pv_name, auto_monitor=True, callback=self._on_update)
+
+    def _on_update(self, value=None, timestamp=None, **kwargs):
+        if value is None:
+            return
+        data = np.array( value)
+        self._lock.acquire()
+        try:
+            self._data = data
+            self._timestamp = timestamp
+            self._count += 1
+        finally:
+            self._lock.release()
+
+    def latest(self):
+        '''
+        Returns (update count, timestamp, data) for the newest update
+        '''
+        self._lock.acquire()
+        try:
+            return (self._count, self._timestamp, self._data)
+        finally:
+            self._lock.release()
+
+
+def set_scale( data):
+    '''
+    Sets the globals used by the map_color_* functions from the image data
+    '''
     global max_val, half_max_val, log_max, half_log_max, one_third_log_max, two_thirds_log_max
-    
-    histo = PV(PV_NAME)
-    
-    # Fetch the data from the PV and convert it back to a
-    # 2D array with the proper dimensions 
-    data = np.array(histo.value)
-    data = data.reshape(ARRAY_WIDTH, ARRAY_HEIGHT)
-
-    max_val = data.max()  # used to scale the color mapping
-    print "Max value:", max_val
+
+    max_val = max( int( data.max()), 2)  # used to scale the color mapping
     half_max_val = max_val / 2
     # MantidPlot defaults to a logarithmic scale, so we will, too
     log_max = math.log(max_val,10)
     half_log_max = log_max / 2
     one_third_log_max = log_max / 3
     two_thirds_log_max = one_third_log_max * 2
-         
-    img = Image.new("RGB", (ARRAY_WIDTH, ARRAY_HEIGHT))
-
-    # Write the individual image pixels based on the array data
-    # -1 will be converted to black, all other values will range
-    # from blue to purple
-    for x in range(ARRAY_WIDTH):
-        for y in range(ARRAY_HEIGHT):
-            evt_cnt = data[x,y]
-            if evt_cnt == -1:
-                img.putpixel( (x,y), (0,0,0)) # write a black pixel
-            elif evt_cnt == 0:
-                img.putpixel( (x,y), (0,0,255))
-            else:
-                img.putpixel( (x,y), map_color_3(evt_cnt))
-                
-            # Note: putpixel() is known to be slow, but there doesn't seem to
-            # be a better way to do things.
-    
-    img.show()  # show() is slow and klunky and requires 'xv' - it's really
-                # meant only for debugging.
+
+
+# The last table built, since max_val often doesn't change between frames
+_lut_cache = {}
+
+def build_lut( map_color):
+    '''
+    Returns a (LUT_SIZE, 3) uint8 array of colors.  Entry i is the color for
+    the count at i / (LUT_SIZE - 1) of the way from 1 to max_val on a log
+    scale.  set_scale() must be called first.
+    '''
+    key = (map_color, max_val)
+    if key in _lut_cache:
+        return _lut_cache[key]
+
+    lut = np.zeros( (LUT_SIZE, 3), dtype=np.int32)
+    for i in range( LUT_SIZE):
+        evt_cnt = 10 ** (log_max * i / (LUT_SIZE - 1))
+        try:
+            lut[i] = map_color( evt_cnt)
+        except ValueError:
+            # log() of 0 (map_color_1 at exactly half the max)
+            lut[i] = lut[i - 1] if i else (0, 0, 255)
+    _lut_cache.clear()
+    _lut_cache[key] = np.clip( lut, 0, 255).astype( np.uint8)
+    return _lut_cache[key]
+
+
+def color_image( data, map_color):
+    '''
+    Converts a 2D array of event counts to an RGB PIL image.
+    -1 will be converted to black, 0 to blue and all other values will range
+    from blue to purple (depending on map_color)
+    '''
+    set_scale( data)
+    lut = build_lut( map_color)
+
+    counts = np.maximum( data, 1).astype( np.float64)
+    index = np.log10( counts)
+    index *= (LUT_SIZE - 1) / log_max
+    index = np.clip( index, 0, LUT_SIZE - 1).astype( np.intp)
+
+    rgb = lut[index]
+    rgb[data == 0] = (0, 0, 255)
+    rgb[data < 0] = (0, 0, 0)
+
+    # data is indexed [x, y], but images are stored a row (y) at a time
+    return Image.fromarray( np.ascontiguousarray( rgb.transpose( 1, 0, 2)),
+                            "RGB")
+
+
+def write_frame( data, timestamp, frame_num, options, map_color):
+    path = os.path.join( options.output_dir, "frame_%05d.%s"%(frame_num,
+                                                            options.format))
+    if options.format == 'npz':
+        if timestamp is None:
+            timestamp = time.time()
+        np.savez( path, counts=data, timestamp=timestamp)
+    else:
+        color_image( data, map_color).save( path)
+    return path
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-p", "--pv", dest="pv_name", default=PV_NAME,
+                      help="the image PV to watch (default: %default)")
+    parser.add_option("-W", "--width", dest="width", type="int",
+                      default=ARRAY_WIDTH,
+                      help="image width (default: %default)")
+    parser.add_option("-H", "--height", dest="height", type="int",
+                      default=ARRAY_HEIGHT,
+                      help="image height (default: %default)")
+    parser.add_option("-o", "--output_dir", dest="output_dir", default=".",
+                      help="directory the frames are written to")
+    parser.add_option("-f", "--format", dest="format", default="png",
+                      choices=["png", "npz"],
+                      help="png (colored image) or npz (raw counts)")
+    parser.add_option("-r", "--frame_rate", dest="frame_rate", type="float",
+                      default=1.0,
+                      help="maximum frames written per second (default: %default)")
+    parser.add_option("-n", "--num_frames", dest="num_frames", type="int",
+                      default=0,
+                      help="stop after this many frames (default: run until ^C)")
+    parser.add_option("-c", "--color_map", dest="color_map", type="int",
+                      default=3, help="which map_color_* function to use (1-3)")
+    (options, args) = parser.parse_args()
+
+    map_color = { 1 : map_color_1,
+                  2 : map_color_2,
+                  3 : map_color_3 }.get( options.color_map)
+    if map_color is None:
+        parser.error( "color_map must be 1, 2 or 3")
+    if options.frame_rate <= 0:
+        parser.error( "frame_rate must be > 0")
+    if not os.path.isdir( options.output_dir):
+        os.makedirs( options.output_dir)
+
+    monitor = FrameMonitor( options.pv_name)
+    period = 1.0 / options.frame_rate
+    last_count = 0
+    frame_num = 0
+
+    try:
+        next_frame = time.time()
+        while options.num_frames == 0 or frame_num < options.num_frames:
+            time.sleep( max( 0, next_frame - time.time()))
+            # If writing a frame took too long, start over from now rather
+            # than trying to catch up
+            next_frame = max( next_frame + period, time.time())
+
+            (count, timestamp, data) = monitor.latest()
+            if count == last_count:
+                continue  # nothing new since the last frame
+            if count > last_count + 1:
+                print "Skipped %d update(s)"%(count - last_count - 1)
+            last_count = count
+
+            if data.size != options.width * options.height:
+                print "Expected %d elements, got %d.  Check the width & " \
+                      "height."%(options.width * options.height, data.size)
+                continue
+
+            # Convert the data back to a 2D array with the proper dimensions
+            data = data.reshape(options.width, options.height)
+
+            start = time.time()
+            path = write_frame( data, timestamp, frame_num, options, map_color)
+            print "Wrote %s (max value %d) in %.3f sec"%(path, data.max(),
+                                                         time.time() - start)
+            frame_num += 1
+    except KeyboardInterrupt:
+        pass
+
+    monitor.pv.disconnect()
 
 
 
 # returns an R,G,B tuple
 def map_color_1( evt_cnt):
-    rv = (0,0,0)  
+    rv = (0,0,0)
     if evt_cnt < half_max_val:
         color = int((math.log(evt_cnt,10) / half_log_max) * 255)
         rv = (color, 0, 255)
     else:
         color = int(( (math.log(evt_cnt - half_max_val,10) / half_log_max) * 255))
         rv = (255-color, color, 255)
-    
+
     return rv
 
 # Another method for mapping event counts to colors
@@ -92,7 +256,7 @@ def map_color_2( evt_cnt):
 
 
 def map_color_3( evt_cnt):
-    rv = (0,0,0)  
+    rv = (0,0,0)
     log_evt_cnt = math.log(evt_cnt, 10)
     if log_evt_cnt < one_third_log_max:
         color = int((log_evt_cnt / one_third_log_max) * 255)
@@ -104,7 +268,7 @@ def map_color_3( evt_cnt):
         color = int(( (log_evt_cnt - two_thirds_log_max) / one_third_log_max) * 255)
         rv = (color, 255, color)
         #print "Events:  %d ==> %s"%(evt_cnt, str(rv))
-    
+
     return rv
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+'''
+Created on Oct 18, 2026
+
+
+Checks that a cached pixel map is used without collecting the detector
+positions, both in the main process and in a worker process (which fetches
+the positions from the main process only when the map isn't cached).
+Doesn't need Mantid or EPICS.
+
+Example:
+    python PixelMapCacheTest.py
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import ConfigParser
+import multiprocessing as mp
+
+import numpy as np
+
+_LIB_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                         os.pardir, 'lib')
+sys.path[:0] = [ _LIB_DIR, os.path.join( _LIB_DIR, 'mantidstats'),
+                 os.path.join( _LIB_DIR, 'mantidstats', 'plugins') ]
+
+import plugin_worker
+from plugin_worker import WorkerContext, PluginWorker
+from detector_image import calc_detector_image
+
+PV_NAME = 'DETIMAGE'
+NUM_PIXELS = 64
+
+
+def make_positions():
+    '''
+    8 tubes of 8 pixels each, on a cylinder around the Y axis
+    '''
+    angles = np.repeat( np.linspace( 0.0, 1.0, 8), 8)
+    positions = np.empty( (NUM_PIXELS, 3))
+    positions[:, 0] = 2.0 * np.sin( angles)
+    positions[:, 1] = np.tile( np.linspace( -0.5, 0.5, 8), 8)
+    positions[:, 2] = 2.0 * np.cos( angles)
+    return positions
+
+
+def make_context( with_positions = True):
+    counts = np.arange( NUM_PIXELS, dtype=np.int64)
+    values = { 'run_number' : 1,
+               'instrument_id' : 'TEST',
+               'num_spectra' : NUM_PIXELS,
+               'spectrum_counts' : counts,
+               'total_events' : int( counts.sum()) }
+    if with_positions:
+        values['detector_positions'] = make_positions()
+    return WorkerContext( values)
+
+
+class PixelMapCacheTest(unittest.TestCase):
+
+    def setUp( self):
+        self._dir = tempfile.mkdtemp()
+        self._config = ConfigParser.ConfigParser()
+        self._config.add_section( 'System Config')
+        self._config.set( 'System Config', 'PIXEL_MAP_CACHE_DIR', self._dir)
+        self._config.add_section( 'DETIMAGE Config')
+        self._config.set( 'DETIMAGE Config', 'PROJECTION', 'auto')
+        self._config.set( 'DETIMAGE Config', 'WIDTH', '16')
+        self._config.set( 'DETIMAGE Config', 'HEIGHT', '16')
+
+    def tearDown( self):
+        shutil.rmtree( self._dir)
+
+    def run_chunk( self, context, config = None):
+        return calc_detector_image()( chunkWS = None, pv_name = PV_NAME,
+                                      run_num = 1,
+                                      config = config or self._config,
+                                      context = context)
+
+    def test_cache_hit( self):
+        expected = self.run_chunk( make_context())
+        self.assertEqual( len( os.listdir( self._dir)), 1)
+
+        # The second time, the map comes from the cache, so the positions
+        # aren't needed
+        image = self.run_chunk( make_context( with_positions = False))
+        self.assertTrue( np.array_equal( image, expected))
+
+    def test_cache_miss( self):
+        self.run_chunk( make_context())
+
+        # A different image size means a different map, which has to be
+        # built from the positions
+        self._config.set( 'DETIMAGE Config', 'WIDTH', '8')
+        self.assertRaises( KeyError, self.run_chunk,
+                           make_context( with_positions = False))
+        self.assertEqual( self.run_chunk( make_context()).size, 8 * 16)
+
+    def test_worker_fetch( self):
+        # Without a cache, the worker has to ask for the positions
+        self._config.remove_option( 'System Config', 'PIXEL_MAP_CACHE_DIR')
+        func = calc_detector_image()
+        expected = [ np.array( func( chunkWS = None, pv_name = PV_NAME,
+                                     run_num = 1, config = self._config,
+                                     context = make_context()))
+                     for i in range( 2) ]
+
+        plugin_worker.CAProcess = mp.Process  # no EPICS in the worker
+        worker = PluginWorker( PV_NAME, calc_detector_image(), self._config,
+                               "MantidStats", spares = 0)
+        worker.start()
+        try:
+            worker.submit( make_context())
+            self.assertTrue( np.array_equal( worker.result(), expected[0]))
+
+            # The image is built by now, so later chunks don't need them
+            worker.submit( make_context( with_positions = False))
+            self.assertTrue( np.array_equal( worker.result(), expected[1]))
+        finally:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
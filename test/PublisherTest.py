@@ -0,0 +1,133 @@
+'''
+Created on Oct 18, 2026
+
+
+Checks how the Publisher coalesces values and merges the image deltas.
+Doesn't need Mantid or EPICS.
+
+Example:
+    python PublisherTest.py
+'''
+
+import os
+import sys
+import time
+import unittest
+
+import numpy as np
+
+_LIB_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                         os.pardir, 'lib')
+sys.path[:0] = [ _LIB_DIR, os.path.join( _LIB_DIR, 'mantidstats') ]
+
+from publisher import Publisher
+from output_backends import NullBackend
+
+IDX = 'IMG_DELTA_IDX'
+VAL = 'IMG_DELTA_VAL'
+
+
+class RecordingBackend(NullBackend):
+    '''
+    Keeps every group of values it's given
+    '''
+    def __init__(self):
+        self.groups = []
+
+    def put_values( self, items, record_time, wait = True):
+        self.groups.append( list( items))
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp( self):
+        self._backend = RecordingBackend()
+        self._publisher = Publisher( self._backend)
+        self._full_frames = 0
+
+    def request_full_frame( self):
+        self._full_frames += 1
+
+    def post_delta( self, idx, val):
+        self._publisher.post( IDX, np.array( idx, np.int32))
+        self._publisher.post( VAL, np.array( val, np.int32))
+
+    def hold( self, *pv_names):
+        '''
+        Makes the PV's look like they were just published, with a rate limit
+        that holds back anything posted for them now
+        '''
+        for pv_name in pv_names:
+            self._publisher.set_rate( pv_name, 0.1)
+            self._publisher._last_put[pv_name] = time.time()
+
+    def flush( self):
+        '''
+        Publishes everything and returns the names & values in the order
+        they were put
+        '''
+        items = self._publisher._take_pending( ignore_rates = True)
+        self._publisher._put_values( items, True)
+        return items
+
+    def test_coalesce( self):
+        self.hold( 'A')
+        self._publisher.post( 'A', 1)
+        self._publisher.post( 'A', 2)
+        self._publisher.flush()
+        self.assertEqual( self._backend.groups, [])
+        self.assertEqual( self.flush(), [ ('A', 2) ])
+
+    def test_merge( self):
+        self.hold( IDX, VAL)
+        self.post_delta( [1, 2], [10, 20])
+        self.post_delta( [2, 3], [21, 30])
+        self.post_delta( [1], [11])
+        self._publisher.flush()
+        self.assertEqual( self._backend.groups, [])
+
+        items = dict( self.flush())
+        self.assertEqual( list( items[IDX]), [1, 2, 3])
+        self.assertEqual( list( items[VAL]), [11, 21, 30])
+
+    def test_merge_too_big( self):
+        self._publisher.set_delta_limit( 'IMG', 3, self.request_full_frame)
+        self.hold( IDX, VAL)
+        self.post_delta( [1, 2], [10, 20])
+        self.post_delta( [3, 4], [30, 40])
+        self.assertEqual( self.flush(), [])
+        self.assertEqual( self._full_frames, 1)
+
+    def test_full_frame_drops_older_deltas( self):
+        self.hold( 'IMG', IDX, VAL)
+        self.post_delta( [1], [10])
+        self._publisher.post( 'IMG', np.arange( 4))
+        self.assertEqual( [ n for (n, v) in self.flush() ], ['IMG'])
+
+    def test_full_frame_before_newer_deltas( self):
+        self.hold( 'IMG', IDX, VAL)
+        self._publisher.post( 'IMG', np.arange( 4))
+        self.post_delta( [1], [10])
+        names = [ n for (n, v) in self.flush() ]
+        self.assertEqual( names[0], 'IMG')
+        self.assertEqual( sorted( names[1:]), [IDX, VAL])
+
+    def test_rate_limited_frame_holds_deltas( self):
+        # The image is held back by its rate limit, so the newer deltas have
+        # to wait for it
+        self.hold( 'IMG')
+        self._publisher.post( 'IMG', np.arange( 4))
+        self.post_delta( [1], [10])
+        self._publisher.flush()
+        self.assertEqual( self._backend.groups, [])
+
+        # Once the frame is due, it goes out first
+        self._publisher._last_put['IMG'] = 0.0
+        self._publisher.flush()
+        names = [ n for (n, v) in self._backend.groups[-1] ]
+        self.assertEqual( names[0], 'IMG')
+        self.assertEqual( sorted( names[1:]), [IDX, VAL])
+
+
+if __name__ == '__main__':
+    unittest.main()
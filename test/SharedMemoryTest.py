@@ -0,0 +1,109 @@
+'''
+Created on Oct 18, 2026
+
+
+Checks the shared memory output backend against its reader:  publishing,
+growing a PV, reusing the space a PV moved out of and the seqlock.  Doesn't
+need Mantid or EPICS.
+
+Example:
+    python SharedMemoryTest.py
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+_LIB_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                         os.pardir, 'lib')
+sys.path[:0] = [ _LIB_DIR, os.path.join( _LIB_DIR, 'mantidstats') ]
+
+from output_backends import SharedMemoryBackend, SharedMemoryReader
+
+
+def no_timing( pv_name, seconds):
+    pass
+
+
+class SharedMemoryTest(unittest.TestCase):
+
+    def setUp( self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join( self._dir, "mantidstats")
+        self._backend = SharedMemoryBackend( self._path, 1024 * 1024, 16)
+        self._reader = SharedMemoryReader( self._path)
+
+    def tearDown( self):
+        self._backend.close()
+        shutil.rmtree( self._dir)
+
+    def put( self, pv_name, value):
+        self._backend.put_values( [ (pv_name, value) ], no_timing)
+
+    def read( self, pv_name):
+        return self._reader.read( pv_name)[2]
+
+    def test_read_back( self):
+        self.assertTrue( self._reader.read( 'A') is None)
+
+        self.put( 'A', 42)
+        self.put( 'B', np.arange( 10, dtype=np.int16))
+        self.assertEqual( list( self.read( 'A')), [42])
+        value = self.read( 'B')
+        self.assertEqual( value.dtype, np.int16)
+        self.assertEqual( list( value), range( 10))
+
+        # Each update bumps the sequence number by 2
+        seq = self._reader.read( 'A')[0]
+        self.put( 'A', 43)
+        self.assertEqual( self._reader.read( 'A')[0], seq + 2)
+        self.assertEqual( list( self.read( 'A')), [43])
+
+    def test_grow( self):
+        # A PV that keeps growing only moves when it outgrows its block, and
+        # the total space used stays within a small multiple of its size
+        start = self._backend._next_free
+        for n in range( 1, 5000, 7):
+            value = np.arange( n, dtype=np.float64)
+            self.put( 'A', value)
+            self.assertTrue( np.array_equal( self.read( 'A'), value))
+        self.assertTrue( self._backend._next_free - start <= 4 * 5000 * 8)
+
+        # Shrinking doesn't move it
+        self.put( 'A', np.arange( 3.0))
+        self.assertEqual( list( self.read( 'A')), [0.0, 1.0, 2.0])
+
+    def test_reuse( self):
+        self.put( 'A', np.zeros( 1000, np.int32))
+        self.put( 'A', np.ones( 2000, np.int32))
+        end = self._backend._next_free
+
+        # B fits in the block A moved out of, so no new space is used
+        self.put( 'B', np.arange( 500, dtype=np.int32))
+        self.assertEqual( self._backend._next_free, end)
+        self.assertEqual( list( self.read( 'B')), range( 500))
+        self.assertTrue( np.array_equal( self.read( 'A'),
+                                         np.ones( 2000, np.int32)))
+
+    def test_torn_read( self):
+        # An odd sequence number means the writer is in the middle of an
+        # update, so the reader has to give up
+        self.put( 'A', np.arange( 10))
+        entry = self._backend._entries[self._backend._index['A']:][:1]
+        entry['seq'] += 1
+        self.assertRaises( RuntimeError, self._reader.read, 'A', 0.01)
+        entry['seq'] += 1
+        self.assertEqual( list( self.read( 'A')), range( 10))
+
+    def test_stale( self):
+        self.assertFalse( self._reader.stale())
+        SharedMemoryBackend( self._path, 1024 * 1024, 16).close()
+        self.assertTrue( self._reader.stale())
+
+
+if __name__ == '__main__':
+    unittest.main()